@@ -0,0 +1,68 @@
+# api_client/circuit_breaker.py
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker ساده برای یک پنل.
+    closed: درخواست‌ها عادی ارسال می‌شوند و خطاهای متوالی شمرده می‌شوند.
+    open: پس از failure_threshold خطای متوالی، تا recovery_timeout ثانیه همه درخواست‌ها فوراً رد می‌شوند.
+    half_open: پس از آن فقط یک درخواست آزمایشی اجازه دارد؛ موفقیت آن مدار را می‌بندد و شکستش دوباره باز می‌کند.
+    """
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, name, failure_threshold=5, recovery_timeout=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_started_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.recovery_timeout:
+                return self.HALF_OPEN
+            return self._state
+
+    def allow_request(self) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN:
+                if now - self._opened_at < self.recovery_timeout:
+                    return False
+                self._state = self.HALF_OPEN
+                self._probe_started_at = None
+            # half_open: فقط یک درخواست آزمایشی در هر لحظه (اگر قبلی گیر کرده باشد، یکی دیگر مجاز است)
+            if self._probe_started_at is None or now - self._probe_started_at >= self.recovery_timeout:
+                self._probe_started_at = now
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self._state != self.CLOSED:
+                logger.info(f"Circuit for {self.name} closed again.")
+            self._state = self.CLOSED
+            self._failures = 0
+            self._probe_started_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    logger.warning(f"Circuit for {self.name} opened after {self._failures} consecutive failure(s).")
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+                self._probe_started_at = None
@@ -0,0 +1,66 @@
+# api_client/client_registry.py
+
+import logging
+import threading
+
+from api_client.xui_api_client import XuiAPIClient
+
+logger = logging.getLogger(__name__)
+
+# رجیستری سراسری کلاینت‌های بلندمدت پنل‌ها: server_id -> (اثر انگشت اعتبارنامه، کلاینت)
+_clients = {}
+_lock = threading.Lock()
+
+
+def _fingerprint(server_data: dict):
+    return (server_data['panel_url'], server_data['username'], server_data['password'],
+            server_data.get('api_connect_timeout'), server_data.get('api_read_timeout'))
+
+
+def get_client_for_server(server_data: dict, client_class=XuiAPIClient):
+    """
+    کلاینت بلندمدت مربوط به یک سرور را برمی‌گرداند تا نشست (کوکی لاگین)، اتصالات
+    keep-alive و وضعیت circuit breaker بین درخواست‌ها حفظ شوند. اگر اطلاعات ورود یا timeoutهای سرور تغییر کرده باشد،
+    کلاینت قدیمی کنار گذاشته شده و یک کلاینت جدید ساخته می‌شود.
+    """
+    server_id = server_data['id']
+    fingerprint = _fingerprint(server_data)
+    stale_client = None
+    with _lock:
+        entry = _clients.get(server_id)
+        if entry and entry[0] == fingerprint and isinstance(entry[1], client_class):
+            return entry[1]
+        if entry:
+            stale_client = entry[1]
+        client = client_class(panel_url=server_data['panel_url'], username=server_data['username'], password=server_data['password'],
+                              connect_timeout=server_data.get('api_connect_timeout'),
+                              read_timeout=server_data.get('api_read_timeout'))
+        _clients[server_id] = (fingerprint, client)
+    if stale_client is not None:
+        logger.info(f"Credentials changed for server {server_id}; replacing its API client.")
+        _close_quietly(stale_client)
+    return client
+
+
+def evict(server_id):
+    """کلاینت یک سرور را (مثلاً پس از حذف سرور) از رجیستری حذف می‌کند."""
+    with _lock:
+        entry = _clients.pop(server_id, None)
+    if entry:
+        _close_quietly(entry[1])
+
+
+def clear():
+    with _lock:
+        entries = list(_clients.values())
+        _clients.clear()
+    for _, client in entries:
+        _close_quietly(client)
+
+
+def _close_quietly(client):
+    try:
+        if hasattr(client, 'close'):
+            client.close()
+    except Exception as e:
+        logger.warning(f"Error closing API client: {e}")
@@ -1,8 +1,19 @@
 # api_client/xui_api_client.py (نسخه جدید بر اساس مستندات Postman)
 
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import logging
+import random
+import threading
+import time
+
+from api_client.circuit_breaker import CircuitBreaker
+from config import (
+    MAX_API_RETRIES, API_RETRY_BACKOFF_BASE_SECONDS, API_RETRY_BACKOFF_MAX_SECONDS,
+    API_CONNECT_TIMEOUT_SECONDS, API_READ_TIMEOUT_SECONDS,
+    CIRCUIT_BREAKER_FAILURE_THRESHOLD, CIRCUIT_BREAKER_RECOVERY_SECONDS,
+)
 
 # غیرفعال کردن هشدارهای مربوط به SSL
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
@@ -10,44 +21,162 @@ requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
 logger = logging.getLogger(__name__)
 
+try:
+    import ijson
+except ImportError:  # پارس جریانی اختیاری است
+    ijson = None
+
+# فیلدهایی از هر اینباند که برای نمایش در منوها و ساخت لینک کانفیگ کافی است
+INBOUND_SUMMARY_FIELDS = ('id', 'remark', 'port', 'protocol', 'streamSettings', 'enable')
+
+_SCALAR_EVENTS = ('string', 'number', 'boolean', 'null')
+
+# فیلدهای آمار ترافیک هر کلاینت در clientStats اینباندها
+CLIENT_TRAFFIC_FIELDS = ('email', 'inboundId', 'up', 'down', 'total', 'expiryTime', 'enable')
+
+# درخواست‌هایی که تکرار آن‌ها عوارض جانبی ندارد و پس از خطای شبکه دوباره ارسال می‌شوند
+_IDEMPOTENT_METHODS = frozenset({'GET', 'HEAD', 'OPTIONS'})
+
+
+class _RetryableResponse(Exception):
+    """پاسخ 5xx که باید مانند خطای شبکه شمرده و (برای درخواست idempotent) تکرار شود."""
+    def __init__(self, response):
+        super().__init__(f"{response.status_code} Server Error for url: {response.url}")
+        self.response = response
+
+
+def _parse_inbound_stream(stream, fields):
+    """
+    پاسخ /panel/api/inbounds/list را به صورت رویدادمحور می‌خواند و برای هر اینباند
+    فقط فیلدهای اسکالر خواسته شده را نگه می‌دارد. خروجی: (success, inbounds)
+    """
+    wanted = {f"obj.item.{field}": field for field in fields}
+    success, inbounds, current = False, [], None
+    for prefix, event, value in ijson.parse(stream):
+        if current is not None:
+            if prefix == 'obj.item' and event == 'end_map':
+                inbounds.append(current)
+                current = None
+            elif event in _SCALAR_EVENTS and prefix in wanted:
+                current[wanted[prefix]] = value
+        elif prefix == 'obj.item' and event == 'start_map':
+            current = {}
+        elif prefix == 'success' and event == 'boolean':
+            success = value
+    return success, inbounds
+
+
+def _parse_client_stats_stream(stream, transform=None):
+    """
+    از پاسخ /panel/api/inbounds/list فقط آمار ترافیک کلاینت‌ها (clientStats تمام اینباندها)
+    را به صورت جریانی استخراج می‌کند. اگر transform داده شود، هر آیتم بلافاصله به خروجی آن
+    (مثلاً یک tuple فشرده) تبدیل می‌شود. خروجی: (success, client_stats)
+    """
+    wanted = {f"obj.item.clientStats.item.{field}": field for field in CLIENT_TRAFFIC_FIELDS}
+    success, client_stats, current = False, [], None
+    for prefix, event, value in ijson.parse(stream):
+        if current is not None:
+            if prefix == 'obj.item.clientStats.item' and event == 'end_map':
+                client_stats.append(transform(current) if transform else current)
+                current = None
+            elif event in _SCALAR_EVENTS and prefix in wanted:
+                current[wanted[prefix]] = value
+        elif prefix == 'obj.item.clientStats.item' and event == 'start_map':
+            current = {}
+        elif prefix == 'success' and event == 'boolean':
+            success = value
+    return success, client_stats
+
 class XuiAPIClient:
     """
     یک کلاینت API قوی و بازنویسی شده برای پنل‌های 3X-UI
     که بر اساس مستندات رسمی Postman ساخته شده است.
     """
-    def __init__(self, panel_url, username, password):
+    def __init__(self, panel_url, username, password, pool_maxsize=10, connect_timeout=None, read_timeout=None):
         self.base_url = panel_url.rstrip('/')
         self.username = username
         self.password = password
         self.session = requests.Session()
         self.session.headers.update({'Accept': 'application/json'})
+        # اتصالات keep-alive به پنل بین درخواست‌ها (و نخ‌ها) دوباره استفاده می‌شوند
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
         self.is_logged_in = False
+        # RLock چون login خودش از _request استفاده می‌کند
+        self._login_lock = threading.RLock()
+        self.timeout = (connect_timeout or API_CONNECT_TIMEOUT_SECONDS, read_timeout or API_READ_TIMEOUT_SECONDS)
+        # وقتی پنل از دسترس خارج است، درخواست‌ها به جای انتظار برای timeout فوراً رد می‌شوند
+        self.circuit_breaker = CircuitBreaker(self.base_url, CIRCUIT_BREAKER_FAILURE_THRESHOLD, CIRCUIT_BREAKER_RECOVERY_SECONDS)
         logger.info(f"XuiAPIClient initialized for {self.base_url}")
 
-    def _request(self, method, path, **kwargs):
-        """یک متد مرکزی و قوی برای ارسال تمام درخواست‌ها."""
+    def _send(self, method, path, idempotent=None, **kwargs):
+        """
+        درخواست را (با لاگین خودکار و تلاش مجدد پس از 401/403) ارسال کرده و شیء Response را برمی‌گرداند.
+        در صورت خطا None برمی‌گرداند.
+        درخواست‌های idempotent (به طور پیش‌فرض GET) پس از خطای شبکه یا 5xx حداکثر MAX_API_RETRIES بار
+        با backoff نمایی تصادفی تکرار می‌شوند. اگر circuit breaker پنل باز باشد، بلافاصله None برمی‌گردد.
+        """
         if not path.startswith('/'):
             path = '/' + path
-        
+        if idempotent is None:
+            idempotent = method.upper() in _IDEMPOTENT_METHODS
+        max_attempts = 1 + (MAX_API_RETRIES if idempotent else 0)
+
         # اگر لاگین نکرده بودیم (به جز برای خود api لاگین)، ابتدا لاگین کن
         if not self.is_logged_in and path != '/login':
-            if not self.login():
-                return None # اگر لاگین ناموفق بود، درخواست را ادامه نده
+            with self._login_lock:
+                # ممکن است نخ دیگری در این فاصله لاگین کرده باشد
+                if not self.is_logged_in and not self.login():
+                    return None # اگر لاگین ناموفق بود، درخواست را ادامه نده
 
         url = self.base_url + path
-        try:
-            response = self.session.request(method, url, verify=False, timeout=20, **kwargs)
+        for attempt in range(1, max_attempts + 1):
+            if not self.circuit_breaker.allow_request():
+                logger.warning(f"Circuit open for {self.base_url}; failing fast on {path}.")
+                return None
+            try:
+                response = self.session.request(method, url, verify=False, timeout=self.timeout, **kwargs)
+
+                # اگر با خطای عدم دسترسی مواجه شدیم، یک بار دیگر برای لاگین تلاش می‌کنیم
+                if response.status_code in [401, 403] and path != '/login':
+                    logger.warning("Authentication error (401/403). Attempting to re-login...")
+                    response.close()
+                    # پنل پاسخ داده است؛ مدار پیش از لاگین بسته می‌شود تا درخواست login (در حالت half_open)
+                    # پشت همین درخواست آزمایشی رد نشود
+                    self.circuit_breaker.record_success()
+                    if not self.login():
+                        return None
+                    # درخواست اصلی را دوباره تکرار کن
+                    response = self.session.request(method, url, verify=False, timeout=self.timeout, **kwargs)
+
+                if response.status_code >= 500:
+                    response.close()
+                    raise _RetryableResponse(response)
+                # پنل پاسخ داده است؛ خطاهای 4xx نشانه از کار افتادن پنل نیستند
+                self.circuit_breaker.record_success()
+                response.raise_for_status()
+                return response
 
-            # اگر با خطای عدم دسترسی مواجه شدیم، یک بار دیگر برای لاگین تلاش می‌کنیم
-            if response.status_code in [401, 403]:
-                logger.warning("Authentication error (401/403). Attempting to re-login...")
-                if not self.login():
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, _RetryableResponse) as e:
+                self.circuit_breaker.record_failure()
+                if attempt >= max_attempts:
+                    logger.error(f"Request failed for {path} after {attempt} attempt(s): {e}")
                     return None
-                # درخواست اصلی را دوباره تکرار کن
-                response = self.session.request(method, url, verify=False, timeout=20, **kwargs)
+                delay = random.uniform(0, min(API_RETRY_BACKOFF_MAX_SECONDS, API_RETRY_BACKOFF_BASE_SECONDS * (2 ** (attempt - 1))))
+                logger.warning(f"Request to {path} failed ({e}); retrying in {delay:.2f}s ({attempt}/{max_attempts - 1})...")
+                time.sleep(delay)
 
-            response.raise_for_status() # بررسی خطاهای HTTP مثل 500
+            except requests.exceptions.RequestException as e:
+                logger.error(f"Request failed for {path}: {e}")
+                return None
 
+    def _request(self, method, path, idempotent=None, **kwargs):
+        """یک متد مرکزی و قوی برای ارسال تمام درخواست‌ها؛ بدنه JSON پاسخ را برمی‌گرداند."""
+        response = self._send(method, path, idempotent=idempotent, **kwargs)
+        if response is None:
+            return None
+        try:
             # مدیریت پاسخ‌های خالی که باعث کرش می‌شدند
             if not response.text:
                 logger.warning(f"Received empty response from {path}")
@@ -64,25 +193,39 @@ class XuiAPIClient:
 
     def login(self):
         """لاگین به پنل و ذخیره کوکی نشست (session)."""
+        with self._login_lock:
+            self.is_logged_in = False
+            payload = {'username': self.username, 'password': self.password}
+            # لاگین تکرارپذیر است و پس از خطای شبکه می‌توان دوباره آن را ارسال کرد
+            response_data = self._request('post', '/login', idempotent=True, data=payload)
+            
+            if response_data and response_data.get('success'):
+                logger.info(f"Successfully logged in to {self.base_url}")
+                self.is_logged_in = True
+                return True
+            else:
+                msg = response_data.get('msg', 'Unknown login error') if response_data else "No response from server"
+                logger.error(f"Login failed for {self.base_url}: {msg}")
+                return False
+
+    def close(self):
+        """نشست HTTP و اتصالات keep-alive آن را می‌بندد."""
+        self.session.close()
         self.is_logged_in = False
-        payload = {'username': self.username, 'password': self.password}
-        response_data = self._request('post', '/login', data=payload)
-        
-        if response_data and response_data.get('success'):
-            logger.info(f"Successfully logged in to {self.base_url}")
-            self.is_logged_in = True
-            return True
-        else:
-            msg = response_data.get('msg', 'Unknown login error') if response_data else "No response from server"
-            logger.error(f"Login failed for {self.base_url}: {msg}")
-            return False
 
-    def list_inbounds(self):
+    def list_inbounds(self, fields=None):
         """
         لیست تمام اینباندها را با جزئیات کامل برمی‌گرداند.
         مسیر API بر اساس مستندات: /panel/api/inbounds/list
+
+        اگر fields داده شود (مثلاً INBOUND_SUMMARY_FIELDS)، پاسخ به صورت جریانی پارس شده
+        و برای هر اینباند فقط همین فیلدها نگه داشته می‌شود؛ بنابراین لیست کلاینت‌ها
+        (settings و clientStats) هرگز به طور کامل در حافظه ساخته نمی‌شود.
         """
         logger.info("Attempting to get inbound list...")
+        if fields is not None:
+            return self._list_inbounds_projected(tuple(fields))
+
         # متد درخواست GET است، نه POST
         response_data = self._request('get', '/panel/api/inbounds/list')
         
@@ -92,10 +235,59 @@ class XuiAPIClient:
         logger.warning(f"Could not get inbounds. Response: {response_data}")
         return []
 
-    def add_client(self, inbound_id, client_settings_json):
+    def _list_inbounds_projected(self, fields):
+        if ijson is None:
+            # بدون ijson، پاسخ کامل پارس شده و سپس خلاصه می‌شود
+            return [{k: inbound.get(k) for k in fields if k in inbound} for inbound in self.list_inbounds()]
+
+        response = self._send('get', '/panel/api/inbounds/list', stream=True)
+        if response is None:
+            return []
+        try:
+            response.raw.decode_content = True
+            success, inbounds = _parse_inbound_stream(response.raw, fields)
+        except (ijson.JSONError, requests.exceptions.RequestException, OSError) as e:
+            logger.error(f"Failed to stream-parse inbound list from {self.base_url}: {e}")
+            return []
+        finally:
+            response.close()
+
+        if success:
+            return inbounds
+        logger.warning(f"Could not get inbounds from {self.base_url} (success=false).")
+        return []
+
+    def list_client_traffics(self, transform=None):
+        """
+        آمار ترافیک تمام کلاینت‌های پنل را با یک درخواست برمی‌گرداند (لیست دیکشنری‌هایی با CLIENT_TRAFFIC_FIELDS،
+        یا خروجی transform برای هر کدام). در صورت خطا None برمی‌گرداند تا با «پنل بدون کلاینت» اشتباه گرفته نشود.
+        """
+        if ijson is None:
+            response_data = self._request('get', '/panel/api/inbounds/list')
+            if not (response_data and response_data.get('success')):
+                return None
+            client_stats = ({k: stat.get(k) for k in CLIENT_TRAFFIC_FIELDS}
+                            for inbound in response_data.get('obj') or [] for stat in inbound.get('clientStats') or [])
+            return [transform(stat) if transform else stat for stat in client_stats]
+
+        response = self._send('get', '/panel/api/inbounds/list', stream=True)
+        if response is None:
+            return None
+        try:
+            response.raw.decode_content = True
+            success, client_stats = _parse_client_stats_stream(response.raw, transform)
+        except (ijson.JSONError, requests.exceptions.RequestException, OSError) as e:
+            logger.error(f"Failed to stream-parse client traffics from {self.base_url}: {e}")
+            return None
+        finally:
+            response.close()
+        return client_stats if success else None
+
+    def add_client(self, inbound_id, client_settings_json, existing_ok=False):
         """
         یک کلاینت جدید به یک اینباند مشخص اضافه می‌کند.
         مسیر API بر اساس مستندات: /panel/api/inbounds/addClient
+        با existing_ok پاسخ «Duplicate email» پنل (کلاینت قبلاً با همین ایمیل ساخته شده) موفق حساب می‌شود.
         """
         logger.info(f"Adding client to inbound {inbound_id}...")
         payload = {
@@ -108,6 +300,44 @@ class XuiAPIClient:
         if response_data and response_data.get('success'):
             logger.info("Client added successfully.")
             return True
+        if existing_ok and response_data and 'duplicate email' in str(response_data.get('msg', '')).lower():
+            logger.info(f"Client already exists on inbound {inbound_id}; treating as added.")
+            return True
         
         logger.error(f"Failed to add client. Response: {response_data}")
-        return False
\ No newline at end of file
+        return False
+
+    def add_clients(self, inbound_id, clients: list, existing_ok=False):
+        """
+        چند کلاینت را با یک درخواست به یک اینباند اضافه می‌کند (endpoint addClient لیست کلاینت‌ها را می‌پذیرد).
+        clients لیستی از دیکشنری‌های تنظیمات کلاینت است.
+        """
+        logger.info(f"Adding {len(clients)} client(s) to inbound {inbound_id} in one request...")
+        return self.add_client(inbound_id, json.dumps({"clients": clients}), existing_ok)
+
+    def update_client(self, inbound_id, client_id, client_settings: dict):
+        """
+        تنظیمات (حجم، تاریخ انقضا و ...) یک کلاینت موجود را به‌روز می‌کند.
+        مسیر API: /panel/api/inbounds/updateClient/{client_id}
+        """
+        payload = {"id": inbound_id, "settings": json.dumps({"clients": [client_settings]})}
+        response_data = self._request('post', f'/panel/api/inbounds/updateClient/{client_id}', json=payload)
+        if response_data and response_data.get('success'):
+            return True
+        logger.error(f"Failed to update client {client_id} on inbound {inbound_id}. Response: {response_data}")
+        return False
+
+    def delete_client(self, inbound_id, client_id):
+        """
+        یک کلاینت را از اینباند حذف می‌کند (client_id برای vless/vmess همان uuid است).
+        مسیر API: /panel/api/inbounds/{inbound_id}/delClient/{client_id}
+        خروجی: True در صورت موفقیت، False اگر پنل درخواست را رد کرد (مثلاً کلاینت وجود ندارد)
+        و None اگر پاسخی از پنل دریافت نشد.
+        """
+        response_data = self._request('post', f'/panel/api/inbounds/{inbound_id}/delClient/{client_id}')
+        if response_data is None:
+            return None
+        if response_data.get('success'):
+            return True
+        logger.warning(f"Panel refused to delete client {client_id} from inbound {inbound_id}: {response_data.get('msg')}")
+        return False
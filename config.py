@@ -21,6 +21,53 @@ DB_PASSWORD = os.getenv("DB_PASSWORD")
 DB_HOST = os.getenv("DB_HOST", "localhost")
 DB_PORT = os.getenv("DB_PORT", "5432")
 
+# --- Connection Pool Settings ---
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_MAX_IDLE_SECONDS = int(os.getenv("DB_POOL_MAX_IDLE_SECONDS", "300"))
+DB_POOL_MAX_LIFETIME_SECONDS = int(os.getenv("DB_POOL_MAX_LIFETIME_SECONDS", "3600"))
+DB_POOL_HEALTH_CHECK_SECONDS = int(os.getenv("DB_POOL_HEALTH_CHECK_SECONDS", "30"))
+DB_POOL_TIMEOUT_SECONDS = float(os.getenv("DB_POOL_TIMEOUT_SECONDS", "10"))
+
+# --- Cache Settings ---
+# حداکثر عمر کش سرورها و درگاه‌های رمزگشایی شده (برای همگام ماندن بین پروسه‌ها)؛ در همه کش‌ها مقدار 0 یعنی بدون کش
+RECORD_CACHE_TTL_SECONDS = int(os.getenv("RECORD_CACHE_TTL_SECONDS", "60"))
+USER_CACHE_TTL_SECONDS = int(os.getenv("USER_CACHE_TTL_SECONDS", "600"))
+# بازه ذخیره دسته‌ای last_activity کاربران؛ مقدار 0 یعنی نوشتن مستقیم در هر /start
+USER_ACTIVITY_FLUSH_SECONDS = float(os.getenv("USER_ACTIVITY_FLUSH_SECONDS", "15"))
+# کش بدنه لینک‌های سابسکریپشن در webhook_server؛ با NOTIFY دیتابیس باطل می‌شود و TTL فقط پشتیبان است
+SUBSCRIPTION_CACHE_MAX_ENTRIES = int(os.getenv("SUBSCRIPTION_CACHE_MAX_ENTRIES", "50000"))
+SUBSCRIPTION_CACHE_TTL_SECONDS = float(os.getenv("SUBSCRIPTION_CACHE_TTL_SECONDS", "3600"))
+# عمر کش پاسخ 404 (سابسکریپشن نامعتبر یا غیرفعال)
+SUBSCRIPTION_CACHE_NEGATIVE_TTL_SECONDS = float(os.getenv("SUBSCRIPTION_CACHE_NEGATIVE_TTL_SECONDS", "60"))
+# عمر کش مقادیر هدر subscription-userinfo (بیش از بازه USAGE_SYNC_INTERVAL_SECONDS فایده‌ای ندارد)
+SUBSCRIPTION_USAGE_CACHE_TTL_SECONDS = float(os.getenv("SUBSCRIPTION_USAGE_CACHE_TTL_SECONDS", "300"))
+# کش نتیجه بررسی عضویت در کانال اجباری؛ اگر ربات ادمین کانال باشد با update های chat_member به‌روز می‌شود
+CHANNEL_MEMBER_CACHE_MAX_ENTRIES = int(os.getenv("CHANNEL_MEMBER_CACHE_MAX_ENTRIES", "100000"))
+CHANNEL_MEMBER_CACHE_TTL_SECONDS = float(os.getenv("CHANNEL_MEMBER_CACHE_TTL_SECONDS", "3600"))
+# عمر کوتاه کش «عضو نیست» تا کاربری که تازه عضو شده (بدون update chat_member) زیاد منتظر نماند
+CHANNEL_MEMBER_CACHE_NEGATIVE_TTL_SECONDS = float(os.getenv("CHANNEL_MEMBER_CACHE_NEGATIVE_TTL_SECONDS", "20"))
+
+# --- Conversation State Store ---
+# memory: فقط همین پروسه؛ postgres: مشترک بین چند پروسه ربات و پایدار در restart
+STATE_STORE_BACKEND = os.getenv("STATE_STORE_BACKEND", "memory").lower()
+# وضعیت خرید یا فرم ادمینی که این مدت دست نخورده بماند حذف می‌شود
+STATE_TTL_SECONDS = float(os.getenv("STATE_TTL_SECONDS", "3600"))
+STATE_MAX_ENTRIES = int(os.getenv("STATE_MAX_ENTRIES", "100000"))
+# بازه حذف وضعیت‌های منقضی و مازاد از دیتابیس (فقط بک‌اند postgres)
+STATE_PURGE_INTERVAL_SECONDS = float(os.getenv("STATE_PURGE_INTERVAL_SECONDS", "300"))
+
+# --- Webhook Server (gunicorn؛ WEBHOOK_WORKERS=0 یعنی به تعداد هسته‌ها) ---
+WEBHOOK_BIND = os.getenv("WEBHOOK_BIND", "127.0.0.1:8080")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "0"))
+# هر worker یک Pool دیتابیس جداگانه با حداکثر WEBHOOK_THREADS + 1 اتصال (و نه DB_POOL_MAX_SIZE) دارد
+WEBHOOK_THREADS = int(os.getenv("WEBHOOK_THREADS", "4"))
+WEBHOOK_KEEPALIVE_SECONDS = int(os.getenv("WEBHOOK_KEEPALIVE_SECONDS", "5"))
+WEBHOOK_TIMEOUT_SECONDS = int(os.getenv("WEBHOOK_TIMEOUT_SECONDS", "60"))
+WEBHOOK_GRACEFUL_TIMEOUT_SECONDS = int(os.getenv("WEBHOOK_GRACEFUL_TIMEOUT_SECONDS", "30"))
+# پس از این تعداد درخواست worker به صورت تدریجی جایگزین می‌شود (0 = غیرفعال)
+WEBHOOK_MAX_REQUESTS = int(os.getenv("WEBHOOK_MAX_REQUESTS", "0"))
+
 # --- Other Critical Settings ---
 ENCRYPTION_KEY = os.getenv("ENCRYPTION_KEY_ALAMOR")
 WEBHOOK_DOMAIN = os.getenv("WEBHOOK_DOMAIN")
@@ -31,6 +78,23 @@ REQUIRED_CHANNEL_ID_STR = os.getenv("REQUIRED_CHANNEL_ID_ALAMOR")
 REQUIRED_CHANNEL_ID = int(REQUIRED_CHANNEL_ID_STR) if REQUIRED_CHANNEL_ID_STR and REQUIRED_CHANNEL_ID_STR.lstrip('-').isdigit() else None
 REQUIRED_CHANNEL_LINK = os.getenv("REQUIRED_CHANNEL_LINK_ALAMOR")
 
+# --- Telegram Updates (polling یا webhook؛ حالت polling همیشه به عنوان جایگزین در دسترس است) ---
+BOT_UPDATE_MODE = os.getenv("BOT_UPDATE_MODE", "polling").strip().lower()
+BOT_WEBHOOK_PATH = os.getenv("BOT_WEBHOOK_PATH", "/telegram/webhook")
+# آدرس عمومی که به تلگرام معرفی می‌شود؛ به طور پیش‌فرض روی همان دامنه پرداخت (nginx آن را به BOT_WEBHOOK_PORT می‌فرستد)
+BOT_WEBHOOK_URL = os.getenv("BOT_WEBHOOK_URL") or (f"https://{WEBHOOK_DOMAIN}{BOT_WEBHOOK_PATH}" if WEBHOOK_DOMAIN else None)
+BOT_WEBHOOK_LISTEN = os.getenv("BOT_WEBHOOK_LISTEN", "127.0.0.1")
+BOT_WEBHOOK_PORT = int(os.getenv("BOT_WEBHOOK_PORT", "8081"))
+# خالی یعنی در هر اجرا یک secret تصادفی ساخته و با setWebhook ثبت می‌شود
+BOT_WEBHOOK_SECRET = os.getenv("BOT_WEBHOOK_SECRET", "")
+BOT_WEBHOOK_MAX_CONNECTIONS = int(os.getenv("BOT_WEBHOOK_MAX_CONNECTIONS", "40"))
+# اجرای هندلرها: updateهای هر چت به ترتیب روی یک worker و چت‌های مختلف به صورت موازی (در هر دو حالت)
+BOT_UPDATE_WORKERS = int(os.getenv("BOT_UPDATE_WORKERS", "16"))
+# ظرفیت صف هر worker؛ در webhook با پر شدن صف 503 برمی‌گردد و در polling دریافت update کند می‌شود
+BOT_UPDATE_QUEUE_SIZE = int(os.getenv("BOT_UPDATE_QUEUE_SIZE", "200"))
+# آدرس پایه Bot API (برای تست با یک Bot API محلی/جعلی؛ خالی یعنی api.telegram.org)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "").rstrip('/')
+
 
 def get_bool_env(var_name, default=False):
     """یک مقدار بولی را از متغیرهای محیطی می‌خواند."""
@@ -46,5 +110,83 @@ ENABLE_GIGABYTE_PLANS = get_bool_env("ENABLE_GIGABYTE_PLANS", True)
 # --- Zarinpal Settings (تنظیمات درگاه زرین‌پال) ---
 ZARINPAL_SANDBOX = get_bool_env("ZARINPAL_SANDBOX", True) # برای تست روی True و برای استفاده واقعی روی False تنظیم شود
 ZARINPAL_MERCHANT_ID = os.getenv("ZARINPAL_MERCHANT_ID")
+ZARINPAL_VERIFY_URL = os.getenv("ZARINPAL_VERIFY_URL", "https://api.zarinpal.com/pg/v4/payment/verify.json")
+ZARINPAL_VERIFY_TIMEOUT_SECONDS = float(os.getenv("ZARINPAL_VERIFY_TIMEOUT_SECONDS", "20"))
+# claim بررسی پرداختی که بیش از این مدت در وضعیت verifying مانده (پروسه از کار افتاده) دوباره قابل برداشت است
+ZARINPAL_VERIFY_CLAIM_TIMEOUT_SECONDS = float(os.getenv("ZARINPAL_VERIFY_CLAIM_TIMEOUT_SECONDS", "60"))
+
+# --- Panel API Client (تلاش مجدد، timeout و circuit breaker) ---
+# تعداد تلاش‌های مجدد برای درخواست‌های idempotent (مثل GET) پس از خطای شبکه یا 5xx
+MAX_API_RETRIES = int(os.getenv("MAX_API_RETRIES_ALAMOR", "3"))
+API_RETRY_BACKOFF_BASE_SECONDS = float(os.getenv("API_RETRY_BACKOFF_BASE_SECONDS", "0.5"))
+API_RETRY_BACKOFF_MAX_SECONDS = float(os.getenv("API_RETRY_BACKOFF_MAX_SECONDS", "5"))
+# مقادیر پیش‌فرض؛ برای هر سرور از ستون‌های api_connect_timeout / api_read_timeout قابل تغییر است
+API_CONNECT_TIMEOUT_SECONDS = float(os.getenv("API_CONNECT_TIMEOUT_SECONDS", "3"))
+API_READ_TIMEOUT_SECONDS = float(os.getenv("API_READ_TIMEOUT_SECONDS", "15"))
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_BREAKER_FAILURE_THRESHOLD", "5"))
+CIRCUIT_BREAKER_RECOVERY_SECONDS = float(os.getenv("CIRCUIT_BREAKER_RECOVERY_SECONDS", "30"))
+
+# --- Provisioning Settings (ساخت همزمان کلاینت روی چند سرور) ---
+PROVISION_MAX_WORKERS = int(os.getenv("PROVISION_MAX_WORKERS", "8"))
+PROVISION_PER_SERVER_CONCURRENCY = int(os.getenv("PROVISION_PER_SERVER_CONCURRENCY", "4"))
+PROVISION_DEADLINE_SECONDS = float(os.getenv("PROVISION_DEADLINE_SECONDS", "60"))
+# عمر snapshot ذخیره شده اینباندها؛ پس از آن لیست اینباندها دوباره از پنل گرفته می‌شود (0 = غیرفعال)
+INBOUND_SNAPSHOT_TTL_SECONDS = int(os.getenv("INBOUND_SNAPSHOT_TTL_SECONDS", "3600"))
+
+# --- Server Health Checker (بررسی دوره‌ای سلامت پنل‌ها؛ 0 یعنی غیرفعال) ---
+SERVER_HEALTH_CHECK_INTERVAL = float(os.getenv("SERVER_HEALTH_CHECK_INTERVAL", "120"))
+SERVER_HEALTH_FAILURE_THRESHOLD = int(os.getenv("SERVER_HEALTH_FAILURE_THRESHOLD", "2"))
+SERVER_HEALTH_MAX_WORKERS = int(os.getenv("SERVER_HEALTH_MAX_WORKERS", "16"))
+
+# --- Usage Sync (همگام‌سازی دوره‌ای مصرف ترافیک کلاینت‌ها از پنل‌ها؛ 0 یعنی غیرفعال) ---
+USAGE_SYNC_INTERVAL_SECONDS = float(os.getenv("USAGE_SYNC_INTERVAL_SECONDS", "300"))
+USAGE_SYNC_MAX_WORKERS = int(os.getenv("USAGE_SYNC_MAX_WORKERS", "8"))
+
+# --- Expired Client Sweeper (حذف کلاینت‌های منقضی از پنل‌ها؛ 0 یعنی غیرفعال) ---
+CLIENT_GC_INTERVAL_SECONDS = float(os.getenv("CLIENT_GC_INTERVAL_SECONDS", "3600"))
+# مهلت پس از انقضا (برای تمدید) قبل از حذف کلاینت
+CLIENT_GC_GRACE_HOURS = float(os.getenv("CLIENT_GC_GRACE_HOURS", "72"))
+CLIENT_GC_BATCH_SIZE = int(os.getenv("CLIENT_GC_BATCH_SIZE", "200"))
+CLIENT_GC_PANEL_RATE_PER_SECOND = float(os.getenv("CLIENT_GC_PANEL_RATE_PER_SECOND", "5"))
+CLIENT_GC_MAX_WORKERS = int(os.getenv("CLIENT_GC_MAX_WORKERS", "4"))
+
+# --- Drift Reconciler (مقایسه خریدها با کلاینت‌های پنل؛ 0 یعنی فقط اجرای دستی از پنل ادمین) ---
+RECONCILE_INTERVAL_SECONDS = float(os.getenv("RECONCILE_INTERVAL_SECONDS", "0"))
+RECONCILE_AUTO_FIX = get_bool_env("RECONCILE_AUTO_FIX", False)
+# اختلاف مجاز تاریخ انقضا (اختلاف منطقه زمانی سرور و دیتابیس را پوشش می‌دهد)
+RECONCILE_EXPIRY_TOLERANCE_SECONDS = int(os.getenv("RECONCILE_EXPIRY_TOLERANCE_SECONDS", "86400"))
+RECONCILE_REPORT_SAMPLE_SIZE = int(os.getenv("RECONCILE_REPORT_SAMPLE_SIZE", "10"))
+
+# --- Provisioning Job Queue (صف پایدار ساخت سرویس پس از تایید پرداخت) ---
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_POLL_INTERVAL_SECONDS = float(os.getenv("JOB_POLL_INTERVAL_SECONDS", "2"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+JOB_RETRY_BASE_SECONDS = float(os.getenv("JOB_RETRY_BASE_SECONDS", "15"))
+JOB_RETRY_MAX_SECONDS = float(os.getenv("JOB_RETRY_MAX_SECONDS", "900"))
+# کار running که worker آن بیش از این مدت پاسخی نداده، دوباره قابل برداشت است (باید از PROVISION_DEADLINE_SECONDS بیشتر باشد)
+JOB_LOCK_TIMEOUT_SECONDS = float(os.getenv("JOB_LOCK_TIMEOUT_SECONDS", "300"))
+
+# --- Outbound Messages (محدودیت نرخ ارسال به تلگرام: حدود 30 پیام در ثانیه کل و 1 پیام در ثانیه برای هر چت) ---
+# محدودیت برای هر پروسه ربات است؛ اگر چند پروسه با یک توکن اجرا می‌شوند OUTBOUND_GLOBAL_RATE را بین آن‌ها تقسیم کنید
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "25"))
+OUTBOUND_GLOBAL_BURST = int(os.getenv("OUTBOUND_GLOBAL_BURST", "25"))
+OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE", "1"))
+OUTBOUND_CHAT_BURST = int(os.getenv("OUTBOUND_CHAT_BURST", "3"))
+# سهمی از ظرفیت کل که ارسال‌های انبوه (outbox) به آن دست نمی‌زنند تا ویرایش‌های تعاملی منتظر نمانند
+OUTBOUND_INTERACTIVE_RESERVE = int(os.getenv("OUTBOUND_INTERACTIVE_RESERVE", "5"))
+# ارسال مستقیم پس از خطای 429 حداکثر این تعداد بار و فقط اگر retry_after از این مقدار کمتر باشد تکرار می‌شود
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", "3"))
+OUTBOUND_MAX_RETRY_WAIT_SECONDS = float(os.getenv("OUTBOUND_MAX_RETRY_WAIT_SECONDS", "30"))
+# صف پایدار پیام‌ها (outbound_messages) که وب‌سرور و ربات در آن می‌نویسند و ربات ارسال می‌کند
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "50"))
+OUTBOX_POLL_INTERVAL_SECONDS = float(os.getenv("OUTBOX_POLL_INTERVAL_SECONDS", "5"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+OUTBOX_LOCK_TIMEOUT_SECONDS = float(os.getenv("OUTBOX_LOCK_TIMEOUT_SECONDS", "120"))
 
-MAX_API_RETRIES = 3
\ No newline at end of file
+# --- Broadcast (ارسال همگانی ادمین؛ سرعت نهایی را محدودکننده نرخ بالا تعیین می‌کند) ---
+BROADCAST_SENDERS = int(os.getenv("BROADCAST_SENDERS", "8"))
+# پیشرفت پس از هر دسته ذخیره می‌شود؛ پس از restart حداکثر یک دسته دوباره ارسال می‌شود
+BROADCAST_CHUNK_SIZE = int(os.getenv("BROADCAST_CHUNK_SIZE", "100"))
+BROADCAST_PROGRESS_INTERVAL_SECONDS = float(os.getenv("BROADCAST_PROGRESS_INTERVAL_SECONDS", "5"))
+# ارسالی که heartbeat آن بیش از این مدت تمدید نشده (پروسه از کار افتاده) توسط پروسه دیگری ادامه می‌یابد
+BROADCAST_LOCK_TIMEOUT_SECONDS = float(os.getenv("BROADCAST_LOCK_TIMEOUT_SECONDS", "120"))
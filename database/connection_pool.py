@@ -0,0 +1,235 @@
+# database/connection_pool.py
+
+import psycopg2
+from psycopg2 import extensions
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeoutError(psycopg2.OperationalError):
+    """وقتی در زمان مقرر هیچ اتصال آزادی در Pool پیدا نشود، رخ می‌دهد."""
+
+
+class _PooledConnection:
+    """یک اتصال خام به همراه زمان ساخت و آخرین استفاده."""
+    __slots__ = ('conn', 'created_at', 'last_used')
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+
+
+class ConnectionPool:
+    """
+    یک Pool ساده و thread-safe برای اتصالات PostgreSQL.
+    اتصالات بیکار بازیافت می‌شوند، قبل از تحویل سلامت‌شان بررسی می‌شود
+    و آمار استفاده از طریق stats() در دسترس است.
+    """
+    def __init__(self, min_size, max_size, max_idle_seconds=300, max_lifetime_seconds=3600,
+                 health_check_after_seconds=30, checkout_timeout=10, reap_interval_seconds=60,
+                 **connect_kwargs):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError(f"Invalid pool size: min={min_size}, max={max_size}")
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_idle_seconds = max_idle_seconds
+        self.max_lifetime_seconds = max_lifetime_seconds
+        self.health_check_after_seconds = health_check_after_seconds
+        self.checkout_timeout = checkout_timeout
+        self._connect_kwargs = connect_kwargs
+
+        self._idle = []          # اتصالات آزاد (LIFO تا اتصالات گرم دوباره استفاده شوند)
+        self._in_use = 0
+        self._lock = threading.Condition()
+        self._closed = False
+        self._stats = {
+            'created': 0, 'closed': 0, 'checkouts': 0, 'waits': 0,
+            'timeouts': 0, 'health_check_failures': 0, 'recycled': 0,
+        }
+
+        for _ in range(min_size):
+            self._idle.append(self._create())
+
+        # نخ پس‌زمینه برای بستن اتصالات بیکار قدیمی
+        if reap_interval_seconds and (max_idle_seconds or max_lifetime_seconds):
+            self._reaper = threading.Thread(target=self._reap_loop, args=(reap_interval_seconds,),
+                                            name="db-pool-reaper", daemon=True)
+            self._reaper.start()
+
+    # --- مدیریت اتصالات خام ---
+    def _bump(self, key):
+        # قفل Condition از نوع RLock است، پس فراخوانی از داخل بخش قفل‌شده هم امن است
+        with self._lock:
+            self._stats[key] += 1
+
+    def _create(self):
+        conn = psycopg2.connect(**self._connect_kwargs)
+        self._bump('created')
+        return _PooledConnection(conn)
+
+    def _discard(self, pooled):
+        try:
+            if not pooled.conn.closed:
+                pooled.conn.close()
+        except Exception as e:
+            logger.warning(f"Error closing pooled connection: {e}")
+        self._bump('closed')
+
+    def _is_expired(self, pooled, now):
+        if self.max_idle_seconds and now - pooled.last_used > self.max_idle_seconds:
+            return True
+        if self.max_lifetime_seconds and now - pooled.created_at > self.max_lifetime_seconds:
+            return True
+        return False
+
+    def _is_healthy(self, pooled, now):
+        conn = pooled.conn
+        if conn.closed:
+            return False
+        if now - pooled.last_used < self.health_check_after_seconds:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    # --- API اصلی ---
+    def getconn(self):
+        """یک اتصال سالم از Pool برمی‌دارد یا در صورت نیاز اتصال جدید می‌سازد."""
+        deadline = time.monotonic() + self.checkout_timeout
+        with self._lock:
+            while True:
+                if self._closed:
+                    raise psycopg2.InterfaceError("Connection pool is closed")
+                if self._idle:
+                    pooled = self._idle.pop()
+                    self._in_use += 1
+                    break
+                if self._in_use < self.max_size:
+                    self._in_use += 1
+                    pooled = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolTimeoutError(f"No free database connection within {self.checkout_timeout}s")
+                self._stats['waits'] += 1
+                self._lock.wait(remaining)
+            self._stats['checkouts'] += 1
+
+        # ساخت یا بررسی سلامت خارج از قفل انجام می‌شود تا بقیه نخ‌ها معطل نمانند
+        try:
+            now = time.monotonic()
+            if pooled is not None and self._is_expired(pooled, now):
+                self._discard(pooled)
+                self._bump('recycled')
+                pooled = None
+            if pooled is not None and not self._is_healthy(pooled, now):
+                logger.warning("Discarding unhealthy pooled database connection.")
+                self._bump('health_check_failures')
+                self._discard(pooled)
+                pooled = None
+            if pooled is None:
+                pooled = self._create()
+        except Exception:
+            with self._lock:
+                self._in_use -= 1
+                self._lock.notify()
+            raise
+        return pooled
+
+    def putconn(self, pooled, discard=False):
+        """اتصال را به Pool برمی‌گرداند؛ اتصالات خراب یا در تراکنش باز دور انداخته می‌شوند."""
+        conn = pooled.conn
+        if not discard and not conn.closed:
+            try:
+                if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                discard = True
+        if conn.closed:
+            discard = True
+
+        with self._lock:
+            self._in_use -= 1
+            if discard or self._closed:
+                self._discard(pooled)
+            else:
+                pooled.last_used = time.monotonic()
+                self._idle.append(pooled)
+            self._lock.notify()
+
+    @contextmanager
+    def connection(self):
+        """
+        مانند `with psycopg2.connect() as conn` رفتار می‌کند: در صورت موفقیت commit
+        و در صورت خطا rollback می‌کند، سپس اتصال را به Pool برمی‌گرداند.
+        """
+        pooled = self.getconn()
+        discard = False
+        try:
+            yield pooled.conn
+            if not pooled.conn.closed:
+                pooled.conn.commit()
+        except BaseException as e:
+            discard = isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError))
+            try:
+                if not pooled.conn.closed:
+                    pooled.conn.rollback()
+            except psycopg2.Error:
+                discard = True
+            raise
+        finally:
+            self.putconn(pooled, discard=discard)
+
+    def prune_idle(self):
+        """اتصالات بیکار منقضی شده را می‌بندد ولی حداقل min_size اتصال را نگه می‌دارد."""
+        now = time.monotonic()
+        with self._lock:
+            keep, expired = [], []
+            # قدیمی‌ترین اتصالات در ابتدای لیست هستند
+            for pooled in self._idle:
+                if self._is_expired(pooled, now) and len(self._idle) - len(expired) > self.min_size:
+                    expired.append(pooled)
+                else:
+                    keep.append(pooled)
+            self._idle = keep
+            for pooled in expired:
+                self._discard(pooled)
+                self._stats['recycled'] += 1
+        return len(expired)
+
+    def _reap_loop(self, interval):
+        while not self._closed:
+            time.sleep(interval)
+            try:
+                pruned = self.prune_idle()
+                if pruned:
+                    logger.info(f"Recycled {pruned} idle database connection(s).")
+            except Exception as e:
+                logger.error(f"Error while pruning idle database connections: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                **self._stats,
+                'min_size': self.min_size, 'max_size': self.max_size,
+                'idle': len(self._idle), 'in_use': self._in_use,
+            }
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            for pooled in self._idle:
+                self._discard(pooled)
+            self._idle = []
+            self._lock.notify_all()
+        logger.info("Database connection pool closed.")
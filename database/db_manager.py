@@ -1,31 +1,106 @@
 import psycopg2
+from psycopg2.sql import SQL, Identifier
 from psycopg2.extras import DictCursor, execute_values
 import logging
+import select
 from cryptography.fernet import Fernet
 import os
 import json
 
 # وارد کردن متغیرهای جدید از کانفیگ
-from config import (ENCRYPTION_KEY, DB_NAME, DB_USER, DB_PASSWORD, DB_HOST, DB_PORT)
+from config import (ENCRYPTION_KEY, DB_NAME, DB_USER, DB_PASSWORD, DB_HOST, DB_PORT,
+                    DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_MAX_IDLE_SECONDS,
+                    DB_POOL_MAX_LIFETIME_SECONDS, DB_POOL_HEALTH_CHECK_SECONDS, DB_POOL_TIMEOUT_SECONDS)
+from database.connection_pool import ConnectionPool
+from database import migrations
+from config import RECORD_CACHE_TTL_SECONDS, USER_CACHE_TTL_SECONDS, USER_ACTIVITY_FLUSH_SECONDS
+from database.user_activity import UserActivityBuffer
+from utils.cache import TTLCache
 
 logger = logging.getLogger(__name__)
 
+# کلید قفل advisory برای پشت سر هم انجام شدن برداشتن پیام‌های صف (حفظ ترتیب پیام‌های هر چت بین چند relay)
+OUTBOX_CLAIM_LOCK_KEY = 724_911_002
+# پارامترهای keepalive اتصال LISTEN: پس از حدود یک دقیقه بی‌پاسخی سوکت، اتصال خطا می‌دهد
+LISTEN_KEEPALIVE_OPTIONS = {'keepalives': 1, 'keepalives_idle': 30, 'keepalives_interval': 10, 'keepalives_count': 3}
+
 class DatabaseManager:
-    def __init__(self):
+    def __init__(self, pool_max_size: int = None):
+        # pool_max_size سقف Pool همین پروسه است (مثلاً برای workerهای وب‌سرور)؛ پیش‌فرض DB_POOL_MAX_SIZE
+        pool_max_size = pool_max_size or DB_POOL_MAX_SIZE
+        pool_min_size = min(DB_POOL_MIN_SIZE, pool_max_size)
         self.db_name = DB_NAME
         self.db_user = DB_USER
         self.db_password = DB_PASSWORD
         self.db_host = DB_HOST
         self.db_port = DB_PORT
         self.fernet = Fernet(ENCRYPTION_KEY.encode('utf-8'))
-        logger.info(f"DatabaseManager initialized for PostgreSQL DB: {self.db_name}")
-
-    def _get_connection(self):
-        """یک اتصال جدید به پایگاه داده PostgreSQL برقرار می‌کند."""
-        return psycopg2.connect(
+        self.pool = ConnectionPool(
+            min_size=pool_min_size, max_size=pool_max_size,
+            max_idle_seconds=DB_POOL_MAX_IDLE_SECONDS, max_lifetime_seconds=DB_POOL_MAX_LIFETIME_SECONDS,
+            health_check_after_seconds=DB_POOL_HEALTH_CHECK_SECONDS, checkout_timeout=DB_POOL_TIMEOUT_SECONDS,
             dbname=self.db_name, user=self.db_user, password=self.db_password,
             host=self.db_host, port=self.db_port
         )
+        # کش رکوردهای رمزگشایی شده سرورها و درگاه‌ها (کلید: id)
+        self._record_cache = TTLCache(ttl_seconds=RECORD_CACHE_TTL_SECONDS)
+        # کش هویت کاربران: telegram_id -> ردیف جدول users
+        self._user_cache = TTLCache(ttl_seconds=USER_CACHE_TTL_SECONDS, max_size=100_000)
+        # بافر write-behind برای last_activity (اگر بازه صفر باشد، نوشتن همزمان انجام می‌شود)
+        self._activity_buffer = UserActivityBuffer(self, USER_ACTIVITY_FLUSH_SECONDS) if USER_ACTIVITY_FLUSH_SECONDS > 0 else None
+        logger.info(f"DatabaseManager initialized for PostgreSQL DB: {self.db_name} (pool {pool_min_size}-{pool_max_size})")
+
+    def _get_connection(self):
+        """
+        یک اتصال از Pool برمی‌دارد. باید با `with` استفاده شود تا اتصال
+        پس از پایان کار (همراه با commit یا rollback) به Pool برگردد.
+        """
+        return self.pool.connection()
+
+    def get_pool_stats(self):
+        """آمار Pool اتصالات دیتابیس را برمی‌گرداند."""
+        return self.pool.stats()
+
+    def close(self):
+        """بافر فعالیت کاربران را flush کرده و تمام اتصالات Pool را می‌بندد (هنگام خاموش شدن برنامه)."""
+        if self._activity_buffer:
+            self._activity_buffer.close()
+        self.pool.close()
+
+    def listen_for_notifications(self, channel: str, on_notify, stop_event, on_connect=None, poll_seconds: float = 5):
+        """
+        با یک اتصال اختصاصی (خارج از Pool) روی channel گوش می‌دهد و payload هر NOTIFY را به on_notify می‌دهد تا
+        stop_event تنظیم شود. پس از قطع اتصال دوباره وصل می‌شود؛ on_connect پس از هر اتصال صدا زده می‌شود
+        چون اعلان‌های زمان قطعی از دست رفته‌اند.
+        """
+        while not stop_event.is_set():
+            conn = None
+            try:
+                # keepalive TCP تا اتصال نیمه‌باز (قطع شبکه بدون FIN) تشخیص داده شود و دوباره وصل شویم
+                conn = psycopg2.connect(dbname=self.db_name, user=self.db_user, password=self.db_password,
+                                        host=self.db_host, port=self.db_port, **LISTEN_KEEPALIVE_OPTIONS)
+                conn.autocommit = True
+                with conn.cursor() as cursor:
+                    cursor.execute(SQL("LISTEN {}").format(Identifier(channel)))
+                if on_connect:
+                    on_connect()
+                while not stop_event.is_set():
+                    if select.select([conn], [], [], poll_seconds) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        on_notify(conn.notifies.pop(0).payload)
+            except Exception as e:
+                # هر خطایی (حتی از on_notify/on_connect یا select روی سوکت مرده) نباید نخ شنونده را بکشد،
+                # وگرنه کش‌ها و relay بی‌صدا دیگر از تغییرات مطلع نمی‌شوند
+                logger.error(f"Error listening on channel {channel} ({type(e).__name__}): {e}; reconnecting in {poll_seconds}s.")
+                stop_event.wait(poll_seconds)
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
 
     def _encrypt(self, data: str) -> str:
         if data is None: return None
@@ -157,6 +232,19 @@ class DatabaseManager:
             logger.error(f"Error creating tables in PostgreSQL: {e}")
             raise e
 
+    def run_migrations(self):
+        """مهاجرت‌های نسخه‌دار schema (مثل ایندکس‌ها) را اجرا می‌کند. باید بعد از create_tables صدا زده شود."""
+        try:
+            with self._get_connection() as conn:
+                applied = migrations.apply_migrations(conn)
+                with conn.cursor() as cursor:
+                    version = migrations.get_current_version(cursor)
+            logger.info(f"Database schema is at version {version} ({applied} migration(s) applied).")
+            return version
+        except psycopg2.Error as e:
+            logger.error(f"Error running database migrations: {e}")
+            raise e
+
     def add_or_update_user(self, telegram_id, first_name, last_name=None, username=None):
         sql = """
             INSERT INTO users (telegram_id, first_name, last_name, username, last_activity)
@@ -165,20 +253,41 @@ class DatabaseManager:
                 first_name = EXCLUDED.first_name,
                 last_name = EXCLUDED.last_name,
                 username = EXCLUDED.username,
-                last_activity = CURRENT_TIMESTAMP
-            RETURNING id;
+                last_activity = CURRENT_TIMESTAMP,
+                blocked_at = NULL
+            RETURNING *;
         """
         try:
             with self._get_connection() as conn:
-                with conn.cursor() as cursor:
+                with conn.cursor(cursor_factory=DictCursor) as cursor:
                     cursor.execute(sql, (telegram_id, first_name, last_name, username))
-                    user_id = cursor.fetchone()[0]
+                    user = dict(cursor.fetchone())
                     conn.commit()
-                    return user_id
+                    self._user_cache.set(telegram_id, user)
+                    return user['id']
         except psycopg2.Error as e:
             logger.error(f"Error adding/updating user {telegram_id}: {e}")
             return None
-            
+
+    def touch_user(self, telegram_id, first_name, last_name=None, username=None):
+        """
+        نسخه سبک add_or_update_user برای مسیرهای پرتکرار (مثل /start).
+        اگر کاربر از قبل در کش هویت باشد، به‌روزرسانی در بافر write-behind قرار می‌گیرد
+        و بدون مراجعه به دیتابیس، id کاربر برگردانده می‌شود.
+        """
+        user = self._user_cache.get(telegram_id)
+        if user is None or self._activity_buffer is None:
+            return self.add_or_update_user(telegram_id, first_name, last_name, username)
+
+        self._activity_buffer.record(telegram_id, first_name, last_name, username)
+        if (user.get('first_name'), user.get('last_name'), user.get('username')) != (first_name, last_name, username):
+            self._user_cache.set(telegram_id, {**user, 'first_name': first_name, 'last_name': last_name, 'username': username})
+        return user['id']
+
+    def flush_user_activity(self):
+        """تغییرات بافر شده کاربران را فوراً در دیتابیس ذخیره می‌کند."""
+        return self._activity_buffer.flush() if self._activity_buffer else 0
+
     def get_all_users(self):
         try:
             with self._get_connection() as conn:
@@ -190,11 +299,19 @@ class DatabaseManager:
             return []
 
     def get_user_by_telegram_id(self, telegram_id):
+        user = self._user_cache.get(telegram_id)
+        if user is not None:
+            return dict(user)
         try:
             with self._get_connection() as conn:
                 with conn.cursor(cursor_factory=DictCursor) as cursor:
                     cursor.execute("SELECT * FROM users WHERE telegram_id = %s", (telegram_id,))
-                    return cursor.fetchone()
+                    user = cursor.fetchone()
+                    if user:
+                        user = dict(user)
+                        self._user_cache.set(telegram_id, user)
+                        return dict(user)
+                    return None
         except psycopg2.Error as e:
             logger.error(f"Error getting user by telegram_id {telegram_id}: {e}")
             return None
@@ -221,6 +338,7 @@ class DatabaseManager:
                     """, (name, self._encrypt(panel_url), self._encrypt(username), self._encrypt(password), self._encrypt(sub_base_url), self._encrypt(sub_path_prefix)))
                     server_id = cursor.fetchone()[0]
                     conn.commit()
+                    self.invalidate_server_cache()
                     logger.info(f"Server '{name}' added successfully.")
                     return server_id
         except psycopg2.IntegrityError:
@@ -230,47 +348,49 @@ class DatabaseManager:
             logger.error(f"Error adding server '{name}': {e}")
             return None
 
-    def get_all_servers(self, only_active=True):
-        """تمام سرورها را با اطلاعات رمزگشایی شده از دیتابیس دریافت می‌کند."""
-        try:
+    def _decrypt_server(self, server):
+        server_dict = dict(server)
+        server_dict['panel_url'] = self._decrypt(server_dict['panel_url'])
+        server_dict['username'] = self._decrypt(server_dict['username'])
+        server_dict['password'] = self._decrypt(server_dict['password'])
+        server_dict['subscription_base_url'] = self._decrypt(server_dict['subscription_base_url'])
+        server_dict['subscription_path_prefix'] = self._decrypt(server_dict['subscription_path_prefix'])
+        return server_dict
+
+    def _load_servers(self):
+        """
+        تمام سرورها را (رمزگشایی شده) از کش یا در صورت نبود، از دیتابیس برمی‌گرداند.
+        خروجی یک دیکشنری {server_id: server_dict} است.
+        """
+        servers = self._record_cache.get('servers')
+        if servers is None:
             with self._get_connection() as conn:
                 with conn.cursor(cursor_factory=DictCursor) as cursor:
-                    query = "SELECT * FROM servers"
-                    if only_active:
-                        query += " WHERE is_active = TRUE AND is_online = TRUE"
-                    cursor.execute(query)
-                    servers_data = cursor.fetchall()
-                    
-                    decrypted_servers = []
-                    for server in servers_data:
-                        server_dict = dict(server)
-                        server_dict['panel_url'] = self._decrypt(server_dict['panel_url'])
-                        server_dict['username'] = self._decrypt(server_dict['username'])
-                        server_dict['password'] = self._decrypt(server_dict['password'])
-                        server_dict['subscription_base_url'] = self._decrypt(server_dict['subscription_base_url'])
-                        server_dict['subscription_path_prefix'] = self._decrypt(server_dict['subscription_path_prefix'])
-                        decrypted_servers.append(server_dict)
-                    return decrypted_servers
+                    cursor.execute("SELECT * FROM servers ORDER BY id")
+                    servers = {row['id']: self._decrypt_server(row) for row in cursor.fetchall()}
+            self._record_cache.set('servers', servers)
+        return servers
+
+    def invalidate_server_cache(self):
+        self._record_cache.invalidate('servers')
+
+    def get_all_servers(self, only_active=True):
+        """تمام سرورها را با اطلاعات رمزگشایی شده (از کش) دریافت می‌کند."""
+        try:
+            servers = self._load_servers().values()
+            if only_active:
+                servers = [s for s in servers if s['is_active'] and s['is_online']]
+            # کپی برمی‌گردانیم تا تغییرات فراخواننده روی کش اثر نگذارد
+            return [dict(s) for s in servers]
         except Exception as e:
             logger.error(f"Error getting all servers: {e}")
             return []
 
     def get_server_by_id(self, server_id):
         try:
-            with self._get_connection() as conn:
-                with conn.cursor(cursor_factory=DictCursor) as cursor:
-                    cursor.execute("SELECT * FROM servers WHERE id = %s", (server_id,))
-                    server = cursor.fetchone()
-                    if server:
-                        server_dict = dict(server)
-                        server_dict['panel_url'] = self._decrypt(server_dict['panel_url'])
-                        server_dict['username'] = self._decrypt(server_dict['username'])
-                        server_dict['password'] = self._decrypt(server_dict['password'])
-                        server_dict['subscription_base_url'] = self._decrypt(server_dict['subscription_base_url'])
-                        server_dict['subscription_path_prefix'] = self._decrypt(server_dict['subscription_path_prefix'])
-                        return server_dict
-                    return None
-        except psycopg2.Error as e:
+            server = self._load_servers().get(server_id)
+            return dict(server) if server else None
+        except Exception as e:
             logger.error(f"Error getting server by ID {server_id}: {e}")
             return None
 
@@ -280,6 +400,7 @@ class DatabaseManager:
                 with conn.cursor() as cursor:
                     cursor.execute("DELETE FROM servers WHERE id = %s", (server_id,))
                     conn.commit()
+                    self.invalidate_server_cache()
                     logger.info(f"Server with ID {server_id} has been deleted.")
                     return cursor.rowcount > 0
         except psycopg2.Error as e:
@@ -294,11 +415,40 @@ class DatabaseManager:
                         UPDATE servers SET is_online = %s, last_checked = %s WHERE id = %s
                     """, (is_online, last_checked, server_id))
                     conn.commit()
+                    self.invalidate_server_cache()
                     return True
         except psycopg2.Error as e:
             logger.error(f"Error updating server status for ID {server_id}: {e}")
             return False
 
+    def update_servers_health(self, results: list, failure_threshold: int = 1):
+        """
+        نتیجه بررسی سلامت چند سرور را در یک دستور UPDATE ثبت می‌کند.
+        results: لیست (server_id, is_ok, latency_ms, checked_at)
+        سرور فقط پس از failure_threshold شکست متوالی آفلاین علامت می‌خورد.
+        """
+        if not results:
+            return True
+        sql = f"""
+            UPDATE servers AS s SET
+                consecutive_failures = CASE WHEN v.ok THEN 0 ELSE s.consecutive_failures + 1 END,
+                is_online = CASE WHEN v.ok THEN TRUE ELSE s.consecutive_failures + 1 < {int(failure_threshold)} END,
+                last_latency_ms = v.latency_ms,
+                last_checked = v.checked_at
+            FROM (VALUES %s) AS v (id, ok, latency_ms, checked_at)
+            WHERE s.id = v.id
+        """
+        try:
+            with self._get_connection() as conn:
+                with conn.cursor() as cursor:
+                    execute_values(cursor, sql, results, template="(%s::int, %s::boolean, %s::int, %s::timestamptz)")
+                    conn.commit()
+                    self.invalidate_server_cache()
+                    return True
+        except psycopg2.Error as e:
+            logger.error(f"Error updating health of {len(results)} servers: {e}")
+            return False
+
     # --- توابع Inboundهای سرور ---
     def get_server_inbounds(self, server_id, only_active=True):
         try:
@@ -316,6 +466,469 @@ class DatabaseManager:
 
     
 
+    def update_inbound_snapshots(self, server_id: int, snapshots: dict):
+        """
+        snapshot فشرده اینباندهای یک سرور را ذخیره می‌کند.
+        snapshots: دیکشنری {inbound_id پنل: snapshot}. فقط اینباندهای ثبت شده در server_inbounds به‌روز می‌شوند.
+        """
+        if not snapshots:
+            return True
+        rows = [(inbound_id, json.dumps(snapshot)) for inbound_id, snapshot in snapshots.items()]
+        try:
+            with self._get_connection() as conn:
+                with conn.cursor() as cursor:
+                    execute_values(cursor, f"""
+                        UPDATE server_inbounds AS si SET
+                            snapshot_json = v.snapshot_json,
+                            snapshot_updated_at = CURRENT_TIMESTAMP
+                        FROM (VALUES %s) AS v (inbound_id, snapshot_json)
+                        WHERE si.server_id = {int(server_id)} AND si.inbound_id = v.inbound_id
+                    """, rows, template="(%s::int, %s::text)")
+                    conn.commit()
+                    return True
+        except psycopg2.Error as e:
+            logger.error(f"Error updating inbound snapshots for server {server_id}: {e}")
+            return False
+
+    # --- توابع مصرف ترافیک کلاینت‌ها ---
+    def sync_client_usage(self, server_id: int, rows: list, synced_at):
+        """
+        آمار ترافیک کلاینت‌های یک سرور را به صورت دسته‌ای upsert می‌کند و ردیف‌های کلاینت‌هایی را که
+        دیگر در پنل نیستند حذف می‌کند. rows: لیست (email, up, down, total, expiry_time, enable).
+        """
+        try:
+            with self._get_connection() as conn:
+                with conn.cursor() as cursor:
+                    if rows:
+                        execute_values(cursor, """
+                            INSERT INTO client_usage (xui_client_email, server_id, up_bytes, down_bytes, total_bytes,
+                                                      expiry_time, enable, updated_at)
+                            VALUES %s
+                            ON CONFLICT (xui_client_email, server_id) DO UPDATE SET
+                                up_bytes = EXCLUDED.up_bytes,
+                                down_bytes = EXCLUDED.down_bytes,
+                                total_bytes = EXCLUDED.total_bytes,
+                                expiry_time = EXCLUDED.expiry_time,
+                                enable = EXCLUDED.enable,
+                                updated_at = EXCLUDED.updated_at
+                        """, [(email, server_id, up, down, total, expiry_time, enable, synced_at)
+                              for email, up, down, total, expiry_time, enable in rows], page_size=1000)
+                    cursor.execute("DELETE FROM client_usage WHERE server_id = %s AND updated_at < %s", (server_id, synced_at))
+                conn.commit()
+                return True
+        except psycopg2.Error as e:
+            logger.error(f"Error syncing client usage for server {server_id}: {e}")
+            return False
+
+    def get_client_usage(self, xui_client_email: str):
+        """
+        مصرف یک کلاینت (جمع تمام سرورها) را از جدول client_usage برمی‌گرداند:
+        {'used_bytes', 'up_bytes', 'down_bytes', 'total_bytes', 'updated_at'} یا None اگر هنوز همگام‌سازی نشده باشد.
+        """
+        if not xui_client_email:
+            return None
+        try:
+            with self._get_connection() as conn:
+                with conn.cursor(cursor_factory=DictCursor) as cursor:
+                    cursor.execute("""
+                        SELECT SUM(up_bytes + down_bytes) AS used_bytes, SUM(up_bytes) AS up_bytes,
+                               SUM(down_bytes) AS down_bytes, MAX(total_bytes) AS total_bytes,
+                               MIN(updated_at) AS updated_at
+                        FROM client_usage WHERE xui_client_email = %s
+                    """, (xui_client_email,))
+                    usage = cursor.fetchone()
+                    return dict(usage) if usage and usage['updated_at'] else None
+        except psycopg2.Error as e:
+            logger.error(f"Error getting usage for client {xui_client_email}: {e}")
+            return None
+
+    # --- صف کارهای ساخت سرویس (provisioning_jobs) ---
+    @staticmethod
+    def _insert_provisioning_job(cursor, payment_id: int, payload: dict, max_attempts: int):
+        """کار ساخت سرویس را در تراکنش جاری ثبت می‌کند (برای هر پرداخت فقط یک کار) و id آن را برمی‌گرداند."""
+        cursor.execute("""
+            INSERT INTO provisioning_jobs (payment_id, payload_json, max_attempts)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (payment_id) DO UPDATE SET payment_id = EXCLUDED.payment_id
+            RETURNING id
+        """, (payment_id, json.dumps(payload), max_attempts))
+        return cursor.fetchone()[0]
+
+    def confirm_payment_and_enqueue(self, payment_id: int, admin_id: int, job_payload: dict, max_attempts: int):
+        """
+        تایید دستی پرداخت و ثبت کار ساخت سرویس آن در یک تراکنش. تایید شرطی است تا اگر دو ادمین همزمان
+        تایید کنند فقط یکی موفق شود. خروجی: id کار، False اگر پرداخت قبلاً تایید شده و None در صورت خطا.
+        """
+        try:
+            with self._get_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("""
+                        UPDATE payments
+                        SET is_confirmed = TRUE, admin_confirmed_by = %s, confirmation_date = CURRENT_TIMESTAMP
+                        WHERE id = %s AND is_confirmed = FALSE
+                    """, (admin_id, payment_id))
+                    if cursor.rowcount == 0:
+                        conn.rollback()
+                        return False
+                    job_id = self._insert_provisioning_job(cursor, payment_id, job_payload, max_attempts)
+                conn.commit()
+                return job_id
+        except psycopg2.Error as e:
+            logger.error(f"Error confirming payment {payment_id} and enqueuing provisioning: {e}")
+            return None
+
+    def claim_provisioning_job(self, worker_name: str, lock_timeout_seconds: float):
+        """
+        یک کار آماده را با FOR UPDATE SKIP LOCKED برمی‌دارد تا چند worker (حتی در چند پروسه) بدون
+        انتظار برای یکدیگر کار کنند. کارهای running که قفلشان منقضی شده (worker از کار افتاده) نیز دوباره برداشته می‌شوند.
+        """
+        try:
+            with self._get_connection() as conn:
+                with conn.cursor(cursor_factory=DictCursor) as cursor:
+                    cursor.execute("""
+                        UPDATE provisioning_jobs SET
+                            status = 'running', attempts = attempts + 1,
+                            locked_at = CURRENT_TIMESTAMP, locked_by = %s
+                        WHERE id = (
+                            SELECT id FROM provisioning_jobs
+                            WHERE (status = 'pending' AND run_after <= CURRENT_TIMESTAMP)
+                               OR (status = 'running' AND locked_at < CURRENT_TIMESTAMP - (%s * INTERVAL '1 second'))
+                            ORDER BY run_after, id
+                            FOR UPDATE SKIP LOCKED
+                            LIMIT 1
+                        )
+                        RETURNING *
+                    """, (worker_name, lock_timeout_seconds))
+                    job = cursor.fetchone()
+                conn.commit()
+                return job
+        except psycopg2.Error as e:
+            logger.error(f"Error claiming provisioning job: {e}")
+            return None
+
+    def complete_provisioning_job(self, job_id: int, purchase: dict = None):
+        """
+        خرید ساخته شده (با همان کلیدهای add_purchase) را ثبت و کار را در یک تراکنش done می‌کند.
+        subscription_id خرید از payload کار می‌آید و یکتاست، پس ثبت دوباره همان خرید (کاری که پس از ثبت خرید
+        دوباره برداشته شده) بی‌اثر است. purchase=None یعنی خرید قبلاً ثبت شده و فقط کار بسته می‌شود.
+        """
+        try:
+            with self._get_connection() as conn:
+                with conn.cursor() as cursor:
+                    if purchase:
+                        columns = self.PURCHASE_COLUMNS
+                        cursor.execute(f"""
+                            INSERT INTO purchases ({', '.join(columns)}, is_active)
+                            VALUES ({', '.join(['%s'] * len(columns))}, TRUE)
+                            ON CONFLICT (subscription_id) DO NOTHING
+                        """, tuple(purchase.get(column) for column in columns))
+                    cursor.execute("""
+                        UPDATE provisioning_jobs SET status = 'done', finished_at = CURRENT_TIMESTAMP, last_error = NULL
+                        WHERE id = %s
+                    """, (job_id,))
+                conn.commit()
+                return True
+        except psycopg2.Error as e:
+            logger.error(f"Error completing provisioning job {job_id}: {e}")
+            return False
+
+    def fail_provisioning_job(self, job_id: int, error: str, retry_delay_seconds: float):
+        """
+        شکست یک کار را ثبت می‌کند: اگر تلاش‌ها تمام شده باشد به وضعیت dead (dead-letter) می‌رود،
+        وگرنه پس از retry_delay_seconds دوباره pending می‌شود. وضعیت جدید را برمی‌گرداند.
+        """
+        try:
+            with self._get_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("""
+                        UPDATE provisioning_jobs SET
+                            status = CASE WHEN attempts >= max_attempts THEN 'dead' ELSE 'pending' END,
+                            run_after = CURRENT_TIMESTAMP + (%s * INTERVAL '1 second'),
+                            finished_at = CASE WHEN attempts >= max_attempts THEN CURRENT_TIMESTAMP END,
+                            locked_at = NULL, locked_by = NULL, last_error = %s
+                        WHERE id = %s
+                        RETURNING status
+                    """, (retry_delay_seconds, error, job_id))
+                    row = cursor.fetchone()
+                conn.commit()
+                return row[0] if row else None
+        except psycopg2.Error as e:
+            logger.error(f"Error recording failure of provisioning job {job_id}: {e}")
+            return None
+
+    def get_provisioning_job_stats(self):
+        """تعداد کارهای صف به تفکیک وضعیت: {'pending': n, 'running': n, 'done': n, 'dead': n}"""
+        try:
+            with self._get_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT status, COUNT(*) FROM provisioning_jobs GROUP BY status")
+                    return dict(cursor.fetchall())
+        except psycopg2.Error as e:
+            logger.error(f"Error getting provisioning job stats: {e}")
+            return {}
+
+    # --- Outbound Message Outbox ---
+    @staticmethod
+    def _insert_outbound_messages(cursor, messages: list):
+        rows = [(chat_id, method, json.dumps(payload), psycopg2.Binary(attachment) if attachment is not None else None, priority)
+                for chat_id, method, payload, attachment, priority in messages]
+        execute_values(cursor, """
+            INSERT INTO outbound_messages (chat_id, method, payload_json, attachment, priority) VALUES %s
+        """, rows, page_size=1000)
+        return len(rows)
+
+    def enqueue_outbound_messages(self, messages: list):
+        """
+        پیام‌ها را برای ارسال توسط OutboxRelay ربات در صف outbound_messages قرار می‌دهد.
+        هر آیتم: (chat_id, method, payload_dict, attachment_bytes_or_None, priority). تعداد ثبت شده‌ها را برمی‌گرداند.
+        """
+        if not messages:
+            return 0
+        try:
+            with self._get_connection() as conn:
+                with conn.cursor() as cursor:
+                    count = self._insert_outbound_messages(cursor, messages)
+                conn.commit()
+                return count
+        except psycopg2.Error as e:
+            logger.error(f"Error enqueuing {len(messages)} outbound message(s): {e}")
+            return 0
+
+    def claim_outbound_messages(self, limit: int, lock_timeout_seconds: float):
+        """
+        حداکثر limit پیام آماده را برمی‌دارد. پیام‌های هر چت فقط به ترتیب id و به صورت یک پیشوند پیوسته برداشته می‌شوند:
+        چتی که پیام قدیمی‌ترش هنوز در حال ارسال یا به تعویق افتاده (429 یا retry) است کنار گذاشته می‌شود و اولویت
+        هر چت، بالاترین اولویت پیام‌های آماده آن است. برداشتن‌ها با یک قفل advisory تراکنشی پشت سر هم انجام می‌شوند
+        تا دو relay پیام‌های یک چت را همزمان برندارند. پیام‌های sending که قفلشان منقضی شده نیز دوباره برداشته می‌شوند.
+        """
+        try:
+            with self._get_connection() as conn:
+                with conn.cursor(cursor_factory=DictCursor) as cursor:
+                    cursor.execute("SELECT pg_advisory_xact_lock(%s)", (OUTBOX_CLAIM_LOCK_KEY,))
+                    cursor.execute("""
+                        WITH ready AS (
+                            SELECT m.id, m.chat_id,
+                                   MIN(m.priority) OVER (PARTITION BY m.chat_id) AS chat_priority,
+                                   MIN(m.id) OVER (PARTITION BY m.chat_id) AS chat_first_id
+                            FROM outbound_messages m
+                            WHERE ((m.status = 'pending' AND m.available_at <= CURRENT_TIMESTAMP)
+                                OR (m.status = 'sending' AND m.locked_at < CURRENT_TIMESTAMP - (%(lock_timeout)s * INTERVAL '1 second')))
+                              AND NOT EXISTS (
+                                  SELECT 1 FROM outbound_messages b
+                                  WHERE b.chat_id = m.chat_id AND b.id < m.id AND (
+                                      (b.status = 'pending' AND b.available_at > CURRENT_TIMESTAMP)
+                                      OR (b.status = 'sending' AND b.locked_at >= CURRENT_TIMESTAMP - (%(lock_timeout)s * INTERVAL '1 second'))))
+                        ), picked AS (
+                            SELECT id FROM ready
+                            ORDER BY chat_priority, chat_first_id, id
+                            LIMIT %(limit)s
+                        )
+                        UPDATE outbound_messages SET status = 'sending', attempts = attempts + 1, locked_at = CURRENT_TIMESTAMP
+                        WHERE id IN (SELECT id FROM picked)
+                        RETURNING *
+                    """, {'lock_timeout': lock_timeout_seconds, 'limit': limit})
+                    rows = cursor.fetchall()
+                conn.commit()
+                chat_priority = {}
+                for row in rows:
+                    chat_priority[row['chat_id']] = min(row['priority'], chat_priority.get(row['chat_id'], row['priority']))
+                return sorted(rows, key=lambda row: (chat_priority[row['chat_id']], row['id']))
+        except psycopg2.Error as e:
+            logger.error(f"Error claiming outbound messages: {e}")
+            return []
+
+    def complete_outbound_message(self, message_id: int):
+        try:
+            with self._get_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("DELETE FROM outbound_messages WHERE id = %s", (message_id,))
+                conn.commit()
+                return True
+        except psycopg2.Error as e:
+            logger.error(f"Error completing outbound message {message_id}: {e}")
+            return False
+
+    def release_outbound_messages(self, message_ids: list, delay_seconds: float):
+        """پیام‌های برداشته شده را بدون حساب کردن تلاش به صف برمی‌گرداند (مثلاً به خاطر محدودیت نرخ چت)."""
+        if not message_ids:
+            return True
+        try:
+            with self._get_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("""
+                        UPDATE outbound_messages SET status = 'pending', attempts = GREATEST(attempts - 1, 0), locked_at = NULL,
+                            available_at = CURRENT_TIMESTAMP + (%s * INTERVAL '1 second')
+                        WHERE id = ANY(%s) AND status = 'sending'
+                    """, (delay_seconds, list(message_ids)))
+                conn.commit()
+                return True
+        except psycopg2.Error as e:
+            logger.error(f"Error releasing {len(message_ids)} outbound message(s): {e}")
+            return False
+
+    def fail_outbound_message(self, message_id: int, error: str, max_attempts: int, retry_delay_seconds: float = None):
+        """
+        شکست ارسال را ثبت می‌کند: بدون retry_delay_seconds (خطای دائمی مثل بلاک شدن ربات) یا پس از max_attempts تلاش
+        به وضعیت failed می‌رود، وگرنه پس از retry_delay_seconds دوباره pending می‌شود. وضعیت جدید را برمی‌گرداند.
+        """
+        try:
+            with self._get_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("""
+                        UPDATE outbound_messages SET
+                            status = CASE WHEN %s OR attempts >= %s THEN 'failed' ELSE 'pending' END,
+                            available_at = CURRENT_TIMESTAMP + (%s * INTERVAL '1 second'),
+                            locked_at = NULL, last_error = %s
+                        WHERE id = %s
+                        RETURNING status
+                    """, (retry_delay_seconds is None, max_attempts, retry_delay_seconds or 0, error, message_id))
+                    row = cursor.fetchone()
+                conn.commit()
+                return row[0] if row else None
+        except psycopg2.Error as e:
+            logger.error(f"Error recording failure of outbound message {message_id}: {e}")
+            return None
+
+    def get_outbound_message_stats(self):
+        """تعداد پیام‌های صف به تفکیک وضعیت: {'pending': n, 'sending': n, 'failed': n}"""
+        try:
+            with self._get_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT status, COUNT(*) FROM outbound_messages GROUP BY status")
+                    return dict(cursor.fetchall())
+        except psycopg2.Error as e:
+            logger.error(f"Error getting outbound message stats: {e}")
+            return {}
+
+    # --- Broadcasts ---
+    def create_broadcast(self, admin_telegram_id: int, message_text: str, progress_message_id: int = None):
+        """یک ارسال همگانی در وضعیت running ثبت می‌کند؛ total_count تعداد کاربران قابل دسترس در همین لحظه است."""
+        try:
+            with self._get_connection() as conn:
+                with conn.cursor(cursor_factory=DictCursor) as cursor:
+                    cursor.execute("""
+                        INSERT INTO broadcasts (admin_telegram_id, message_text, progress_message_id, total_count)
+                        VALUES (%s, %s, %s, (SELECT COUNT(*) FROM users WHERE blocked_at IS NULL))
+                        RETURNING *
+                    """, (admin_telegram_id, message_text, progress_message_id))
+                    broadcast = cursor.fetchone()
+                conn.commit()
+                return dict(broadcast)
+        except psycopg2.Error as e:
+            logger.error(f"Error creating broadcast for admin {admin_telegram_id}: {e}")
+            return None
+
+    def count_broadcast_recipients(self) -> int:
+        try:
+            with self._get_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT COUNT(*) FROM users WHERE blocked_at IS NULL")
+                    return cursor.fetchone()[0]
+        except psycopg2.Error as e:
+            logger.error(f"Error counting broadcast recipients: {e}")
+            return 0
+
+    def get_broadcast_recipients(self, after_user_id: int, limit: int):
+        """
+        صفحه بعدی کاربران قابل دسترس (id بزرگ‌تر از after_user_id، به ترتیب id) را با یک کوئری کوتاه برمی‌گرداند
+        تا در طول ارسال طولانی هیچ اتصال یا تراکنشی باز نماند. در صورت خطا None برمی‌گرداند.
+        """
+        try:
+            with self._get_connection() as conn:
+                with conn.cursor(cursor_factory=DictCursor) as cursor:
+                    cursor.execute("""
+                        SELECT id, telegram_id FROM users
+                        WHERE id > %s AND blocked_at IS NULL
+                        ORDER BY id
+                        LIMIT %s
+                    """, (after_user_id, limit))
+                    return cursor.fetchall()
+        except psycopg2.Error as e:
+            logger.error(f"Error getting broadcast recipients after user {after_user_id}: {e}")
+            return None
+
+    def update_broadcast_progress(self, broadcast_id: int, last_user_id: int, sent: int, failed: int, blocked: int):
+        """پیشرفت یک دسته را (به صورت افزایشی) ذخیره و heartbeat را تمدید می‌کند. وضعیت فعلی ارسال را برمی‌گرداند."""
+        try:
+            with self._get_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("""
+                        UPDATE broadcasts SET last_user_id = GREATEST(last_user_id, %s), sent_count = sent_count + %s,
+                            failed_count = failed_count + %s, blocked_count = blocked_count + %s, heartbeat_at = CURRENT_TIMESTAMP
+                        WHERE id = %s
+                        RETURNING status
+                    """, (last_user_id, sent, failed, blocked, broadcast_id))
+                    row = cursor.fetchone()
+                conn.commit()
+                return row[0] if row else None
+        except psycopg2.Error as e:
+            logger.error(f"Error saving progress of broadcast {broadcast_id}: {e}")
+            return None
+
+    def finish_broadcast(self, broadcast_id: int, status: str):
+        """وضعیت نهایی (done یا cancelled) را ثبت می‌کند؛ فقط اگر ارسال هنوز running باشد True برمی‌گرداند."""
+        try:
+            with self._get_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("""
+                        UPDATE broadcasts SET status = %s, finished_at = CURRENT_TIMESTAMP, heartbeat_at = NULL
+                        WHERE id = %s AND status = 'running'
+                    """, (status, broadcast_id))
+                    updated = cursor.rowcount == 1
+                conn.commit()
+                return updated
+        except psycopg2.Error as e:
+            logger.error(f"Error finishing broadcast {broadcast_id}: {e}")
+            return False
+
+    def claim_stale_broadcasts(self, lock_timeout_seconds: float):
+        """
+        ارسال‌های running که هیچ پروسه‌ای آن‌ها را پیش نمی‌برد (heartbeat خالی یا قدیمی‌تر از lock_timeout_seconds،
+        مثلاً پس از restart) را برمی‌دارد و heartbeat آن‌ها را تمدید می‌کند تا پروسه دیگری همزمان ادامه‌شان ندهد.
+        """
+        try:
+            with self._get_connection() as conn:
+                with conn.cursor(cursor_factory=DictCursor) as cursor:
+                    cursor.execute("""
+                        UPDATE broadcasts SET heartbeat_at = CURRENT_TIMESTAMP
+                        WHERE status = 'running'
+                          AND (heartbeat_at IS NULL OR heartbeat_at < CURRENT_TIMESTAMP - (%s * INTERVAL '1 second'))
+                        RETURNING *
+                    """, (lock_timeout_seconds,))
+                    broadcasts = [dict(row) for row in cursor.fetchall()]
+                conn.commit()
+                return broadcasts
+        except psycopg2.Error as e:
+            logger.error(f"Error claiming stale broadcasts: {e}")
+            return []
+
+    def release_broadcast(self, broadcast_id: int):
+        """heartbeat را پاک می‌کند تا ارسال نیمه‌کاره (هنگام خاموش شدن ربات) در اجرای بعدی بلافاصله ادامه یابد."""
+        try:
+            with self._get_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("UPDATE broadcasts SET heartbeat_at = NULL WHERE id = %s AND status = 'running'", (broadcast_id,))
+                conn.commit()
+                return True
+        except psycopg2.Error as e:
+            logger.error(f"Error releasing broadcast {broadcast_id}: {e}")
+            return False
+
+    def mark_users_blocked(self, user_ids: list):
+        """کاربرانی که تلگرام برای آن‌ها 403 برگردانده (ربات بلاک شده یا حساب حذف شده) را یکجا علامت می‌زند."""
+        if not user_ids:
+            return 0
+        try:
+            with self._get_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("UPDATE users SET blocked_at = CURRENT_TIMESTAMP WHERE id = ANY(%s)", (list(user_ids),))
+                    updated = cursor.rowcount
+                conn.commit()
+                return updated
+        except psycopg2.Error as e:
+            logger.error(f"Error marking {len(user_ids)} user(s) as blocked: {e}")
+            return 0
+
     # --- توابع پلن‌ها ---
     def add_plan(self, name, plan_type, volume_gb, duration_days, price, per_gb_price):
         try:
@@ -386,6 +999,7 @@ class DatabaseManager:
                     """, (name, gateway_type, encrypted_card_number, encrypted_card_holder_name, encrypted_merchant_id, description, priority))
                     gateway_id = cursor.fetchone()[0]
                     conn.commit()
+                    self.invalidate_payment_gateway_cache()
                     logger.info(f"Payment Gateway '{name}' ({gateway_type}) added successfully.")
                     return gateway_id
         except psycopg2.IntegrityError:
@@ -395,47 +1009,44 @@ class DatabaseManager:
             logger.error(f"Error adding payment gateway '{name}': {e}")
             return None
 
-    def get_all_payment_gateways(self, only_active=False):
-        try:
+    def _decrypt_gateway(self, gateway):
+        gateway_dict = dict(gateway)
+        if gateway_dict.get('card_number'):
+            gateway_dict['card_number'] = self._decrypt(gateway_dict['card_number'])
+        if gateway_dict.get('card_holder_name'):
+            gateway_dict['card_holder_name'] = self._decrypt(gateway_dict['card_holder_name'])
+        if gateway_dict.get('merchant_id'):
+            gateway_dict['merchant_id'] = self._decrypt(gateway_dict['merchant_id'])
+        return gateway_dict
+
+    def _load_payment_gateways(self):
+        """تمام درگاه‌ها را (رمزگشایی شده) به صورت {gateway_id: gateway_dict} از کش یا دیتابیس برمی‌گرداند."""
+        gateways = self._record_cache.get('payment_gateways')
+        if gateways is None:
             with self._get_connection() as conn:
                 with conn.cursor(cursor_factory=DictCursor) as cursor:
-                    query = "SELECT * FROM payment_gateways"
-                    if only_active:
-                        query += " WHERE is_active = TRUE"
-                    query += " ORDER BY priority DESC, id"
-                    cursor.execute(query)
-                    gateways = cursor.fetchall()
-                    decrypted_gateways = []
-                    for gateway in gateways:
-                        gateway_dict = dict(gateway)
-                        if gateway_dict.get('card_number'):
-                            gateway_dict['card_number'] = self._decrypt(gateway_dict['card_number'])
-                        if gateway_dict.get('card_holder_name'):
-                            gateway_dict['card_holder_name'] = self._decrypt(gateway_dict['card_holder_name'])
-                        if gateway_dict.get('merchant_id'):
-                            gateway_dict['merchant_id'] = self._decrypt(gateway_dict['merchant_id'])
-                        decrypted_gateways.append(gateway_dict)
-                    return decrypted_gateways
+                    cursor.execute("SELECT * FROM payment_gateways ORDER BY priority DESC, id")
+                    gateways = {row['id']: self._decrypt_gateway(row) for row in cursor.fetchall()}
+            self._record_cache.set('payment_gateways', gateways)
+        return gateways
+
+    def invalidate_payment_gateway_cache(self):
+        self._record_cache.invalidate('payment_gateways')
+
+    def get_all_payment_gateways(self, only_active=False):
+        try:
+            gateways = self._load_payment_gateways().values()
+            if only_active:
+                gateways = [g for g in gateways if g['is_active']]
+            return [dict(g) for g in gateways]
         except Exception as e:
             logger.error(f"Error getting payment gateways: {e}")
             return []
 
     def get_payment_gateway_by_id(self, gateway_id):
         try:
-            with self._get_connection() as conn:
-                with conn.cursor(cursor_factory=DictCursor) as cursor:
-                    cursor.execute("SELECT * FROM payment_gateways WHERE id = %s", (gateway_id,))
-                    gateway = cursor.fetchone()
-                    if gateway:
-                        gateway_dict = dict(gateway)
-                        if gateway_dict.get('card_number'):
-                            gateway_dict['card_number'] = self._decrypt(gateway_dict['card_number'])
-                        if gateway_dict.get('card_holder_name'):
-                            gateway_dict['card_holder_name'] = self._decrypt(gateway_dict['card_holder_name'])
-                        if gateway_dict.get('merchant_id'):
-                            gateway_dict['merchant_id'] = self._decrypt(gateway_dict['merchant_id'])
-                        return gateway_dict
-                    return None
+            gateway = self._load_payment_gateways().get(gateway_id)
+            return dict(gateway) if gateway else None
         except Exception as e:
             logger.error(f"Error getting payment gateway {gateway_id}: {e}")
             return None
@@ -446,6 +1057,7 @@ class DatabaseManager:
                 with conn.cursor() as cursor:
                     cursor.execute("UPDATE payment_gateways SET is_active = %s WHERE id = %s", (is_active, gateway_id))
                     conn.commit()
+                    self.invalidate_payment_gateway_cache()
                     return True
         except psycopg2.Error as e:
             logger.error(f"Error updating gateway status for ID {gateway_id}: {e}")
@@ -528,15 +1140,131 @@ class DatabaseManager:
             logger.error(f"Error adding purchase for user {user_id}: {e}")
             return None
 
+    PURCHASE_COLUMNS = ('user_id', 'purchase_type', 'server_id', 'profile_id', 'plan_id', 'expire_date',
+                        'initial_volume_gb', 'subscription_id', 'full_configs_json',
+                        'xui_client_uuid', 'xui_client_email', 'single_configs_json')
+
+    def get_expired_purchases(self, grace_hours: float, limit: int, after_id: int = 0):
+        """
+        خریدهای فعالی که منقضی شده‌اند (بیش از grace_hours از expire_date گذشته) یا حجمشان طبق
+        جدول client_usage تمام شده است را به ترتیب id و صفحه‌بندی keyset (id > after_id) برمی‌گرداند.
+        فقط خریدهای فعال بعد از after_id پیمایش می‌شوند و مصرف هر کدام با کلید اصلی client_usage خوانده می‌شود،
+        پس کل یک دور پاکسازی متناسب با تعداد خریدهای فعال است و نه اندازه client_usage.
+        """
+        try:
+            with self._get_connection() as conn:
+                with conn.cursor(cursor_factory=DictCursor) as cursor:
+                    cursor.execute("""
+                        SELECT p.id, p.purchase_type, p.server_id, p.profile_id, p.xui_client_uuid, p.xui_client_email,
+                               CASE WHEN p.expire_date < NOW() - (%s * INTERVAL '1 hour') THEN 'expired' ELSE 'exhausted' END AS reason
+                        FROM purchases p
+                        WHERE p.is_active = TRUE AND p.id > %s
+                          AND (p.expire_date < NOW() - (%s * INTERVAL '1 hour')
+                               OR EXISTS (
+                                   SELECT 1 FROM client_usage u
+                                   WHERE u.xui_client_email = p.xui_client_email
+                                   HAVING MAX(u.total_bytes) > 0 AND SUM(u.up_bytes + u.down_bytes) >= MAX(u.total_bytes)
+                               ))
+                        ORDER BY p.id
+                        LIMIT %s
+                    """, (grace_hours, after_id, grace_hours, limit))
+                    return cursor.fetchall()
+        except psycopg2.Error as e:
+            logger.error(f"Error getting expired purchases: {e}")
+            return []
+
+    def get_purchase_client_targets(self, purchase_ids: list):
+        """
+        برای هر خرید، اینباندهایی که کلاینت آن روی‌شان ساخته شده است را برمی‌گرداند:
+        لیست ردیف‌های (purchase_id, server_id, inbound_id).
+        """
+        if not purchase_ids:
+            return []
+        try:
+            with self._get_connection() as conn:
+                with conn.cursor(cursor_factory=DictCursor) as cursor:
+                    cursor.execute("""
+                        SELECT p.id AS purchase_id, si.server_id, si.inbound_id
+                        FROM purchases p JOIN server_inbounds si ON si.server_id = p.server_id
+                        WHERE p.id = ANY(%s) AND p.purchase_type <> 'profile'
+                        UNION ALL
+                        SELECT p.id, si.server_id, si.inbound_id
+                        FROM purchases p
+                        JOIN profile_inbounds pi ON pi.profile_id = p.profile_id
+                        JOIN server_inbounds si ON si.id = pi.server_inbound_id
+                        WHERE p.id = ANY(%s) AND p.purchase_type = 'profile'
+                    """, (list(purchase_ids), list(purchase_ids)))
+                    return cursor.fetchall()
+        except psycopg2.Error as e:
+            logger.error(f"Error getting client targets for {len(purchase_ids)} purchases: {e}")
+            return []
+
+    def deactivate_purchases(self, purchase_ids: list):
+        """چند خرید را با یک دستور UPDATE غیرفعال می‌کند و تعداد ردیف‌های تغییر یافته را برمی‌گرداند."""
+        if not purchase_ids:
+            return 0
+        try:
+            with self._get_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("UPDATE purchases SET is_active = FALSE WHERE id = ANY(%s) AND is_active = TRUE", (list(purchase_ids),))
+                    updated = cursor.rowcount
+                conn.commit()
+                return updated
+        except psycopg2.Error as e:
+            logger.error(f"Error deactivating {len(purchase_ids)} purchases: {e}")
+            return 0
+
+    def get_server_purchases_for_reconcile(self, server_id: int, after_id: int, limit: int):
+        """
+        صفحه بعدی خریدهای فعالی که کلاینتشان باید روی این سرور باشد (id بزرگ‌تر از after_id، به ترتیب id)
+        را با یک کوئری کوتاه برمی‌گرداند تا در طول درخواست‌های پنل هیچ اتصال یا تراکنشی باز نماند.
+        هر ردیف شامل inbound_ids (اینباندهای هدف روی همین سرور) و telegram_id کاربر است. در صورت خطا None.
+        """
+        try:
+            with self._get_connection() as conn:
+                with conn.cursor(cursor_factory=DictCursor) as cursor:
+                    cursor.execute("""
+                        SELECT p.id, p.xui_client_uuid, p.xui_client_email, p.expire_date, p.initial_volume_gb,
+                               u.telegram_id,
+                               CASE WHEN p.purchase_type = 'profile' THEN ARRAY(
+                                   SELECT si.inbound_id FROM profile_inbounds pi
+                                   JOIN server_inbounds si ON si.id = pi.server_inbound_id
+                                   WHERE pi.profile_id = p.profile_id AND si.server_id = %(server_id)s AND si.is_active = TRUE)
+                               ELSE ARRAY(
+                                   SELECT si.inbound_id FROM server_inbounds si
+                                   WHERE si.server_id = %(server_id)s AND si.is_active = TRUE)
+                               END AS inbound_ids
+                        FROM purchases p
+                        JOIN users u ON u.id = p.user_id
+                        WHERE p.is_active = TRUE AND p.id > %(after_id)s AND p.xui_client_email IS NOT NULL AND (
+                            (p.purchase_type <> 'profile' AND p.server_id = %(server_id)s)
+                            OR (p.purchase_type = 'profile' AND p.profile_id IN (
+                                SELECT pi.profile_id FROM profile_inbounds pi
+                                JOIN server_inbounds si ON si.id = pi.server_inbound_id
+                                WHERE si.server_id = %(server_id)s))
+                        )
+                        ORDER BY p.id
+                        LIMIT %(limit)s
+                    """, {'server_id': server_id, 'after_id': after_id, 'limit': limit})
+                    return cursor.fetchall()
+        except psycopg2.Error as e:
+            logger.error(f"Error getting purchases to reconcile for server {server_id} after {after_id}: {e}")
+            return None
+
     def get_user_purchases(self, user_db_id):
         try:
             with self._get_connection() as conn:
                 with conn.cursor(cursor_factory=DictCursor) as cursor:
                     cursor.execute("""
-                        SELECT p.id, p.purchase_date, p.expire_date, p.initial_volume_gb, p.is_active, s.name as server_name, pr.name as profile_name
+                        SELECT p.id, p.purchase_date, p.expire_date, p.initial_volume_gb, p.is_active, s.name as server_name, pr.name as profile_name,
+                               u.used_bytes
                         FROM purchases p
                         LEFT JOIN servers s ON p.server_id = s.id
                         LEFT JOIN profiles pr ON p.profile_id = pr.id
+                        LEFT JOIN LATERAL (
+                            SELECT SUM(cu.up_bytes + cu.down_bytes) AS used_bytes
+                            FROM client_usage cu WHERE cu.xui_client_email = p.xui_client_email
+                        ) u ON TRUE
                         WHERE p.user_id = %s
                         ORDER BY p.id DESC
                     """, (user_db_id,))
@@ -617,6 +1345,82 @@ class DatabaseManager:
             logger.error(f"Error confirming online payment for ID {payment_id}: {e}")
             return False
 
+    def claim_payment_verification(self, authority: str, new_state: str, stale_seconds: float):
+        """
+        بررسی یک authority را به صورت اتمی (UPDATE شرطی) به این درخواست می‌سپارد و وضعیت را new_state می‌کند.
+        فقط اولین درخواست ردیف پرداخت را دریافت می‌کند؛ بقیه None می‌گیرند و باید نتیجه ذخیره شده را نمایش دهند.
+        claim وضعیت verifying که بیش از stale_seconds از آن گذشته (پروسه از کار افتاده) دوباره قابل برداشت است.
+        """
+        try:
+            with self._get_connection() as conn:
+                with conn.cursor(cursor_factory=DictCursor) as cursor:
+                    cursor.execute("""
+                        UPDATE payments SET verification_state = %s, verification_claimed_at = CURRENT_TIMESTAMP
+                        WHERE authority = %s AND is_confirmed = FALSE
+                          AND (verification_state IS NULL
+                               OR (verification_state = 'verifying'
+                                   AND verification_claimed_at < CURRENT_TIMESTAMP - (%s * INTERVAL '1 second')))
+                        RETURNING *
+                    """, (new_state, authority, stale_seconds))
+                    payment = cursor.fetchone()
+                conn.commit()
+                return payment
+        except psycopg2.Error as e:
+            logger.error(f"Error claiming verification for authority {authority}: {e}")
+            return None
+
+    def finish_payment_verification(self, payment_id: int, state: str, ref_id: str = None, message: str = None):
+        """
+        نتیجه بررسی claim شده را ثبت می‌کند: verified (همراه با تایید پرداخت)، failed یا None برای آزاد کردن claim
+        (مثلاً پس از خطای شبکه تا درخواست بعدی دوباره بررسی کند). فقط اگر claim هنوز در اختیار این درخواست باشد True برمی‌گرداند.
+        """
+        verified = state == 'verified'
+        try:
+            with self._get_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("""
+                        UPDATE payments SET
+                            verification_state = %s, verification_message = %s,
+                            is_confirmed = %s,
+                            ref_id = COALESCE(%s, ref_id),
+                            confirmation_date = CASE WHEN %s THEN CURRENT_TIMESTAMP ELSE confirmation_date END
+                        WHERE id = %s AND verification_state = 'verifying' AND is_confirmed = FALSE
+                    """, (state, message, verified, ref_id, verified, payment_id))
+                    updated = cursor.rowcount
+                conn.commit()
+                return updated > 0
+        except psycopg2.Error as e:
+            logger.error(f"Error finishing verification for payment {payment_id}: {e}")
+            return False
+
+    def complete_payment_verification(self, payment_id: int, ref_id: str, job_payload: dict, max_attempts: int,
+                                      outbound_messages: list = None):
+        """
+        پرداخت آنلاین بررسی شده را verified و تایید می‌کند و کار ساخت سرویس و پیام‌های outbox (با قالب
+        enqueue_outbound_messages) را در همان تراکنش ثبت می‌کند تا پرداخت برداشت شده بدون کار ساخت باقی نماند.
+        خروجی: True، False اگر claim دیگر در اختیار این درخواست نیست و None در صورت خطا (هیچ چیز ثبت نشده است).
+        """
+        try:
+            with self._get_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("""
+                        UPDATE payments SET
+                            verification_state = 'verified', verification_message = NULL, is_confirmed = TRUE,
+                            ref_id = %s, confirmation_date = CURRENT_TIMESTAMP
+                        WHERE id = %s AND verification_state = 'verifying' AND is_confirmed = FALSE
+                    """, (ref_id, payment_id))
+                    if cursor.rowcount == 0:
+                        conn.rollback()
+                        return False
+                    self._insert_provisioning_job(cursor, payment_id, job_payload, max_attempts)
+                    if outbound_messages:
+                        self._insert_outbound_messages(cursor, outbound_messages)
+                conn.commit()
+                return True
+        except psycopg2.Error as e:
+            logger.error(f"Error completing verification for payment {payment_id}: {e}")
+            return None
+
     def add_profile(self, name, description=""):
         try:
             with self._get_connection() as conn:
@@ -774,4 +1578,72 @@ class DatabaseManager:
             return True
         except psycopg2.Error as e:
             logger.error(f"Error updating server inbounds for server {server_id}: {e}")
-            return False
\ No newline at end of file
+            return False
+    # --- Conversation State Store (PostgresStateStore) ---
+    def get_conversation_state(self, namespace: str, state_key: str):
+        """مقدار سریال شده (bytes) یک وضعیت منقضی نشده یا None."""
+        try:
+            with self._get_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("""
+                        SELECT value FROM conversation_states
+                        WHERE namespace = %s AND state_key = %s AND expires_at > CURRENT_TIMESTAMP
+                    """, (namespace, state_key))
+                    row = cursor.fetchone()
+                    return bytes(row[0]) if row else None
+        except psycopg2.Error as e:
+            logger.error(f"Error getting conversation state {namespace}/{state_key}: {e}")
+            return None
+
+    def set_conversation_state(self, namespace: str, state_key: str, value: bytes, ttl_seconds: float):
+        try:
+            with self._get_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("""
+                        INSERT INTO conversation_states (namespace, state_key, value, expires_at)
+                        VALUES (%s, %s, %s, CURRENT_TIMESTAMP + (%s * INTERVAL '1 second'))
+                        ON CONFLICT (namespace, state_key)
+                        DO UPDATE SET value = EXCLUDED.value, expires_at = EXCLUDED.expires_at
+                    """, (namespace, state_key, psycopg2.Binary(value), ttl_seconds))
+                conn.commit()
+                return True
+        except psycopg2.Error as e:
+            logger.error(f"Error saving conversation state {namespace}/{state_key}: {e}")
+            return False
+
+    def delete_conversation_state(self, namespace: str, state_key: str):
+        """وضعیت را حذف می‌کند و در صورت وجود (و منقضی نبودن) مقدار قبلی آن را برمی‌گرداند."""
+        try:
+            with self._get_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("""
+                        DELETE FROM conversation_states WHERE namespace = %s AND state_key = %s
+                        RETURNING value, expires_at > CURRENT_TIMESTAMP
+                    """, (namespace, state_key))
+                    row = cursor.fetchone()
+                conn.commit()
+                return bytes(row[0]) if row and row[1] else None
+        except psycopg2.Error as e:
+            logger.error(f"Error deleting conversation state {namespace}/{state_key}: {e}")
+            return None
+
+    def purge_conversation_states(self, namespace: str, max_entries: int = None) -> int:
+        """وضعیت‌های منقضی شده و (با max_entries) قدیمی‌ترین وضعیت‌های مازاد را حذف و تعداد حذف شده‌ها را برمی‌گرداند."""
+        try:
+            with self._get_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("DELETE FROM conversation_states WHERE namespace = %s AND expires_at <= CURRENT_TIMESTAMP",
+                                   (namespace,))
+                    deleted = cursor.rowcount
+                    if max_entries:
+                        cursor.execute("""
+                            DELETE FROM conversation_states WHERE namespace = %s AND state_key IN (
+                                SELECT state_key FROM conversation_states WHERE namespace = %s
+                                ORDER BY expires_at DESC OFFSET %s)
+                        """, (namespace, namespace, max_entries))
+                        deleted += cursor.rowcount
+                conn.commit()
+                return deleted
+        except psycopg2.Error as e:
+            logger.error(f"Error purging conversation states for {namespace}: {e}")
+            return 0
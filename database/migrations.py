@@ -0,0 +1,253 @@
+# database/migrations.py
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# کلید قفل advisory تا اگر ربات و وب‌هوک همزمان بالا آمدند، مهاجرت‌ها دو بار اجرا نشوند
+MIGRATION_LOCK_KEY = 724_911_001
+
+
+class ConcurrentIndex:
+    """
+    ایندکسی که روی جدول بزرگ و در حال استفاده با CREATE INDEX CONCURRENTLY ساخته می‌شود تا نوشتن روی جدول
+    در طول ساخت قفل نشود. این دستور داخل تراکنش مجاز نیست، پس مهاجرتی که شامل آن باشد در حالت autocommit
+    (هر دستور جداگانه) اجرا می‌شود. ایندکس نامعتبر باقی‌مانده از ساخت نیمه‌کاره قبلی ابتدا حذف می‌شود.
+    """
+    def __init__(self, name: str, definition: str):
+        self.name = name
+        self.definition = definition  # مثلاً "ON payments (user_id)"
+
+
+# لیست مرتب مهاجرت‌ها: (شماره نسخه، توضیح، لیست دستورات SQL یا ConcurrentIndex)
+# هر دستور باید idempotent باشد (IF NOT EXISTS) و نسخه‌ها هرگز نباید تغییر کنند یا حذف شوند؛
+# برای هر تغییر جدید یک نسخه جدید در انتهای لیست اضافه کنید.
+MIGRATIONS = [
+    (1, "Index payments.authority for Zarinpal callbacks", [
+        ConcurrentIndex("idx_payments_authority", "ON payments (authority) WHERE authority IS NOT NULL"),
+    ]),
+    (2, "Index purchases.user_id for 'my services'", [
+        ConcurrentIndex("idx_purchases_user_id", "ON purchases (user_id, id DESC)"),
+    ]),
+    (3, "Partial index for pending payments", [
+        ConcurrentIndex("idx_payments_pending", "ON payments (payment_date) WHERE is_confirmed = FALSE"),
+        ConcurrentIndex("idx_payments_user_id", "ON payments (user_id)"),
+    ]),
+    (4, "Server health columns for the background prober", [
+        "ALTER TABLE servers ADD COLUMN IF NOT EXISTS last_latency_ms INTEGER",
+        "ALTER TABLE servers ADD COLUMN IF NOT EXISTS consecutive_failures INTEGER NOT NULL DEFAULT 0",
+    ]),
+    (5, "Compact inbound metadata snapshot on server_inbounds", [
+        "ALTER TABLE server_inbounds ADD COLUMN IF NOT EXISTS snapshot_json TEXT",
+        "ALTER TABLE server_inbounds ADD COLUMN IF NOT EXISTS snapshot_updated_at TIMESTAMPTZ",
+    ]),
+    (6, "Per-server API connect/read timeouts (NULL = global default)", [
+        "ALTER TABLE servers ADD COLUMN IF NOT EXISTS api_connect_timeout REAL",
+        "ALTER TABLE servers ADD COLUMN IF NOT EXISTS api_read_timeout REAL",
+    ]),
+    (7, "Per-client traffic usage synced from the panels", [
+        """CREATE TABLE IF NOT EXISTS client_usage (
+            xui_client_email TEXT NOT NULL,
+            server_id INTEGER NOT NULL REFERENCES servers(id) ON DELETE CASCADE,
+            up_bytes BIGINT NOT NULL DEFAULT 0,
+            down_bytes BIGINT NOT NULL DEFAULT 0,
+            total_bytes BIGINT NOT NULL DEFAULT 0,
+            expiry_time BIGINT,
+            enable BOOLEAN,
+            updated_at TIMESTAMPTZ NOT NULL,
+            PRIMARY KEY (xui_client_email, server_id)
+        )""",
+        ConcurrentIndex("idx_purchases_xui_client_email", "ON purchases (xui_client_email)"),
+    ]),
+    (8, "Partial index on expire_date of active purchases for the expired-client sweeper", [
+        ConcurrentIndex("idx_purchases_active_expire", "ON purchases (expire_date) WHERE is_active = TRUE"),
+    ]),
+    (9, "Durable provisioning job queue", [
+        """CREATE TABLE IF NOT EXISTS provisioning_jobs (
+            id BIGSERIAL PRIMARY KEY,
+            payment_id INTEGER UNIQUE REFERENCES payments(id) ON DELETE CASCADE,
+            payload_json TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL,
+            run_after TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            locked_at TIMESTAMPTZ,
+            locked_by TEXT,
+            last_error TEXT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMPTZ
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_provisioning_jobs_pending ON provisioning_jobs (run_after) WHERE status = 'pending'",
+        "CREATE INDEX IF NOT EXISTS idx_provisioning_jobs_running ON provisioning_jobs (locked_at) WHERE status = 'running'",
+    ]),
+    (10, "Atomic claim for online payment verification", [
+        "ALTER TABLE payments ADD COLUMN IF NOT EXISTS verification_state TEXT",
+        "ALTER TABLE payments ADD COLUMN IF NOT EXISTS verification_claimed_at TIMESTAMPTZ",
+        "ALTER TABLE payments ADD COLUMN IF NOT EXISTS verification_message TEXT",
+    ]),
+    (11, "NOTIFY on purchase changes for subscription cache invalidation", [
+        """CREATE OR REPLACE FUNCTION notify_purchase_change() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP <> 'INSERT' AND OLD.subscription_id IS NOT NULL THEN
+                PERFORM pg_notify('purchase_changed', OLD.subscription_id);
+            END IF;
+            IF TG_OP <> 'DELETE' AND NEW.subscription_id IS NOT NULL
+               AND (TG_OP = 'INSERT' OR NEW.subscription_id IS DISTINCT FROM OLD.subscription_id) THEN
+                PERFORM pg_notify('purchase_changed', NEW.subscription_id);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql""",
+        "DROP TRIGGER IF EXISTS purchases_notify_change ON purchases",
+        """CREATE TRIGGER purchases_notify_change AFTER INSERT OR UPDATE OR DELETE ON purchases
+        FOR EACH ROW EXECUTE PROCEDURE notify_purchase_change()""",
+    ]),
+    # وضعیت گفتگوی کاربران و ادمین‌ها (PostgresStateStore)؛ داده موقتی است و UNLOGGED بودن نوشتن را ارزان می‌کند
+    (12, "Shared conversation state store", [
+        """CREATE UNLOGGED TABLE IF NOT EXISTS conversation_states (
+            namespace TEXT NOT NULL,
+            state_key TEXT NOT NULL,
+            value BYTEA NOT NULL,
+            expires_at TIMESTAMPTZ NOT NULL,
+            PRIMARY KEY (namespace, state_key)
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_conversation_states_expires ON conversation_states (namespace, expires_at)",
+    ]),
+    (13, "Outbound message outbox", [
+        """CREATE TABLE IF NOT EXISTS outbound_messages (
+            id BIGSERIAL PRIMARY KEY,
+            chat_id BIGINT NOT NULL,
+            method TEXT NOT NULL,
+            payload_json TEXT NOT NULL,
+            attachment BYTEA,
+            priority SMALLINT NOT NULL DEFAULT 2,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            available_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            locked_at TIMESTAMPTZ,
+            last_error TEXT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_outbound_messages_pending ON outbound_messages (priority, id) WHERE status = 'pending'",
+        "CREATE INDEX IF NOT EXISTS idx_outbound_messages_sending ON outbound_messages (locked_at) WHERE status = 'sending'",
+        # OutboxRelay ربات با LISTEN بلافاصله از پیام‌های جدید (مثلاً از وب‌سرور پرداخت) مطلع می‌شود
+        """CREATE OR REPLACE FUNCTION notify_outbound_message() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('outbound_message', '');
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql""",
+        "DROP TRIGGER IF EXISTS outbound_messages_notify ON outbound_messages",
+        """CREATE TRIGGER outbound_messages_notify AFTER INSERT ON outbound_messages
+        FOR EACH STATEMENT EXECUTE PROCEDURE notify_outbound_message()""",
+    ]),
+    (14, "Resumable admin broadcasts and blocked users", [
+        # زمان آخرین پاسخ 403 تلگرام (ربات بلاک شده یا حساب غیرفعال)؛ با فعالیت دوباره کاربر پاک می‌شود
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS blocked_at TIMESTAMPTZ",
+        """CREATE TABLE IF NOT EXISTS broadcasts (
+            id SERIAL PRIMARY KEY,
+            admin_telegram_id BIGINT NOT NULL,
+            message_text TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            total_count INTEGER NOT NULL DEFAULT 0,
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            sent_count INTEGER NOT NULL DEFAULT 0,
+            failed_count INTEGER NOT NULL DEFAULT 0,
+            blocked_count INTEGER NOT NULL DEFAULT 0,
+            progress_message_id BIGINT,
+            heartbeat_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMPTZ
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_broadcasts_running ON broadcasts (heartbeat_at) WHERE status = 'running'",
+    ]),
+    # پیمایش keyset خریدهای فعال در ExpiredClientCollector بدون عبور از خریدهای غیرفعال شده
+    (15, "Partial index on ids of active purchases", [
+        ConcurrentIndex("idx_purchases_active_id", "ON purchases (id) WHERE is_active = TRUE"),
+    ]),
+    # برداشتن پیام‌های صف به ترتیب هر چت: بررسی پیام‌های قدیمی‌تر در حال ارسال یا به تعویق افتاده همان چت
+    (16, "Per-chat index on outbound messages", [
+        "CREATE INDEX IF NOT EXISTS idx_outbound_messages_chat ON outbound_messages (chat_id, id) WHERE status <> 'failed'",
+    ]),
+]
+
+
+def _ensure_version_table(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+        )""")
+
+
+def get_current_version(cursor) -> int:
+    cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    return cursor.fetchone()[0]
+
+
+def _create_concurrent_index(cursor, index: ConcurrentIndex):
+    cursor.execute("""
+        SELECT NOT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = %s AND pg_catalog.pg_table_is_visible(c.oid)
+    """, (index.name,))
+    row = cursor.fetchone()
+    if row and row[0]:
+        logger.warning(f"Dropping invalid index {index.name} left by an interrupted build.")
+        cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {index.name}")
+    cursor.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {index.name} {index.definition}")
+
+
+def _apply_non_transactional(conn, version, description, statements) -> bool:
+    """
+    مهاجرت شامل ConcurrentIndex را در حالت autocommit اجرا می‌کند و قفل advisory را در سطح session می‌گیرد.
+    دستورات idempotent هستند، پس اجرای نیمه‌کاره در شروع بعدی از ابتدا تکرار می‌شود.
+    """
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_KEY,))
+            try:
+                if version <= get_current_version(cursor):
+                    return False
+                logger.info(f"Applying migration {version} (non-transactional): {description}")
+                for statement in statements:
+                    if isinstance(statement, ConcurrentIndex):
+                        _create_concurrent_index(cursor, statement)
+                    else:
+                        cursor.execute(statement)
+                cursor.execute("INSERT INTO schema_version (version, description) VALUES (%s, %s)", (version, description))
+                return True
+            finally:
+                cursor.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_KEY,))
+    finally:
+        conn.autocommit = False
+
+
+def apply_migrations(conn) -> int:
+    """
+    مهاجرت‌های اجرا نشده را به ترتیب، هر کدام در یک تراکنش جداگانه اجرا می‌کند؛ مهاجرت‌های شامل
+    ConcurrentIndex بدون تراکنش (autocommit) اجرا می‌شوند. تعداد مهاجرت‌های اعمال شده را برمی‌گرداند.
+    """
+    with conn.cursor() as cursor:
+        _ensure_version_table(cursor)
+    conn.commit()
+
+    applied = 0
+    for version, description, statements in sorted(MIGRATIONS, key=lambda m: m[0]):
+        if any(isinstance(statement, ConcurrentIndex) for statement in statements):
+            applied += _apply_non_transactional(conn, version, description, statements)
+            continue
+        with conn.cursor() as cursor:
+            # قفل تا پایان تراکنش نگه داشته می‌شود
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_KEY,))
+            if version <= get_current_version(cursor):
+                conn.rollback()
+                continue
+            logger.info(f"Applying migration {version}: {description}")
+            for statement in statements:
+                cursor.execute(statement)
+            cursor.execute("INSERT INTO schema_version (version, description) VALUES (%s, %s)", (version, description))
+        conn.commit()
+        applied += 1
+    return applied
@@ -0,0 +1,83 @@
+# database/user_activity.py
+
+import datetime
+import logging
+import threading
+
+from psycopg2.extras import execute_values
+
+logger = logging.getLogger(__name__)
+
+
+class UserActivityBuffer:
+    """
+    به‌روزرسانی‌های last_activity و پروفایل کاربران را در حافظه جمع (coalesce) می‌کند
+    و در بازه‌های زمانی مشخص با یک دستور execute_values در دیتابیس می‌نویسد.
+    برای هر telegram_id فقط آخرین وضعیت نگه داشته می‌شود.
+    """
+    FLUSH_SQL = """
+        INSERT INTO users (telegram_id, first_name, last_name, username, last_activity)
+        VALUES %s
+        ON CONFLICT (telegram_id) DO UPDATE SET
+            first_name = EXCLUDED.first_name,
+            last_name = EXCLUDED.last_name,
+            username = EXCLUDED.username,
+            last_activity = GREATEST(users.last_activity, EXCLUDED.last_activity),
+            blocked_at = CASE WHEN EXCLUDED.last_activity > users.blocked_at THEN NULL ELSE users.blocked_at END
+    """
+
+    def __init__(self, db_manager, flush_interval_seconds: float, max_pending: int = 5000):
+        self._db_manager = db_manager
+        self.flush_interval_seconds = flush_interval_seconds
+        self.max_pending = max_pending
+        self._pending = {}  # telegram_id -> (first_name, last_name, username, last_activity)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="user-activity-flusher", daemon=True)
+        self._thread.start()
+
+    def record(self, telegram_id, first_name, last_name=None, username=None):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        with self._lock:
+            self._pending[telegram_id] = (first_name, last_name, username, now)
+            should_flush_now = len(self._pending) >= self.max_pending
+        if should_flush_now:
+            self._wakeup.set()
+
+    def flush(self):
+        """تمام تغییرات در انتظار را در یک batch ذخیره می‌کند. تعداد ردیف‌ها را برمی‌گرداند."""
+        with self._lock:
+            if not self._pending:
+                return 0
+            batch, self._pending = self._pending, {}
+        rows = [(tg_id, *values) for tg_id, values in batch.items()]
+        try:
+            with self._db_manager._get_connection() as conn:
+                with conn.cursor() as cursor:
+                    execute_values(cursor, self.FLUSH_SQL, rows, page_size=500)
+                conn.commit()
+            return len(rows)
+        except Exception as e:
+            logger.error(f"Error flushing {len(rows)} buffered user activity rows: {e}")
+            # برگرداندن به صف، بدون بازنویسی مقادیر جدیدتر
+            with self._lock:
+                for tg_id, values in batch.items():
+                    self._pending.setdefault(tg_id, values)
+            return 0
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.flush_interval_seconds)
+            self._wakeup.clear()
+            self.flush()
+
+    def close(self):
+        self._stopped = True
+        self._wakeup.set()
+        self._thread.join(timeout=5)
+        self.flush()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pending)
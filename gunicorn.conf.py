@@ -0,0 +1,44 @@
+# gunicorn.conf.py
+# اجرای production وب‌سرور پرداخت و سابسکریپشن:
+#   gunicorn -c gunicorn.conf.py webhook_server:app
+# بارگذاری دوباره تدریجی workerها (بدون قطع درخواست‌های در حال اجرا): kill -HUP <master pid>
+# با preload_app کد برنامه در master بارگذاری شده است؛ برای اعمال کد جدید سرویس باید restart شود.
+
+import multiprocessing
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from config import (WEBHOOK_BIND, WEBHOOK_WORKERS, WEBHOOK_THREADS, WEBHOOK_KEEPALIVE_SECONDS, WEBHOOK_TIMEOUT_SECONDS,
+                    WEBHOOK_GRACEFUL_TIMEOUT_SECONDS, WEBHOOK_MAX_REQUESTS)
+
+bind = WEBHOOK_BIND
+# هر worker یک Pool دیتابیس و یک اتصال LISTEN دارد؛ کار اصلی انتظار برای درگاه است که نخ‌ها انجام می‌دهند،
+# پس به ازای هر هسته یک worker کافی است و تعداد اتصالات دیتابیس زیر max_connections پیش‌فرض می‌ماند
+workers = WEBHOOK_WORKERS if WEBHOOK_WORKERS > 0 else multiprocessing.cpu_count()
+# worker نوع sync از keep-alive پشتیبانی نمی‌کند؛ gthread هم keep-alive و هم انتظار همزمان برای درگاه را ممکن می‌کند
+worker_class = 'gthread'
+threads = WEBHOOK_THREADS
+keepalive = WEBHOOK_KEEPALIVE_SECONDS
+timeout = WEBHOOK_TIMEOUT_SECONDS
+graceful_timeout = WEBHOOK_GRACEFUL_TIMEOUT_SECONDS
+max_requests = WEBHOOK_MAX_REQUESTS
+max_requests_jitter = max(1, WEBHOOK_MAX_REQUESTS // 10) if WEBHOOK_MAX_REQUESTS > 0 else 0
+
+# کد برنامه و مهاجرت‌های دیتابیس یک بار در master اجرا می‌شوند و workerها با copy-on-write از آن fork می‌شوند
+preload_app = True
+accesslog = None
+errorlog = '-'
+loglevel = 'info'
+
+
+def post_fork(server, worker):
+    # Pool دیتابیس و نخ‌های پس‌زمینه پس از fork و جداگانه برای هر worker ساخته می‌شوند
+    import webhook_server
+    webhook_server.init_worker()
+
+
+def worker_exit(server, worker):
+    import webhook_server
+    webhook_server.shutdown_worker()
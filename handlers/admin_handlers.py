@@ -7,13 +7,18 @@ import datetime
 import json
 import os
 import zipfile
-from config import ADMIN_IDS, SUPPORT_CHANNEL_LINK , WEBHOOK_DOMAIN
+from config import ADMIN_IDS, SUPPORT_CHANNEL_LINK
 from database.db_manager import DatabaseManager
-from api_client.xui_api_client import XuiAPIClient
+from api_client.xui_api_client import XuiAPIClient, INBOUND_SUMMARY_FIELDS
+from api_client import client_registry
 from utils import messages, helpers
 from keyboards import inline_keyboards
-from utils.config_generator import ConfigGenerator
-from utils.bot_helpers import send_subscription_info # این ایمپورت جدید است
+from utils.config_generator import ConfigGenerator, build_inbound_snapshot
+from utils.server_health import ServerHealthChecker
+from utils.client_gc import ExpiredClientCollector
+from utils.reconciler import DriftReconciler
+from utils.provisioning import approve_payment_and_enqueue
+from utils.state_store import create_state_store
 logger = logging.getLogger(__name__)
 
 # ماژول‌های سراسری
@@ -21,12 +26,15 @@ _bot: telebot.TeleBot = None
 _db_manager: DatabaseManager = None
 _xui_api: XuiAPIClient = None
 _config_generator: ConfigGenerator = None
-_admin_states = {}
+_admin_states = None # StateStore
+_broadcast_engine = None
 
-def register_admin_handlers(bot_instance, db_manager_instance, xui_api_instance):
-    global _bot, _db_manager, _xui_api, _config_generator
+def register_admin_handlers(bot_instance, db_manager_instance, xui_api_instance, broadcast_engine=None):
+    global _bot, _db_manager, _xui_api, _config_generator, _admin_states, _broadcast_engine
+    _broadcast_engine = broadcast_engine
     _bot = bot_instance
     _db_manager = db_manager_instance
+    _admin_states = create_state_store('admin', _db_manager)
     _xui_api = xui_api_instance
     _config_generator = ConfigGenerator(xui_api_instance, db_manager_instance)
 
@@ -35,9 +43,8 @@ def register_admin_handlers(bot_instance, db_manager_instance, xui_api_instance)
     # =============================================================================
 
     def _clear_admin_state(admin_id):
-        """وضعیت ادمین را فقط از دیکشنری پاک می‌کند."""
-        if admin_id in _admin_states:
-            del _admin_states[admin_id]
+        """وضعیت ادمین را فقط از state store پاک می‌کند."""
+        _admin_states.pop(admin_id, None)
 
     def _show_menu(user_id, text, markup, message=None):
         try:
@@ -126,18 +133,76 @@ def register_admin_handlers(bot_instance, db_manager_instance, xui_api_instance)
 
     def test_all_servers(admin_id, message):
         _bot.edit_message_text(messages.TESTING_ALL_SERVERS, admin_id, message.message_id, reply_markup=None)
-        servers = _db_manager.get_all_servers()
-        if not servers:
+        # تمام سرورها به صورت موازی بررسی و نتیجه یکجا در دیتابیس ثبت می‌شود
+        results = ServerHealthChecker(_db_manager, _xui_api).run_once()
+        if not results:
             _bot.send_message(admin_id, messages.NO_SERVERS_FOUND); _show_server_management_menu(admin_id); return
-        results = []
-        for s in servers:
-            temp_xui_client = _xui_api(panel_url=s['panel_url'], username=s['username'], password=s['password'])
-            is_online = temp_xui_client.login()
-            _db_manager.update_server_status(s['id'], is_online, datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-            results.append(f"{'✅' if is_online else '❌'} {helpers.escape_markdown_v1(s['name'])}")
-        _bot.send_message(admin_id, messages.TEST_RESULTS_HEADER + "\n".join(results), parse_mode='Markdown')
+        lines = [f"{'✅' if is_ok else '❌'} {helpers.escape_markdown_v1(s['name'])} ({latency_ms}ms)" for s, is_ok, latency_ms in results]
+        _bot.send_message(admin_id, messages.TEST_RESULTS_HEADER + "\n".join(lines), parse_mode='Markdown')
         _show_server_management_menu(admin_id)
 
+    def show_dashboard(admin_id, message):
+        dispatcher_stats = _bot.dispatcher.stats() if hasattr(_bot, 'dispatcher') else {}
+        pool_stats = _db_manager.get_pool_stats()
+        job_stats = _db_manager.get_provisioning_job_stats()
+        processed = dispatcher_stats.get('processed', 0)
+        text = messages.ADMIN_DASHBOARD_TEXT.format(
+            workers=dispatcher_stats.get('workers', '-'), queue_size=dispatcher_stats.get('queue_size', '-'),
+            queued=dispatcher_stats.get('queued', 0), max_queue_depth=dispatcher_stats.get('max_queue_depth', 0),
+            processed=processed, errors=dispatcher_stats.get('errors', 0), rejected=dispatcher_stats.get('rejected', 0),
+            avg_ms=round(dispatcher_stats.get('busy_seconds', 0) * 1000 / processed) if processed else 0,
+            db_in_use=pool_stats['in_use'], db_idle=pool_stats['idle'], db_max_size=pool_stats['max_size'],
+            db_waits=pool_stats['waits'], db_timeouts=pool_stats['timeouts'],
+            jobs_pending=job_stats.get('pending', 0), jobs_running=job_stats.get('running', 0), jobs_dead=job_stats.get('dead', 0),
+        )
+        _show_menu(admin_id, text, inline_keyboards.get_back_button("admin_main_menu"), message)
+
+    def preview_client_gc(admin_id, message):
+        _bot.edit_message_text(messages.CLIENT_GC_RUNNING, admin_id, message.message_id, reply_markup=None)
+        report = ExpiredClientCollector(_db_manager, _xui_api).run_once(dry_run=True)
+        if report['busy']:
+            _show_menu(admin_id, messages.CLIENT_GC_BUSY, inline_keyboards.get_back_button("admin_server_management"), message); return
+        if not report['purchases']:
+            _show_menu(admin_id, messages.CLIENT_GC_NOTHING_TO_DO, inline_keyboards.get_back_button("admin_server_management"), message); return
+        server_lines = []
+        for server_id, count in report['clients_by_server'].most_common():
+            server = _db_manager.get_server_by_id(server_id)
+            server_name = helpers.escape_markdown_v1(server['name']) if server else f"#{server_id}"
+            server_lines.append(f"▫️ {server_name}: {count}")
+        text = messages.CLIENT_GC_DRY_RUN_REPORT.format(
+            purchases=report['purchases'], expired=report['by_reason'].get('expired', 0),
+            exhausted=report['by_reason'].get('exhausted', 0), servers="\n".join(server_lines) or "-"
+        )
+        _show_menu(admin_id, text, inline_keyboards.get_client_gc_confirmation_menu(), message)
+
+    def run_client_gc(admin_id, message):
+        _bot.edit_message_text(messages.CLIENT_GC_RUNNING, admin_id, message.message_id, reply_markup=None)
+        report = ExpiredClientCollector(_db_manager, _xui_api).run_once()
+        text = messages.CLIENT_GC_BUSY if report['busy'] else messages.CLIENT_GC_DONE_REPORT.format(
+            deactivated=report['deactivated'], skipped=report['skipped'])
+        _show_menu(admin_id, text, inline_keyboards.get_back_button("admin_server_management"), message)
+
+    def _run_reconcile(admin_id, message, fix):
+        _bot.edit_message_text(messages.RECONCILE_RUNNING, admin_id, message.message_id, reply_markup=None)
+        results = DriftReconciler(_db_manager, _xui_api).run_once(fix=fix)
+        if not results:
+            _show_menu(admin_id, messages.NO_SERVERS_FOUND, inline_keyboards.get_back_button("admin_server_management"), message); return
+        text = messages.RECONCILE_FIX_REPORT_HEADER if fix else messages.RECONCILE_REPORT_HEADER
+        for server, report in results:
+            server_name = helpers.escape_markdown_v1(server['name'])
+            if report is None:
+                text += messages.RECONCILE_SERVER_UNREACHABLE.format(server_name=server_name); continue
+            counts = report['counts']
+            text += messages.RECONCILE_SERVER_LINE.format(
+                server_name=server_name, purchases=counts['purchases'], panel_clients=report['panel_clients'],
+                missing=counts['missing'], orphaned=counts['orphaned'], mismatched=counts['mismatched'], fixed=counts['fixed'])
+        text += messages.RECONCILE_ORPHAN_NOTE
+        markup = inline_keyboards.get_back_button("admin_server_management") if fix else inline_keyboards.get_reconcile_confirmation_menu()
+        _show_menu(admin_id, text, markup, message)
+
+    def preview_reconcile(admin_id, message): _run_reconcile(admin_id, message, fix=False)
+    def run_reconcile_fix(admin_id, message): _run_reconcile(admin_id, message, fix=True)
+
     # =============================================================================
     # SECTION: Stateful Process Handlers
     # =============================================================================
@@ -243,10 +308,21 @@ def register_admin_handlers(bot_instance, db_manager_instance, xui_api_instance)
                 _bot.edit_message_text(f"⚠️ خطایی رخ داد! پروفایلی با نام **{profile_name}** از قبل وجود دارد. لطفاً نام دیگری انتخاب کنید.", admin_id, prompt_id, parse_mode='Markdown')
         # ------------------
             
+        elif state == 'waiting_for_broadcast_text':
+            data['text'] = text; state_info['state'] = 'confirming_broadcast'
+            try: _bot.delete_message(admin_id, message.message_id)
+            except Exception: pass
+            confirm_text = messages.BROADCAST_CONFIRM.format(text=text, count=_db_manager.count_broadcast_recipients())
+            _bot.edit_message_text(confirm_text, admin_id, prompt_id, reply_markup=inline_keyboards.get_confirmation_menu("admin_broadcast_confirm", "admin_main_menu"))
+
         # --- Inbound Flow ---
         elif state == 'waiting_for_server_id_for_inbounds':
             process_manage_inbounds_flow(admin_id, message)
 
+        # state_info و data در همین دیکشنری تغییر کرده‌اند و باید دوباره ذخیره شوند (اگر فرآیند پایان نیافته باشد)
+        if state_info.get('state') != state:
+            _admin_states[admin_id] = state_info
+
         
     # =============================================================================
     # SECTION: Process Starters and Callback Handlers
@@ -302,6 +378,7 @@ def register_admin_handlers(bot_instance, db_manager_instance, xui_api_instance)
             state_info['state'] = 'waiting_for_per_gb_price'
             _bot.edit_message_text(messages.ADD_PLAN_PROMPT_PER_GB_PRICE, admin_id, message.message_id)
         state_info['prompt_message_id'] = message.message_id
+        _admin_states[admin_id] = state_info
 
     # ... other functions remain the same ...
 
@@ -352,11 +429,18 @@ def register_admin_handlers(bot_instance, db_manager_instance, xui_api_instance)
             "admin_toggle_gateway_status": start_toggle_gateway_status_flow,
             "admin_list_servers": list_all_servers,
             "admin_test_all_servers": test_all_servers,
+            "admin_client_gc_preview": preview_client_gc,
+            "admin_client_gc_run": run_client_gc,
+            "admin_reconcile_preview": preview_reconcile,
+            "admin_reconcile_fix": run_reconcile_fix,
             "admin_list_plans": list_plans_action,
             "admin_list_gateways": list_gateways_action,
             "admin_list_users": list_all_users,
             "admin_manage_inbounds": start_manage_inbounds_flow,
             "admin_create_backup": create_backup,
+            "admin_dashboard": show_dashboard,
+            "admin_broadcast": start_broadcast_flow,
+            "admin_broadcast_confirm": confirm_broadcast,
             "admin_add_profile": start_add_profile_flow, # <-- اضافه شده
             "admin_list_profiles": list_profiles_for_management, # <-- اضافه شده
         }
@@ -384,6 +468,7 @@ def register_admin_handlers(bot_instance, db_manager_instance, xui_api_instance)
             parts = data.split('_'); profile_id, db_inbound_id = int(parts[-2]), int(parts[-1])
             handle_toggle_profile_inbound(call, profile_id, db_inbound_id)
         elif data.startswith("admin_profile_save_inbounds_"): save_profile_inbounds(call, int(data.split('_')[-1]))
+        elif data.startswith("admin_broadcast_cancel_"): cancel_broadcast(admin_id, message, int(data.split('_')[-1]))
         else: _bot.edit_message_text(messages.UNDER_CONSTRUCTION, admin_id, message.message_id, reply_markup=inline_keyboards.get_back_button("admin_main_menu"))
     @_bot.message_handler(func=lambda msg: helpers.is_admin(msg.from_user.id) and _admin_states.get(msg.from_user.id))
     def handle_admin_stateful_messages(message):
@@ -417,6 +502,7 @@ def register_admin_handlers(bot_instance, db_manager_instance, xui_api_instance)
         
         server = _db_manager.get_server_by_id(server_id)
         if server and _db_manager.delete_server(server_id):
+            client_registry.evict(server_id)
             _bot.edit_message_text(messages.SERVER_DELETED_SUCCESS.format(server_name=server['name']), admin_id, message.message_id, reply_markup=inline_keyboards.get_back_button("admin_server_management"))
         else:
             _bot.edit_message_text(messages.SERVER_DELETED_ERROR, admin_id, message.message_id, reply_markup=inline_keyboards.get_back_button("admin_server_management"))
@@ -477,6 +563,15 @@ def register_admin_handlers(bot_instance, db_manager_instance, xui_api_instance)
     # SECTION: Process-Specific Helper Functions
     # =============================================================================
 
+    def _save_inbound_snapshots(server_id, panel_inbounds):
+        """snapshot فشرده اینباندها را هنگام همگام‌سازی توسط ادمین به‌روز می‌کند."""
+        try:
+            snapshots = {p_in['id']: build_inbound_snapshot(p_in) for p_in in panel_inbounds}
+        except (ValueError, TypeError, AttributeError) as e:
+            logger.error(f"Error building inbound snapshots for server {server_id}: {e}")
+            return
+        _db_manager.update_inbound_snapshots(server_id, snapshots)
+
     def _generate_server_list_text():
         servers = _db_manager.get_all_servers(only_active=False) # همه سرورها را نشان می‌دهیم
         if not servers: return messages.NO_SERVERS_FOUND
@@ -509,14 +604,15 @@ def register_admin_handlers(bot_instance, db_manager_instance, xui_api_instance)
             _bot.edit_message_text(f"{messages.SERVER_NOT_FOUND}\n\n{messages.SELECT_SERVER_FOR_INBOUNDS_PROMPT}", admin_id, prompt_id, parse_mode='Markdown'); return
         server_id = int(server_id_str)
         _bot.edit_message_text(messages.FETCHING_INBOUNDS, admin_id, prompt_id)
-        temp_xui_client = _xui_api(panel_url=server_data['panel_url'], username=server_data['username'], password=server_data['password'])
-        panel_inbounds = temp_xui_client.list_inbounds()
+        xui_client = client_registry.get_client_for_server(server_data, _xui_api)
+        panel_inbounds = xui_client.list_inbounds(fields=INBOUND_SUMMARY_FIELDS)
         if not panel_inbounds:
             _bot.edit_message_text(messages.NO_INBOUNDS_FOUND_ON_PANEL, admin_id, prompt_id, reply_markup=inline_keyboards.get_back_button("admin_server_management"))
             _clear_admin_state(admin_id); return
         active_db_inbound_ids = [i['inbound_id'] for i in _db_manager.get_server_inbounds(server_id, only_active=True)]
         state_info['state'] = f'selecting_inbounds_for_{server_id}'
         state_info['data'] = {'panel_inbounds': panel_inbounds, 'selected_inbound_ids': active_db_inbound_ids}
+        _admin_states[admin_id] = state_info
         markup = inline_keyboards.get_inbound_selection_menu(server_id, panel_inbounds, active_db_inbound_ids)
         _bot.edit_message_text(messages.SELECT_INBOUNDS_TO_ACTIVATE.format(server_name=server_data['name']), admin_id, prompt_id, reply_markup=markup, parse_mode='Markdown')
 
@@ -569,6 +665,7 @@ def register_admin_handlers(bot_instance, db_manager_instance, xui_api_instance)
         
         # به‌روزرسانی state و کیبورد
         state_info['data']['selected_inbound_ids'] = selected_ids
+        _admin_states[admin_id] = state_info
         markup = inline_keyboards.get_inbound_selection_menu(server_id, panel_inbounds, selected_ids)
         
         try:
@@ -578,7 +675,6 @@ def register_admin_handlers(bot_instance, db_manager_instance, xui_api_instance)
                 logger.warning(f"Error updating inbound selection keyboard: {e}")
 
     def process_payment_approval(admin_id, payment_id, message):
-        _bot.edit_message_caption("⏳ در حال ساخت و فعال‌سازی سرویس...", message.chat.id, message.message_id)
         payment = _db_manager.get_payment_by_id(payment_id)
         if not payment or payment['is_confirmed']:
             _bot.answer_callback_query(message.id, "این پرداخت قبلاً پردازش شده است.", show_alert=True)
@@ -586,80 +682,24 @@ def register_admin_handlers(bot_instance, db_manager_instance, xui_api_instance)
 
         order_details = json.loads(payment['order_details_json'])
         user_telegram_id = order_details['user_telegram_id']
-        user_db_info = _db_manager.get_user_by_id(payment['user_id'])
-        
-        purchase_type = order_details.get('purchase_type')
-        plan_type = order_details.get('plan_type')
-
-        total_gb, duration_days, plan_id = 0, 0, None
-        if plan_type == 'fixed_monthly':
-            plan = order_details.get('plan_details')
-            if plan:
-                total_gb, duration_days, plan_id = plan.get('volume_gb'), plan.get('duration_days'), plan.get('id')
-        elif plan_type == 'gigabyte_based':
-            gb_plan = order_details.get('gb_plan_details')
-            gb_plan = gb_plan[0] if isinstance(gb_plan, list) and gb_plan else gb_plan
-            if gb_plan and isinstance(gb_plan, dict):
-                total_gb = order_details.get('requested_gb')
-                duration_days = gb_plan.get('duration_days', 0)
-                plan_id = gb_plan.get('id')
-
-        # --- FIX: Unpack returned values correctly ---
-        webhook_sub_id, full_configs, client_details = None, None, None
-        server_id, profile_id = None, None
-
-        if purchase_type == 'profile':
-            profile_id = order_details.get('profile_id')
-            if profile_id:
-                webhook_sub_id, full_configs, client_details = _config_generator.create_subscription_for_profile(
-                    user_telegram_id, profile_id, total_gb, duration_days
-                )
-        else:
-            server_id = order_details.get('server_id')
-            if server_id:
-                webhook_sub_id, full_configs, client_details = _config_generator.create_subscription_for_server(
-                    user_telegram_id, server_id, total_gb, duration_days
-                )
 
-        if not webhook_sub_id or not full_configs or not client_details:
-            _bot.edit_message_caption("❌ خطا در ساخت کانفیگ‌ها در پنل X-UI.", message.chat.id, message.message_id)
+        # ساخت سرویس در صف پایدار انجام می‌شود تا یک پنل کند، نخ ربات را مسدود نکند؛
+        # worker پس از پایان کار، اطلاعات سرویس را برای کاربر می‌فرستد
+        job_id = approve_payment_and_enqueue(_db_manager, payment_id, admin_id, user_telegram_id)
+        if job_id is False:
+            _bot.send_message(admin_id, messages.ADMIN_PAYMENT_ALREADY_PROCESSED.format(payment_id=payment_id))
             return
-        
-        expire_date = (datetime.datetime.now() + datetime.timedelta(days=duration_days)) if duration_days and duration_days > 0 else None
-        
-        # --- FIX: Pass the correct IDs to the database manager ---
-        purchase_id = _db_manager.add_purchase(
-            user_id=user_db_info['id'], 
-            purchase_type=purchase_type, 
-            server_id=server_id,
-            profile_id=profile_id, 
-            plan_id=plan_id,
-            expire_date=expire_date.strftime("%Y-%m-%d %H:%M:%S") if expire_date else None,
-            initial_volume_gb=total_gb, 
-            subscription_id=webhook_sub_id,  # This is for the webhook URL
-            full_configs_json=json.dumps(full_configs),
-            xui_client_uuid=client_details.get('uuid'),
-            xui_client_email=client_details.get('email'),
-            single_configs_json=json.dumps(full_configs) # Legacy column, filled for compatibility
-        )
-
-        if not purchase_id:
-            _bot.edit_message_caption("❌ خطا در ذخیره خرید در دیتابیس.", message.chat.id, message.message_id)
+        if not job_id:
+            _bot.send_message(admin_id, messages.ADMIN_PAYMENT_APPROVAL_FAILED.format(payment_id=payment_id))
             return
-            
-        _db_manager.update_payment_status(payment_id, True, admin_id)
-        
-        final_sub_link = f"https://{WEBHOOK_DOMAIN}/sub/{webhook_sub_id}"
-        
+
         admin_user = _bot.get_chat_member(admin_id, admin_id).user
         admin_username_display = f"@{admin_user.username}" if admin_user.username else admin_user.first_name
-        new_caption = message.caption + "\n\n" + messages.ADMIN_PAYMENT_CONFIRMED_DISPLAY.format(admin_username=admin_username_display)
-        
+        new_caption = message.caption + "\n\n" + messages.ADMIN_PAYMENT_CONFIRMED_DISPLAY.format(admin_username=admin_username_display) + \
+            "\n" + messages.ADMIN_PROVISIONING_QUEUED
+
         _bot.edit_message_caption(new_caption, message.chat.id, message.message_id, parse_mode='Markdown')
-        _bot.send_message(user_telegram_id, "✅ پرداخت شما با موفقیت تایید و سرویس شما فعال گردید.")
-        
-        # The bot_helpers function will handle sending the link and QR code
-        send_subscription_info(_bot, user_telegram_id, final_sub_link)
+        _bot.send_message(user_telegram_id, messages.PROVISIONING_QUEUED_USER)
 
     def process_payment_rejection(admin_id, payment_id, message):
         payment = _db_manager.get_payment_by_id(payment_id)
@@ -685,6 +725,7 @@ def register_admin_handlers(bot_instance, db_manager_instance, xui_api_instance)
         
         # ابتدا اطلاعات در دیتابیس ذخیره می‌شود
         if _db_manager.update_server_inbounds(server_id, inbounds_to_save):
+            _save_inbound_snapshots(server_id, panel_inbounds)
             msg = messages.INBOUND_CONFIG_SUCCESS
         else:
             msg = messages.INBOUND_CONFIG_FAILED
@@ -731,8 +772,8 @@ def register_admin_handlers(bot_instance, db_manager_instance, xui_api_instance)
         server_id = int(server_id_str)
         _bot.edit_message_text(messages.FETCHING_INBOUNDS, admin_id, prompt_id)
         
-        temp_xui_client = _xui_api(panel_url=server_data['panel_url'], username=server_data['username'], password=server_data['password'])
-        panel_inbounds = temp_xui_client.list_inbounds()
+        xui_client = client_registry.get_client_for_server(server_data, _xui_api)
+        panel_inbounds = xui_client.list_inbounds(fields=INBOUND_SUMMARY_FIELDS)
 
         if not panel_inbounds:
             _bot.edit_message_text(messages.NO_INBOUNDS_FOUND_ON_PANEL, admin_id, prompt_id, reply_markup=inline_keyboards.get_back_button("admin_server_management"))
@@ -743,6 +784,7 @@ def register_admin_handlers(bot_instance, db_manager_instance, xui_api_instance)
         
         state_info['state'] = f'selecting_inbounds_for_{server_id}'
         state_info['data'] = {'panel_inbounds': panel_inbounds, 'selected_inbound_ids': active_db_inbound_ids}
+        _admin_states[admin_id] = state_info
         
         markup = inline_keyboards.get_inbound_selection_menu(server_id, panel_inbounds, active_db_inbound_ids)
         _bot.edit_message_text(messages.SELECT_INBOUNDS_TO_ACTIVATE.format(server_name=server_data['name']), admin_id, prompt_id, reply_markup=markup, parse_mode='Markdown')
@@ -754,7 +796,11 @@ def register_admin_handlers(bot_instance, db_manager_instance, xui_api_instance)
         panel_inbounds = _admin_states.get(admin_id, {}).get('data', {}).get('panel_inbounds', [])
         inbounds_to_save = [{'id': p_in['id'], 'remark': p_in.get('remark', '')} for p_in in panel_inbounds if p_in['id'] in selected_ids]
         
-        msg = messages.INBOUND_CONFIG_SUCCESS if _db_manager.update_server_inbounds(server_id, inbounds_to_save) else messages.INBOUND_CONFIG_FAILED
+        if _db_manager.update_server_inbounds(server_id, inbounds_to_save):
+            _save_inbound_snapshots(server_id, panel_inbounds)
+            msg = messages.INBOUND_CONFIG_SUCCESS
+        else:
+            msg = messages.INBOUND_CONFIG_FAILED
         _bot.edit_message_text(msg.format(server_name=server_data['name']), admin_id, message.message_id, reply_markup=inline_keyboards.get_back_button("admin_server_management"))
             
         _clear_admin_state(admin_id)
@@ -795,6 +841,7 @@ def register_admin_handlers(bot_instance, db_manager_instance, xui_api_instance)
             return
         
         state_info['data']['selected_inbound_ids'] = list(set(selected_ids))
+        _admin_states[admin_id] = state_info
         markup = inline_keyboards.get_inbound_selection_menu(server_id, panel_inbounds, selected_ids)
         
         try:
@@ -850,6 +897,7 @@ def register_admin_handlers(bot_instance, db_manager_instance, xui_api_instance)
         elif gateway_type == 'card_to_card':
             state_info['state'] = 'waiting_for_card_number'
             _bot.edit_message_text(messages.ADD_GATEWAY_PROMPT_CARD_NUMBER, admin_id, message.message_id)
+        _admin_states[admin_id] = state_info
             
             
             
@@ -859,6 +907,25 @@ def register_admin_handlers(bot_instance, db_manager_instance, xui_api_instance)
         """منوی اصلی بخش مدیریت پروفایل‌ها را نمایش می‌دهد."""
         _show_menu(admin_id, "🧬 **مدیریت پروفایل‌ها**\n\nاز این بخش می‌توانید پروفایل‌های ترکیبی را تعریف و مدیریت کنید.", inline_keyboards.get_profile_management_menu(), message)
 
+    def start_broadcast_flow(admin_id, message):
+        _clear_admin_state(admin_id)
+        _admin_states[admin_id] = {'state': 'waiting_for_broadcast_text', 'data': {}, 'prompt_message_id': message.message_id}
+        _bot.edit_message_text(messages.BROADCAST_PROMPT, admin_id, message.message_id, reply_markup=inline_keyboards.get_back_button("admin_main_menu"))
+
+    def confirm_broadcast(admin_id, message):
+        """ارسال همگانی را ثبت می‌کند؛ همین پیام از این پس پیشرفت ارسال را نشان می‌دهد."""
+        state_info = _admin_states.get(admin_id)
+        if not state_info or state_info.get('state') != 'confirming_broadcast': return
+        _clear_admin_state(admin_id)
+        broadcast_id = _broadcast_engine.create(admin_id, state_info['data']['text'], message.message_id) if _broadcast_engine else None
+        if not broadcast_id:
+            _show_menu(admin_id, messages.BROADCAST_START_FAILED, inline_keyboards.get_back_button("admin_main_menu"), message)
+
+    def cancel_broadcast(admin_id, message, broadcast_id):
+        # پیام پیشرفت با وضعیت «لغو شده» توسط خود موتور ارسال به‌روز می‌شود
+        if not _broadcast_engine or not _broadcast_engine.cancel(broadcast_id):
+            _show_menu(admin_id, messages.BROADCAST_NOT_RUNNING, inline_keyboards.get_back_button("admin_main_menu"), message)
+
     def start_add_profile_flow(admin_id, message):
         """فرآیند افزودن یک پروفایل جدید را آغاز می‌کند."""
         _clear_admin_state(admin_id)
@@ -933,12 +1000,12 @@ def register_admin_handlers(bot_instance, db_manager_instance, xui_api_instance)
 
         _bot.edit_message_text("⏳ در حال دریافت لیست اینباندها از پنل...", admin_id, message.message_id)
         
-        api_client = _xui_api(panel_url=server_data['panel_url'], username=server_data['username'], password=server_data['password'])
-        if not api_client.login():
+        api_client = client_registry.get_client_for_server(server_data, _xui_api)
+        if not api_client.is_logged_in and not api_client.login():
             _bot.edit_message_text("❌ اتصال به پنل سرور ناموفق بود.", admin_id, message.message_id, reply_markup=inline_keyboards.get_back_button(f"admin_manage_profile_inbounds_{profile_id}"))
             return
         
-        panel_inbounds = api_client.list_inbounds()
+        panel_inbounds = api_client.list_inbounds(fields=INBOUND_SUMMARY_FIELDS)
         if not panel_inbounds:
             _bot.edit_message_text("هیچ اینباندی در پنل این سرور یافت نشد.", admin_id, message.message_id, reply_markup=inline_keyboards.get_back_button(f"admin_manage_profile_inbounds_{profile_id}"))
             return
@@ -957,7 +1024,7 @@ def register_admin_handlers(bot_instance, db_manager_instance, xui_api_instance)
             'server_id': server_id,
             'selected_ids': selected_db_ids,
             'inbound_map': inbound_map,
-            'panel_inbounds': panel_inbounds  # <-- این خط تضمین می‌کند که لیست کامل ذخیره شود
+            'panel_inbounds': panel_inbounds  # فقط خلاصه اینباندها (بدون لیست کلاینت‌ها) ذخیره می‌شود
         }
         # --- پایان بخش اصلاح شده ---
         
@@ -984,6 +1051,7 @@ def register_admin_handlers(bot_instance, db_manager_instance, xui_api_instance)
             selected_ids.remove(db_inbound_id)
         else:
             selected_ids.add(db_inbound_id)
+        _admin_states[admin_id] = state_data
             
         # --- بخش اصلاح شده و حیاتی ---
         # بازخوانی اطلاعات لازم از حافظه موقت (state)
@@ -13,6 +13,8 @@ from keyboards import inline_keyboards
 from utils.config_generator import ConfigGenerator
 from utils.helpers import is_float_or_int , escape_markdown_v1
 from utils.bot_helpers import send_subscription_info # این ایمپورت جدید است
+from utils.state_store import create_state_store
+from utils.outbound import queue_photo
 from config import ZARINPAL_MERCHANT_ID, WEBHOOK_DOMAIN , ZARINPAL_SANDBOX
 from config import ENABLE_SERVER_PURCHASE, ENABLE_PROFILE_PURCHASE, ENABLE_FIXED_PLANS, ENABLE_GIGABYTE_PLANS
 
@@ -26,7 +28,7 @@ _config_generator: ConfigGenerator = None
 
 # متغیرهای وضعیت
 _user_menu_message_ids = {} # {user_id: message_id}
-_user_states = {} # {user_id: {'state': '...', 'data': {...}}}
+_user_states = None # StateStore: {user_id: {'state': '...', 'data': {...}}}
 
 
 
@@ -34,9 +36,10 @@ ZARINPAL_API_URL = "https://api.zarinpal.com/pg/v4/payment/request.json"
 ZARINPAL_STARTPAY_URL = "https://www.zarinpal.com/pg/StartPay/"
 
 def register_user_handlers(bot_instance, db_manager_instance, xui_api_instance):
-    global _bot, _db_manager, _xui_api, _config_generator
+    global _bot, _db_manager, _xui_api, _config_generator, _user_states
     _bot = bot_instance
     _db_manager = db_manager_instance
+    _user_states = create_state_store('user', _db_manager)
     _xui_api = xui_api_instance
     _config_generator = ConfigGenerator(_xui_api, _db_manager)
 
@@ -78,21 +81,18 @@ def register_user_handlers(bot_instance, db_manager_instance, xui_api_instance):
         _bot.answer_callback_query(call.id)
         user_id = call.from_user.id
         data = call.data
-        if user_id not in _user_states:
-            _user_states[user_id] = {'data': {}}
         if data == "buy_type_server":
-            _user_states[user_id]['data']['purchase_type'] = 'server' # <-- ثبت نوع خرید
+            _update_user_state(user_id, data={'purchase_type': 'server'}) # <-- ثبت نوع خرید
             select_server_for_purchase(user_id, call.message)
         elif data == "buy_type_profile":
-            _user_states[user_id]['data']['purchase_type'] = 'profile' # <-- ثبت نوع خرید
+            _update_user_state(user_id, data={'purchase_type': 'profile'}) # <-- ثبت نوع خرید
             select_profile_for_purchase(user_id, call.message)
         elif data == "show_order_summary":
         # این شرط جدید، دکمه بازگشت را مدیریت می‌کند
             show_order_summary(user_id, call.message)
         elif data.startswith("buy_select_server_"):
             server_id = int(data.replace("buy_select_server_", ""))
-            _user_states[user_id]['data']['purchase_type'] = 'server'
-            _user_states[user_id]['data']['server_id'] = server_id
+            _update_user_state(user_id, data={'purchase_type': 'server', 'server_id': server_id})
             # --- بخش اصلاح شده ---
             # ارسال callback صحیح برای دکمه بازگشت
             _bot.edit_message_text(messages.SELECT_PLAN_TYPE_PROMPT_USER, user_id, call.message.message_id, 
@@ -100,8 +100,7 @@ def register_user_handlers(bot_instance, db_manager_instance, xui_api_instance):
 
         elif data.startswith("buy_select_profile_"):
             profile_id = int(data.replace("buy_select_profile_", ""))
-            _user_states[user_id]['data']['purchase_type'] = 'profile'
-            _user_states[user_id]['data']['profile_id'] = profile_id
+            _update_user_state(user_id, data={'purchase_type': 'profile', 'profile_id': profile_id})
             # --- بخش اصلاح شده ---
             # ارسال callback صحیح برای دکمه بازگشت
             _bot.edit_message_text(messages.SELECT_PLAN_TYPE_PROMPT_USER, user_id, call.message.message_id, 
@@ -125,7 +124,9 @@ def register_user_handlers(bot_instance, db_manager_instance, xui_api_instance):
     def handle_stateful_messages(message):
         """هندل کردن پیام‌های متنی یا عکسی که کاربر در یک وضعیت خاص ارسال می‌کند"""
         user_id = message.from_user.id
-        state_info = _user_states[user_id]
+        state_info = _user_states.get(user_id)
+        if not state_info:
+            return
         current_state = state_info.get('state')
 
         # حذف پیام ورودی کاربر برای تمیز ماندن چت
@@ -140,10 +141,17 @@ def register_user_handlers(bot_instance, db_manager_instance, xui_api_instance):
 
     # --- توابع کمکی و اصلی ---
     def _clear_user_state(user_id):
-        if user_id in _user_states:
-            del _user_states[user_id]
+        _user_states.pop(user_id, None)
         _bot.clear_step_handler_by_chat_id(chat_id=user_id)
 
+    def _update_user_state(user_id, data: dict = None, **fields):
+        """فیلدهای وضعیت کاربر (state، prompt_message_id و ...) و کلیدهای data را تغییر داده و دوباره ذخیره می‌کند."""
+        state_info = _user_states.get(user_id) or {}
+        state_info.update(fields)
+        state_info.setdefault('data', {}).update(data or {})
+        _user_states[user_id] = state_info
+        return state_info
+
     def _show_user_main_menu(user_id, message_to_edit=None):
         _clear_user_state(user_id)
         menu_text = messages.USER_MAIN_MENU_TEXT
@@ -193,10 +201,10 @@ def register_user_handlers(bot_instance, db_manager_instance, xui_api_instance):
         )
 
     def select_plan_type(user_id, plan_type, message):
-        _user_states[user_id]['data']['plan_type'] = plan_type
+        state_info = _update_user_state(user_id, data={'plan_type': plan_type})
         
         # تعیین دکمه بازگشت بر اساس نوع خرید (سرور یا پروفایل)
-        purchase_type = _user_states[user_id]['data'].get('purchase_type')
+        purchase_type = state_info['data'].get('purchase_type')
         if purchase_type == 'profile':
             # اگر کاربر در حال خرید پروفایل است، باید به لیست پروفایل‌ها برگردد
             back_callback = "buy_type_profile"
@@ -209,7 +217,7 @@ def register_user_handlers(bot_instance, db_manager_instance, xui_api_instance):
             if not active_plans:
                 _bot.edit_message_text(messages.NO_FIXED_PLANS_AVAILABLE, user_id, message.message_id, reply_markup=inline_keyboards.get_back_button(back_callback))
                 return
-            _user_states[user_id]['state'] = 'selecting_fixed_plan'
+            _update_user_state(user_id, state='selecting_fixed_plan')
             _bot.edit_message_text(messages.SELECT_FIXED_PLAN_PROMPT, user_id, message.message_id, reply_markup=inline_keyboards.get_fixed_plan_selection_menu(active_plans, back_callback))
         
         elif plan_type == 'gigabyte_based':
@@ -217,16 +225,15 @@ def register_user_handlers(bot_instance, db_manager_instance, xui_api_instance):
             if not gb_plan or not gb_plan.get('per_gb_price'):
                 _bot.edit_message_text(messages.GIGABYTE_PLAN_NOT_CONFIGURED, user_id, message.message_id, reply_markup=inline_keyboards.get_back_button(back_callback))
                 return
-            _user_states[user_id]['data']['gb_plan_details'] = gb_plan
-            _user_states[user_id]['state'] = 'waiting_for_gigabytes_input'
             sent_msg = _bot.edit_message_text(messages.ENTER_GIGABYTES_PROMPT, user_id, message.message_id, reply_markup=inline_keyboards.get_back_button(back_callback))
-            _user_states[user_id]['prompt_message_id'] = sent_msg.message_id
+            _update_user_state(user_id, state='waiting_for_gigabytes_input', prompt_message_id=sent_msg.message_id,
+                               data={'gb_plan_details': dict(gb_plan)})
     def select_fixed_plan(user_id, plan_id, message):
         plan = _db_manager.get_plan_by_id(plan_id)
         if not plan:
             _bot.edit_message_text(messages.OPERATION_FAILED, user_id, message.message_id)
             return
-        _user_states[user_id]['data']['plan_details'] = plan
+        _update_user_state(user_id, data={'plan_details': dict(plan)})
         show_order_summary(user_id, message)
         
     def process_gigabyte_input(message):
@@ -237,12 +244,12 @@ def register_user_handlers(bot_instance, db_manager_instance, xui_api_instance):
             _bot.edit_message_text(messages.INVALID_GIGABYTE_INPUT + "\n" + messages.ENTER_GIGABYTES_PROMPT, user_id, state_data['prompt_message_id'])
             return
             
-        state_data['data']['requested_gb'] = float(message.text)
+        _update_user_state(user_id, data={'requested_gb': float(message.text)})
         show_order_summary(user_id, message)
 
     def show_order_summary(user_id, message):
-        _user_states[user_id]['state'] = 'confirming_order'
-        order_data = _user_states[user_id]['data']
+        state_info = _update_user_state(user_id, state='confirming_order')
+        order_data = state_info['data']
         
         summary_text = messages.ORDER_SUMMARY_HEADER
         
@@ -296,11 +303,12 @@ def register_user_handlers(bot_instance, db_manager_instance, xui_api_instance):
         
         order_data['total_price'] = total_price
         order_data['plan_details_for_admin'] = plan_details_for_admin
+        _user_states[user_id] = state_info
         
-        prompt_id = _user_states[user_id].get('prompt_message_id', message.message_id)
+        prompt_id = state_info.get('prompt_message_id', message.message_id)
         _bot.edit_message_text(summary_text, user_id, prompt_id, parse_mode='Markdown', reply_markup=inline_keyboards.get_order_confirmation_menu())
     def display_payment_gateways(user_id, message):
-        _user_states[user_id]['state'] = 'selecting_gateway'
+        _update_user_state(user_id, state='selecting_gateway')
         active_gateways = _db_manager.get_all_payment_gateways(only_active=True)
         if not active_gateways:
             _bot.edit_message_text(messages.NO_ACTIVE_PAYMENT_GATEWAYS, user_id, message.message_id, reply_markup=inline_keyboards.get_back_button("show_order_summary"))
@@ -379,8 +387,6 @@ def register_user_handlers(bot_instance, db_manager_instance, xui_api_instance):
 
         # --- منطق برای کارت به کارت ---
         elif gateway['type'] == 'card_to_card':
-            _user_states[user_id]['data']['gateway_details'] = gateway
-            _user_states[user_id]['state'] = 'waiting_for_payment_receipt'
             total_price = order_data['total_price']
             payment_text = messages.PAYMENT_GATEWAY_DETAILS.format(
                 name=gateway['name'], card_number=gateway['card_number'],
@@ -389,7 +395,8 @@ def register_user_handlers(bot_instance, db_manager_instance, xui_api_instance):
                 amount=total_price
             )
             sent_msg = _bot.edit_message_text(payment_text, user_id, message.message_id, reply_markup=inline_keyboards.get_back_button("show_order_summary"))
-            _user_states[user_id]['prompt_message_id'] = sent_msg.message_id
+            _update_user_state(user_id, state='waiting_for_payment_receipt', prompt_message_id=sent_msg.message_id,
+                               data={'gateway_details': gateway})
 
     def process_payment_receipt(message):
         user_id = message.from_user.id
@@ -448,17 +455,15 @@ def register_user_handlers(bot_instance, db_manager_instance, xui_api_instance):
         )
         markup = inline_keyboards.get_admin_payment_action_menu(payment_id)
         
+        # اعلان ادمین‌ها از outbox ارسال می‌شود تا هجوم رسیدها هندلر کاربر را پشت محدودیت نرخ تلگرام معطل نکند
         for admin_id in ADMIN_IDS:
-            try:
-                sent_msg = _bot.send_photo(
-                    admin_id, order_details_for_db['receipt_file_id'],
-                    caption=messages.ADMIN_NEW_PAYMENT_NOTIFICATION_HEADER + caption,
-                    parse_mode='Markdown', reply_markup=markup
-                )
-                if admin_id == ADMIN_IDS[0]:
-                    _db_manager.update_payment_admin_notification_id(payment_id, sent_msg.message_id)
-            except Exception as e:
-                logger.error(f"Failed to send payment notification to admin {admin_id}: {e}")
+            if not queue_photo(
+                _db_manager, admin_id, order_details_for_db['receipt_file_id'],
+                caption=messages.ADMIN_NEW_PAYMENT_NOTIFICATION_HEADER + caption,
+                parse_mode='Markdown', reply_markup=markup,
+                on_sent=('payment_admin_notification', payment_id) if admin_id == ADMIN_IDS[0] else None
+            ):
+                logger.error(f"Failed to queue payment notification for admin {admin_id}.")
 
         _bot.send_message(user_id, messages.RECEIPT_RECEIVED_USER)
         _clear_user_state(user_id)
@@ -482,6 +487,17 @@ def register_user_handlers(bot_instance, db_manager_instance, xui_api_instance):
             # فراخوانی escape_markdown_v1 از اینجا نیز حذف شد
             text = messages.CONFIG_DELIVERY_HEADER + \
                 messages.CONFIG_DELIVERY_SUB_LINK.format(sub_link=sub_link)
+
+            # مصرف از جدول client_usage خوانده می‌شود، نه به صورت زنده از پنل
+            usage = _db_manager.get_client_usage(purchase['xui_client_email'])
+            if usage:
+                total_gb = helpers.bytes_to_gb(usage['total_bytes']) if usage['total_bytes'] else messages.SERVICE_USAGE_UNLIMITED
+                text += messages.SERVICE_USAGE_INFO.format(
+                    used_gb=helpers.bytes_to_gb(usage['used_bytes']), total_gb=total_gb,
+                    updated_at=usage['updated_at'].strftime("%Y-%m-%d %H:%M")
+                )
+            else:
+                text += messages.SERVICE_USAGE_NOT_SYNCED
             
             # ساخت کیبورد با دکمه‌های بازگشت و دریافت کانفیگ تکی
             markup = types.InlineKeyboardMarkup()
@@ -544,8 +560,8 @@ def register_user_handlers(bot_instance, db_manager_instance, xui_api_instance):
     # در فایل handlers/user_handlers.py
 
     def show_order_summary(user_id, message):
-        _user_states[user_id]['state'] = 'confirming_order'
-        order_data = _user_states[user_id]['data']
+        state_info = _update_user_state(user_id, state='confirming_order')
+        order_data = state_info['data']
         
         summary_text = messages.ORDER_SUMMARY_HEADER
         purchase_type = order_data.get('purchase_type')
@@ -592,8 +608,9 @@ def register_user_handlers(bot_instance, db_manager_instance, xui_api_instance):
         
         order_data['total_price'] = total_price
         order_data['plan_details_for_admin'] = plan_details_for_admin
+        _user_states[user_id] = state_info
         
-        prompt_id = _user_states[user_id].get('prompt_message_id', message.message_id)
+        prompt_id = state_info.get('prompt_message_id', message.message_id)
         _bot.edit_message_text(summary_text, user_id, prompt_id, parse_mode='Markdown', reply_markup=inline_keyboards.get_order_confirmation_menu())
         
         
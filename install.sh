@@ -215,6 +215,11 @@ server {
         proxy_set_header Host \$host;
         proxy_set_header X-Real-IP \$remote_addr;
     }
+    # Telegram updates (BOT_UPDATE_MODE=webhook)
+    location /telegram/ {
+        proxy_pass http://127.0.0.1:8081;
+        proxy_set_header X-Real-IP \$remote_addr;
+    }
 }
 EOL
     sudo systemctl restart nginx
@@ -250,7 +255,10 @@ After=network.target
 [Service]
 User=root
 WorkingDirectory=$INSTALL_DIR
-ExecStart=$INSTALL_DIR/.venv/bin/python3 $INSTALL_DIR/webhook_server.py
+ExecStart=$INSTALL_DIR/.venv/bin/gunicorn -c $INSTALL_DIR/gunicorn.conf.py webhook_server:app
+ExecReload=/bin/kill -s HUP \$MAINPID
+KillMode=mixed
+TimeoutStopSec=35
 Restart=always
 RestartSec=10s
 [Install]
@@ -16,6 +16,7 @@ def get_admin_main_inline_menu():
         types.InlineKeyboardButton("👥 مدیریت کاربران", callback_data="admin_user_management"),
         types.InlineKeyboardButton("🧬 مدیریت پروفایل‌ها", callback_data="admin_profile_management"),
         types.InlineKeyboardButton("📊 داشبورد", callback_data="admin_dashboard"),
+        types.InlineKeyboardButton("📢 ارسال همگانی", callback_data="admin_broadcast"),
         types.InlineKeyboardButton("🗄 تهیه نسخه پشتیبان", callback_data="admin_create_backup")
     )
     return markup
@@ -28,9 +29,27 @@ def get_server_management_inline_menu():
         types.InlineKeyboardButton("🔌 مدیریت Inboundها", callback_data="admin_manage_inbounds"),
         types.InlineKeyboardButton("🔄 تست اتصال سرورها", callback_data="admin_test_all_servers"),
         types.InlineKeyboardButton("❌ حذف سرور", callback_data="admin_delete_server"),
+        types.InlineKeyboardButton("🧹 پاکسازی کلاینت‌های منقضی", callback_data="admin_client_gc_preview"),
+        types.InlineKeyboardButton("🔍 بررسی همخوانی با پنل‌ها", callback_data="admin_reconcile_preview"),
         types.InlineKeyboardButton("🔙 بازگشت", callback_data="admin_main_menu")
     )
     return markup
+
+def get_reconcile_confirmation_menu():
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    markup.add(
+        types.InlineKeyboardButton("🛠 اصلاح موارد ناهمخوان", callback_data="admin_reconcile_fix"),
+        types.InlineKeyboardButton("🔙 بازگشت", callback_data="admin_server_management")
+    )
+    return markup
+
+def get_client_gc_confirmation_menu():
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    markup.add(
+        types.InlineKeyboardButton("✅ اجرای پاکسازی", callback_data="admin_client_gc_run"),
+        types.InlineKeyboardButton("🔙 بازگشت", callback_data="admin_server_management")
+    )
+    return markup
     
 def get_plan_management_inline_menu():
     markup = types.InlineKeyboardMarkup(row_width=2)
@@ -108,6 +127,11 @@ def get_confirmation_menu(confirm_callback: str, cancel_callback: str, confirm_t
     )
     return markup
 
+def get_broadcast_progress_menu(broadcast_id: int):
+    markup = types.InlineKeyboardMarkup(row_width=1)
+    markup.add(types.InlineKeyboardButton("⛔️ توقف ارسال", callback_data=f"admin_broadcast_cancel_{broadcast_id}"))
+    return markup
+
 # --- توابع کیبورد کاربر ---
 
 def get_user_main_inline_menu():
@@ -191,8 +215,11 @@ def get_my_services_menu(purchases: list):
     else:
         for p in purchases:
             status_emoji = "✅" if p['is_active'] else "❌"
-            expire_date_str = p['expire_date'][:10] if p['expire_date'] else "نامحدود"
+            expire_date_str = str(p['expire_date'])[:10] if p['expire_date'] else "نامحدود"
             btn_text = f"{status_emoji} سرویس {p['id']} ({p['server_name']}) - انقضا: {expire_date_str}"
+            # مصرف از جدول client_usage (همگام شده در پس‌زمینه) خوانده می‌شود
+            if p.get('used_bytes') is not None:
+                btn_text += f" - مصرف: {p['used_bytes'] / (1024 ** 3):.2f}GB"
             markup.add(types.InlineKeyboardButton(btn_text, callback_data=f"user_service_details_{p['id']}"))
     
     markup.add(types.InlineKeyboardButton("🔙 بازگشت به منو اصلی", callback_data="user_main_menu"))
@@ -3,6 +3,8 @@
 import telebot
 import logging
 import os
+import secrets
+import signal
 
 # --- تنظیمات لاگ (تغییر در این بخش) ---
 logging.basicConfig(
@@ -17,11 +19,24 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # --- ایمپورت ماژول‌های پروژه ---
-from config import BOT_TOKEN, ADMIN_IDS, REQUIRED_CHANNEL_ID, REQUIRED_CHANNEL_LINK
+from config import BOT_TOKEN, ADMIN_IDS, REQUIRED_CHANNEL_ID, REQUIRED_CHANNEL_LINK, SERVER_HEALTH_CHECK_INTERVAL, USAGE_SYNC_INTERVAL_SECONDS, CLIENT_GC_INTERVAL_SECONDS
+from config import RECONCILE_INTERVAL_SECONDS, RECONCILE_AUTO_FIX, JOB_WORKERS
+from config import (BOT_UPDATE_MODE, BOT_WEBHOOK_URL, BOT_WEBHOOK_PATH, BOT_WEBHOOK_LISTEN, BOT_WEBHOOK_PORT, BOT_WEBHOOK_SECRET,
+                    BOT_WEBHOOK_MAX_CONNECTIONS, BOT_UPDATE_WORKERS, BOT_UPDATE_QUEUE_SIZE, TELEGRAM_API_URL)
 from database.db_manager import DatabaseManager
 from api_client.xui_api_client import XuiAPIClient
 from handlers import admin_handlers, user_handlers
 from utils import messages, helpers
+from utils.server_health import ServerHealthChecker
+from utils.usage_sync import UsageSyncEngine
+from utils.client_gc import ExpiredClientCollector
+from utils.reconciler import DriftReconciler
+from utils.provisioning import ProvisioningWorkerPool
+from utils.config_generator import ConfigGenerator
+from utils.telegram_webhook import TelegramWebhookServer
+from utils.update_dispatcher import DispatchingTeleBot
+from utils.outbound import OutboxRelay
+from utils.broadcast import BroadcastEngine
 from keyboards import inline_keyboards
 
 # --- نمونه‌سازی (Instantiation) ---
@@ -29,9 +44,16 @@ if not BOT_TOKEN:
     logger.critical("BOT_TOKEN is not set in the environment variables. Exiting.")
     exit()
 
-bot = telebot.TeleBot(BOT_TOKEN)
+if TELEGRAM_API_URL:
+    # Bot API محلی یا جعلی (برای تست)
+    telebot.apihelper.API_URL = TELEGRAM_API_URL + "/bot{0}/{1}"
+    telebot.apihelper.FILE_URL = TELEGRAM_API_URL + "/file/bot{0}/{1}"
+
+# هندلرها در workerهای bot.dispatcher اجرا می‌شوند (updateهای هر چت به ترتیب، چت‌های مختلف موازی)
+# و تمام ارسال‌ها از محدودکننده نرخ bot.limiter عبور می‌کنند
+bot = DispatchingTeleBot(BOT_TOKEN, num_workers=BOT_UPDATE_WORKERS, queue_size=BOT_UPDATE_QUEUE_SIZE)
 db_manager = DatabaseManager()
-# نمونه‌سازی XuiAPIClient اینجا لازم نیست چون در هر فانکشن به صورت موقت ساخته می‌شود
+# کلاینت‌های XuiAPIClient برای هر سرور یک بار ساخته شده و در api_client.client_registry نگه داشته می‌شوند
 
 # --- هندلر دستور /start ---
 @bot.message_handler(commands=['start'])
@@ -40,8 +62,8 @@ def send_welcome(message):
     first_name = message.from_user.first_name
     logger.info(f"Received /start from user ID: {user_id} ({first_name})")
 
-    # ذخیره/به‌روزرسانی کاربر در دیتابیس
-    db_manager.add_or_update_user(
+    # ذخیره/به‌روزرسانی کاربر (برای کاربران شناخته شده به صورت دسته‌ای و با تأخیر)
+    db_manager.touch_user(
         telegram_id=user_id,
         first_name=first_name,
         last_name=message.from_user.last_name,
@@ -61,30 +83,116 @@ def send_welcome(message):
         welcome_text = messages.START_WELCOME.format(first_name=helpers.escape_markdown_v1(first_name))
         bot.send_message(user_id, welcome_text, parse_mode='Markdown', reply_markup=inline_keyboards.get_user_main_inline_menu())
 
+# --- عضویت در کانال اجباری ---
+# فقط اگر ربات ادمین کانال باشد دریافت می‌شود و کش عضویت را بدون فراخوانی get_chat_member به‌روز نگه می‌دارد
+@bot.chat_member_handler(func=lambda update: update.chat.id == REQUIRED_CHANNEL_ID)
+def handle_required_channel_member(update):
+    helpers.update_channel_membership(update.chat.id, update.new_chat_member.user.id, update.new_chat_member.status)
+
+# --- دریافت updateها ---
+# تلگرام update های chat_member را فقط در صورت درخواست صریح ارسال می‌کند
+ALLOWED_UPDATES = telebot.util.update_types if REQUIRED_CHANNEL_ID else None
+
+def run_webhook():
+    """
+    updateها را از طریق وب‌هوک دریافت می‌کند و تا دریافت SIGTERM یا Ctrl+C منتظر می‌ماند.
+    اگر راه‌اندازی وب‌هوک ممکن نباشد False برمی‌گرداند تا ربات با polling ادامه دهد.
+    """
+    if not BOT_WEBHOOK_URL:
+        logger.error("BOT_WEBHOOK_URL (or WEBHOOK_DOMAIN) is not set; falling back to polling.")
+        return False
+    secret_token = BOT_WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    webhook = TelegramWebhookServer(lambda update: bot.dispatcher.submit(update, block=False),
+                                    BOT_WEBHOOK_LISTEN, BOT_WEBHOOK_PORT, BOT_WEBHOOK_PATH, secret_token)
+    try:
+        webhook.start()
+        bot.set_webhook(url=BOT_WEBHOOK_URL, secret_token=secret_token, max_connections=BOT_WEBHOOK_MAX_CONNECTIONS,
+                        allowed_updates=ALLOWED_UPDATES)
+    except Exception as e:
+        logger.error(f"Could not start webhook mode: {e}; falling back to polling.")
+        webhook.stop()
+        return False
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: webhook.stop())
+    logger.info(f"Bot is now receiving updates via webhook at {BOT_WEBHOOK_URL}...")
+    try:
+        webhook.wait()
+    except KeyboardInterrupt:
+        webhook.stop()
+    logger.info("Bot webhook stopped.")
+    return True
+
+
+def run_polling():
+    bot.remove_webhook()
+    logger.info("Bot is now polling for updates...")
+    bot.infinity_polling(logger_level=logging.WARNING, allowed_updates=ALLOWED_UPDATES) # برای جلوگیری از لاگ‌های زیاد خود کتابخانه
+    logger.info("Bot polling stopped.")
+
+
 # --- تابع اصلی ---
 def main():
-    bot.remove_webhook()
     logger.info("Bot is starting...")
 
     # ایجاد جداول دیتابیس در صورت عدم وجود
     try:
         db_manager.create_tables()
+        db_manager.run_migrations()
         logger.info("Database tables checked/created successfully.")
     except Exception as e:
         logger.critical(f"FATAL: Could not create database tables. Error: {e}")
         return # خروج از برنامه اگر دیتابیس مشکل داشته باشد
 
     # ثبت هندلرها
-    # XUI API Client به صورت موقت در هر تابع ساخته می‌شود، پس لازم نیست اینجا پاس داده شود
-    admin_handlers.register_admin_handlers(bot, db_manager, XuiAPIClient)
+    # کلاس XuiAPIClient به عنوان سازنده به رجیستری کلاینت‌ها پاس داده می‌شود
+    # ارسال‌های همگانی نیمه‌کاره (مثلاً پیش از restart) با start() از آخرین دسته ذخیره شده ادامه می‌یابند
+    broadcast_engine = BroadcastEngine(db_manager, bot)
+    admin_handlers.register_admin_handlers(bot, db_manager, XuiAPIClient, broadcast_engine=broadcast_engine)
     logger.info("Admin handlers registered.")
 
     user_handlers.register_user_handlers(bot, db_manager, XuiAPIClient)
     logger.info("User handlers registered.")
 
-    logger.info("Bot is now polling for updates...")
-    bot.infinity_polling(logger_level=logging.WARNING) # برای جلوگیری از لاگ‌های زیاد خود کتابخانه
-    logger.info("Bot polling stopped.")
+    # بررسی دوره‌ای سلامت پنل‌ها در پس‌زمینه
+    health_checker = ServerHealthChecker(db_manager, XuiAPIClient, SERVER_HEALTH_CHECK_INTERVAL)
+    health_checker.start()
+
+    # همگام‌سازی دوره‌ای مصرف ترافیک کلاینت‌ها با جدول client_usage
+    usage_sync = UsageSyncEngine(db_manager, XuiAPIClient, USAGE_SYNC_INTERVAL_SECONDS)
+    usage_sync.start()
+
+    # حذف دوره‌ای کلاینت‌های منقضی از پنل‌ها
+    client_gc = ExpiredClientCollector(db_manager, XuiAPIClient, CLIENT_GC_INTERVAL_SECONDS)
+    client_gc.start()
+
+    # مقایسه دوره‌ای خریدها با کلاینت‌های پنل‌ها (به طور پیش‌فرض غیرفعال)
+    reconciler = DriftReconciler(db_manager, XuiAPIClient, RECONCILE_INTERVAL_SECONDS, auto_fix=RECONCILE_AUTO_FIX)
+    reconciler.start()
+
+    # workerهای صف ساخت سرویس (کارها از ربات و وب‌هوک پرداخت در صف قرار می‌گیرند)
+    provisioning_workers = ProvisioningWorkerPool(db_manager, ConfigGenerator(XuiAPIClient, db_manager), bot, JOB_WORKERS)
+    provisioning_workers.start()
+
+    # ارسال پیام‌های صف outbound_messages (اعلان‌های وب‌سرور پرداخت و اعلان‌های انبوه ربات)
+    outbox_relay = OutboxRelay(db_manager, bot)
+    outbox_relay.start()
+    broadcast_engine.start()
+
+    bot.dispatcher.start()
+    if BOT_UPDATE_MODE != 'webhook' or not run_webhook():
+        run_polling()
+    bot.dispatcher.stop()
+    logger.info(f"Update dispatcher stats at shutdown: {bot.dispatcher.stats()}")
+    health_checker.stop()
+    usage_sync.stop()
+    client_gc.stop()
+    reconciler.stop()
+    provisioning_workers.stop()
+    broadcast_engine.stop()
+    outbox_relay.stop()
+    logger.info(f"Outbound stats at shutdown: limiter={bot.limiter.stats()}, outbox={outbox_relay.stats()}")
+    logger.info(f"DB pool stats at shutdown: {db_manager.get_pool_stats()}")
+    db_manager.close()
 
 @bot.message_handler(commands=['myid'])
 def send_user_id(message):
@@ -0,0 +1,146 @@
+# tests/test_telegram_webhook.py
+"""
+تست حالت وب‌هوک ربات در برابر یک Bot API جعلی محلی: update ها به TelegramWebhookServer ارسال می‌شوند و
+پاسخ هندلر به جای api.telegram.org به سرور جعلی (مانند TELEGRAM_API_URL) می‌رسد. به دیتابیس نیازی ندارد.
+"""
+
+import json
+import os
+import queue
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+import pytest
+import requests
+import telebot
+
+# افزودن مسیر پروژه به sys.path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.telegram_webhook import TelegramWebhookServer, SECRET_TOKEN_HEADER
+from utils.update_dispatcher import DispatchingTeleBot
+
+WEBHOOK_PATH = "/telegram/webhook"
+SECRET = "test-secret"
+CHAT_ID = 424242
+
+
+class _StubBotApi:
+    """Bot API جعلی: هر فراخوانی (method, پارامترها) را در صف calls قرار می‌دهد و یک Message ساختگی برمی‌گرداند."""
+    def __init__(self):
+        self.calls = queue.Queue()
+        stub = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                url = urlsplit(self.path)
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode('utf-8')
+                params = dict(parse_qsl(url.query))
+                if self.headers.get('Content-Type', '').startswith('application/json'):
+                    params.update(json.loads(body or '{}'))
+                else:
+                    params.update(parse_qsl(body))
+                stub.calls.put((url.path.rsplit('/', 1)[-1], params))
+                result = {"message_id": 1, "date": 0, "chat": {"id": CHAT_ID, "type": "private"}, "text": "ok"}
+                payload = json.dumps({"ok": True, "result": result}).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self._httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self._httpd.server_address[1]}"
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+@pytest.fixture
+def bot_api(monkeypatch):
+    stub = _StubBotApi()
+    # همان کاری که main.py با TELEGRAM_API_URL انجام می‌دهد
+    monkeypatch.setattr(telebot.apihelper, 'API_URL', stub.url + "/bot{0}/{1}")
+    yield stub
+    stub.close()
+
+
+def _start_webhook(bot):
+    webhook = TelegramWebhookServer(lambda update: bot.dispatcher.submit(update, block=False),
+                                    '127.0.0.1', 0, WEBHOOK_PATH, SECRET)
+    webhook.start()
+    return webhook, f"http://127.0.0.1:{webhook._httpd.server_address[1]}{WEBHOOK_PATH}"
+
+
+def _message_update(update_id, text="/start"):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": 0, "text": text,
+            "chat": {"id": CHAT_ID, "type": "private"},
+            "from": {"id": CHAT_ID, "is_bot": False, "first_name": "Test"},
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text)}] if text.startswith('/') else [],
+        },
+    }
+
+
+def _post(url, body, secret=SECRET):
+    data = body if isinstance(body, (bytes, str)) else json.dumps(body)
+    return requests.post(url, data=data, headers={SECRET_TOKEN_HEADER: secret, 'Content-Type': 'application/json'}, timeout=5)
+
+
+@pytest.fixture
+def running_bot(bot_api):
+    bot = DispatchingTeleBot("123:TEST", num_workers=2, queue_size=10)
+
+    @bot.message_handler(commands=['start'])
+    def reply(message):
+        bot.send_message(message.chat.id, f"hello {message.from_user.first_name}")
+
+    bot.dispatcher.start()
+    webhook, url = _start_webhook(bot)
+    yield bot, url
+    webhook.stop()
+    bot.dispatcher.stop()
+
+
+def test_update_is_dispatched_to_handler(running_bot, bot_api):
+    _, url = running_bot
+    assert _post(url, _message_update(1)).status_code == 200
+
+    method, params = bot_api.calls.get(timeout=5)
+    assert method == 'sendMessage'
+    assert str(params['chat_id']) == str(CHAT_ID)
+    assert params['text'] == "hello Test"
+
+
+def test_invalid_secret_token_is_rejected(running_bot, bot_api):
+    _, url = running_bot
+    assert _post(url, _message_update(2), secret="wrong").status_code == 403
+    assert requests.post(url, data=json.dumps(_message_update(3)), timeout=5).status_code == 403
+    assert bot_api.calls.empty()
+
+
+@pytest.mark.parametrize("body", ['{not json', '[]', 'null', '{"message": {}}', '{"update_id": 5, "message": {"message_id": 1}}'])
+def test_malformed_update_returns_400(running_bot, body):
+    _, url = running_bot
+    assert _post(url, body).status_code == 400
+
+
+def test_full_queue_returns_503(bot_api):
+    # dispatcher شروع نشده است، پس update اول صف یک‌عضوی را پر می‌کند
+    bot = DispatchingTeleBot("123:TEST", num_workers=1, queue_size=1)
+    webhook, url = _start_webhook(bot)
+    try:
+        assert _post(url, _message_update(10)).status_code == 200
+        assert _post(url, _message_update(11)).status_code == 503
+    finally:
+        webhook.stop()
@@ -0,0 +1,139 @@
+# tests/test_zarinpal_callback.py
+"""
+تست همزمانی callback زرین‌پال: تعداد زیادی درخواست همزمان برای یک authority (رفرش مرورگر یا تکرار
+callback توسط درگاه) باید فقط یک بار verify درگاه را صدا بزند و فقط یک کار ساخت سرویس ثبت کند.
+
+به یک دیتابیس PostgreSQL یک‌بارمصرف نیاز دارد: نام آن در TEST_DB_NAME و بقیه اتصال در DB_USER/DB_PASSWORD/
+DB_HOST/DB_PORT. بدون TEST_DB_NAME تست رد (skip) می‌شود. درگاه با یک سرور HTTP محلی شبیه‌سازی می‌شود.
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+# افزودن مسیر پروژه به sys.path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+TEST_DB_NAME = os.getenv("TEST_DB_NAME")
+CONCURRENT_CALLBACKS = 40
+
+pytestmark = pytest.mark.skipif(not TEST_DB_NAME, reason="TEST_DB_NAME is not set (needs a disposable PostgreSQL database)")
+
+
+class _StubZarinpal:
+    """درگاه جعلی: هر verify را می‌شمارد و با تأخیر (برای باز کردن پنجره رقابت) کد 100 برمی‌گرداند."""
+    def __init__(self, delay_seconds: float = 0.3):
+        self.verify_calls = 0
+        self._lock = threading.Lock()
+        stub = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                with stub._lock:
+                    stub.verify_calls += 1
+                time.sleep(delay_seconds)
+                body = json.dumps({"data": {"code": 100, "ref_id": 123456}, "errors": []}).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self._httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self._httpd.server_address[1]}/pg/v4/payment/verify.json"
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+@pytest.fixture(scope="module")
+def webhook_app():
+    os.environ["DB_NAME"] = TEST_DB_NAME
+    if not os.getenv("ENCRYPTION_KEY_ALAMOR"):
+        from cryptography.fernet import Fernet
+        os.environ["ENCRYPTION_KEY_ALAMOR"] = Fernet.generate_key().decode()
+    import config
+    # فایل .env پروژه (با override) نباید تست را به دیتابیس واقعی ببرد
+    if config.DB_NAME != TEST_DB_NAME:
+        pytest.skip(".env overrides DB_NAME; refusing to run against a non-test database")
+
+    import webhook_server  # جداول و مهاجرت‌ها در زمان import اعمال می‌شوند
+    webhook_server.init_worker()
+    yield webhook_server
+    webhook_server.shutdown_worker()
+
+
+@pytest.fixture
+def stub_gateway(webhook_app, monkeypatch):
+    stub = _StubZarinpal()
+    monkeypatch.setattr(webhook_app, 'ZARINPAL_VERIFY_URL', stub.url)
+    yield stub
+    stub.close()
+
+
+@pytest.fixture
+def pending_payment(webhook_app):
+    db = webhook_app.db_manager
+    suffix = uuid.uuid4().hex[:12]
+    telegram_id = int(uuid.uuid4().int % 10**12)
+    db.add_or_update_user(telegram_id, "test")
+    user_id = db.get_user_by_telegram_id(telegram_id)['id']
+    gateway_id = db.add_payment_gateway(f"zarinpal-test-{suffix}", 'zarinpal', merchant_id=f"merchant-{suffix}")
+    order_details = {'user_telegram_id': telegram_id, 'gateway_details': {'id': gateway_id}}
+    payment_id = db.add_payment(user_id, 10000, None, json.dumps(order_details))
+    authority = f"A{suffix}"
+    db.set_payment_authority(payment_id, authority)
+    yield {'payment_id': payment_id, 'authority': authority, 'telegram_id': telegram_id}
+
+    with db._get_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("DELETE FROM outbound_messages WHERE chat_id = %s", (telegram_id,))
+            cursor.execute("DELETE FROM provisioning_jobs WHERE payment_id = %s", (payment_id,))
+            cursor.execute("DELETE FROM payments WHERE id = %s", (payment_id,))
+            cursor.execute("DELETE FROM payment_gateways WHERE id = %s", (gateway_id,))
+            cursor.execute("DELETE FROM users WHERE id = %s", (user_id,))
+        conn.commit()
+    db.invalidate_payment_gateway_cache()
+
+
+def _count(db, sql, params):
+    with db._get_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchone()[0]
+
+
+def test_concurrent_callbacks_verify_and_enqueue_once(webhook_app, stub_gateway, pending_payment):
+    url = f"/zarinpal/verify?Authority={pending_payment['authority']}&Status=OK"
+    start = threading.Barrier(CONCURRENT_CALLBACKS)
+
+    def callback(_):
+        client = webhook_app.app.test_client()
+        start.wait()
+        return client.get(url).status_code
+
+    with ThreadPoolExecutor(max_workers=CONCURRENT_CALLBACKS) as pool:
+        statuses = list(pool.map(callback, range(CONCURRENT_CALLBACKS)))
+
+    db = webhook_app.db_manager
+    payment = db.get_payment_by_id(pending_payment['payment_id'])
+    assert statuses == [200] * CONCURRENT_CALLBACKS
+    assert stub_gateway.verify_calls == 1
+    assert payment['is_confirmed'] and payment['verification_state'] == 'verified'
+    assert payment['ref_id'] == '123456'
+    assert _count(db, "SELECT COUNT(*) FROM provisioning_jobs WHERE payment_id = %s", (pending_payment['payment_id'],)) == 1
+    assert _count(db, "SELECT COUNT(*) FROM outbound_messages WHERE chat_id = %s", (pending_payment['telegram_id'],)) == 1
@@ -0,0 +1,180 @@
+# utils/broadcast.py
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from telebot.apihelper import ApiTelegramException
+
+from config import (BROADCAST_SENDERS, BROADCAST_CHUNK_SIZE, BROADCAST_PROGRESS_INTERVAL_SECONDS,
+                    BROADCAST_LOCK_TIMEOUT_SECONDS)
+from keyboards import inline_keyboards
+from utils import messages
+from utils.outbound import PRIORITY_BULK
+
+logger = logging.getLogger(__name__)
+
+
+def _is_unreachable(error):
+    """403 یعنی ربات توسط کاربر بلاک شده یا حساب او حذف/غیرفعال شده است."""
+    return error.error_code == 403 or 'chat not found' in (getattr(error, 'description', '') or '')
+
+
+class BroadcastEngine:
+    """
+    ارسال همگانی پیام ادمین به تمام کاربران. گیرندگان به ترتیب id و صفحه به صفحه (keyset) در دسته‌های
+    BROADCAST_CHUNK_SIZE تایی توسط BROADCAST_SENDERS نخ با اولویت PRIORITY_BULK ارسال می‌شوند؛ سرعت را
+    محدودکننده نرخ ربات تعیین می‌کند. پس از هر دسته last_user_id و شمارنده‌ها در جدول broadcasts ذخیره و
+    کاربران بلاک کرده یکجا علامت زده می‌شوند، پس ارسال پس از restart (یا توسط پروسه دیگری) از همان‌جا ادامه می‌یابد.
+    پیشرفت با ویرایش یک پیام ادمین نمایش داده می‌شود.
+    """
+    def __init__(self, db_manager, bot, senders: int = BROADCAST_SENDERS, chunk_size: int = BROADCAST_CHUNK_SIZE):
+        self.db_manager = db_manager
+        self.bot = bot
+        self.senders = max(1, senders)
+        self.chunk_size = max(1, chunk_size)
+        self._stop_event = threading.Event()
+        self._cancelled = set()
+        self._runners = {}  # broadcast_id -> thread
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def create(self, admin_id: int, text: str, progress_message_id: int):
+        """ارسال جدیدی ثبت و شروع می‌کند؛ در صورت خطای دیتابیس None برمی‌گرداند."""
+        broadcast = self.db_manager.create_broadcast(admin_id, text, progress_message_id)
+        if not broadcast:
+            return None
+        logger.info(f"Broadcast {broadcast['id']} created by admin {admin_id} for {broadcast['total_count']} user(s).")
+        self._launch(broadcast)
+        return broadcast['id']
+
+    def cancel(self, broadcast_id: int) -> bool:
+        """ارسال را لغو می‌کند؛ اگر در پروسه دیگری اجرا شود، آن پروسه با ذخیره دسته بعدی متوجه می‌شود."""
+        if not self.db_manager.finish_broadcast(broadcast_id, 'cancelled'):
+            return False
+        with self._lock:
+            if broadcast_id in self._runners:
+                self._cancelled.add(broadcast_id)
+        return True
+
+    def _launch(self, broadcast):
+        with self._lock:
+            if broadcast['id'] in self._runners:
+                return
+            thread = threading.Thread(target=self._run, args=(broadcast,), name=f"broadcast-{broadcast['id']}", daemon=True)
+            self._runners[broadcast['id']] = thread
+        thread.start()
+
+    def _send_one(self, text, recipient):
+        try:
+            with self.bot.outbound_context(priority=PRIORITY_BULK):
+                self.bot.send_message(recipient['telegram_id'], text)
+            return 'sent'
+        except ApiTelegramException as e:
+            if _is_unreachable(e):
+                return 'blocked'
+            logger.warning(f"Broadcast message to {recipient['telegram_id']} failed: {e}")
+            return 'failed'
+        except Exception as e:
+            logger.warning(f"Broadcast message to {recipient['telegram_id']} failed: {e}")
+            return 'failed'
+
+    def _report(self, broadcast, counts, status, started, processed_here):
+        processed = counts['sent'] + counts['failed'] + counts['blocked']
+        total = max(broadcast['total_count'], processed)
+        elapsed = time.monotonic() - started
+        rate = processed_here / elapsed if elapsed > 0 else 0
+        eta = "-"
+        if status == 'running' and rate > 0:
+            eta = time.strftime('%H:%M:%S', time.gmtime((total - processed) / rate))
+        text = messages.BROADCAST_PROGRESS.format(
+            broadcast_id=broadcast['id'], status=messages.BROADCAST_STATUS_LABELS.get(status, status),
+            processed=processed, total=total, percent=round(processed * 100 / total) if total else 100,
+            sent=counts['sent'], blocked=counts['blocked'], failed=counts['failed'], rate=round(rate, 1), eta=eta)
+        markup = (inline_keyboards.get_broadcast_progress_menu(broadcast['id']) if status == 'running'
+                  else inline_keyboards.get_back_button("admin_main_menu"))
+        try:
+            if broadcast.get('progress_message_id'):
+                self.bot.edit_message_text(text, broadcast['admin_telegram_id'], broadcast['progress_message_id'], reply_markup=markup)
+            else:
+                sent = self.bot.send_message(broadcast['admin_telegram_id'], text, reply_markup=markup)
+                broadcast['progress_message_id'] = sent.message_id
+        except Exception as e:
+            if 'message is not modified' not in str(e):
+                logger.warning(f"Could not update progress message of broadcast {broadcast['id']}: {e}")
+
+    def _run(self, broadcast):
+        broadcast_id = broadcast['id']
+        counts = {'sent': broadcast['sent_count'], 'failed': broadcast['failed_count'], 'blocked': broadcast['blocked_count']}
+        started, processed_here, last_report = time.monotonic(), 0, 0.0
+        status = 'running'
+        last_user_id = broadcast['last_user_id']
+        try:
+            with ThreadPoolExecutor(max_workers=self.senders, thread_name_prefix=f"broadcast-{broadcast_id}-sender") as pool:
+                while True:
+                    if self._stop_event.is_set():
+                        status = 'interrupted'
+                        break
+                    if broadcast_id in self._cancelled:
+                        status = 'cancelled'
+                        break
+                    chunk = self.db_manager.get_broadcast_recipients(last_user_id, self.chunk_size)
+                    if chunk is None:
+                        raise RuntimeError("could not read recipients")
+                    if not chunk:
+                        status = 'done' if self.db_manager.finish_broadcast(broadcast_id, 'done') else 'cancelled'
+                        break
+                    results = list(pool.map(lambda recipient: self._send_one(broadcast['message_text'], recipient), chunk))
+                    delta = {key: results.count(key) for key in counts}
+                    blocked_ids = [recipient['id'] for recipient, result in zip(chunk, results) if result == 'blocked']
+                    self.db_manager.mark_users_blocked(blocked_ids)
+                    current = self.db_manager.update_broadcast_progress(
+                        broadcast_id, chunk[-1]['id'], delta['sent'], delta['failed'], delta['blocked'])
+                    last_user_id = chunk[-1]['id']
+                    for key in counts:
+                        counts[key] += delta[key]
+                    processed_here += len(chunk)
+                    if current is not None and current != 'running':
+                        status = current
+                        break
+                    if time.monotonic() - last_report >= BROADCAST_PROGRESS_INTERVAL_SECONDS:
+                        self._report(broadcast, counts, 'running', started, processed_here)
+                        last_report = time.monotonic()
+        except Exception as e:
+            # heartbeat دیگر تمدید نمی‌شود و ارسال پس از BROADCAST_LOCK_TIMEOUT_SECONDS دوباره برداشته می‌شود
+            logger.error(f"Broadcast {broadcast_id} stopped unexpectedly: {e}")
+            return
+        finally:
+            with self._lock:
+                self._runners.pop(broadcast_id, None)
+                self._cancelled.discard(broadcast_id)
+
+        if status == 'interrupted':
+            self.db_manager.release_broadcast(broadcast_id)
+            logger.info(f"Broadcast {broadcast_id} paused at shutdown; it will resume on next start.")
+            return
+        self._report(broadcast, counts, status, started, processed_here)
+        logger.info(f"Broadcast {broadcast_id} {status}: sent={counts['sent']}, blocked={counts['blocked']}, failed={counts['failed']}.")
+
+    def _supervise(self):
+        while not self._stop_event.is_set():
+            for broadcast in self.db_manager.claim_stale_broadcasts(BROADCAST_LOCK_TIMEOUT_SECONDS):
+                logger.info(f"Resuming broadcast {broadcast['id']} after user {broadcast['last_user_id']}.")
+                self._launch(broadcast)
+            self._stop_event.wait(BROADCAST_LOCK_TIMEOUT_SECONDS / 2)
+
+    def start(self):
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=self._supervise, name="broadcast-supervisor", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10):
+        """ارسال‌های در حال اجرا پس از پایان دسته فعلی متوقف و برای ادامه در اجرای بعدی آزاد می‌شوند."""
+        self._stop_event.set()
+        with self._lock:
+            runners = list(self._runners.values())
+        deadline = time.monotonic() + timeout
+        for thread in runners:
+            thread.join(timeout=max(0, deadline - time.monotonic()))
@@ -0,0 +1,59 @@
+# utils/cache.py
+
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    یک کش ساده و thread-safe در حافظه با زمان انقضا برای هر مقدار.
+    اگر max_size تعیین شود، قدیمی‌ترین مقدار استفاده نشده (LRU) حذف می‌شود.
+    TTL صفر یا منفی یعنی کش نکردن (هر get دوباره به منبع می‌رود)، نه نگهداری بی‌پایان.
+    """
+    def __init__(self, ttl_seconds: float, max_size: int = None):
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING:
+                return default
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl: float = None):
+        ttl = self.ttl_seconds if ttl is None else ttl
+        if not ttl or ttl <= 0:
+            self.invalidate(key)
+            return
+        expires_at = time.monotonic() + ttl
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            if self.max_size and len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
@@ -0,0 +1,110 @@
+# utils/client_gc.py
+
+import logging
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from api_client import client_registry
+from config import CLIENT_GC_GRACE_HOURS, CLIENT_GC_BATCH_SIZE, CLIENT_GC_PANEL_RATE_PER_SECOND, CLIENT_GC_MAX_WORKERS
+from utils.periodic import PeriodicWorker
+
+logger = logging.getLogger(__name__)
+
+# در هر پروسه فقط یک پاکسازی همزمان (دوره‌ای یا دستی از پنل ادمین) اجرا می‌شود
+_sweep_lock = threading.Lock()
+
+
+class ExpiredClientCollector(PeriodicWorker):
+    """
+    کلاینت‌های خریدهای منقضی یا تمام شده را از پنل‌ها حذف کرده و خریدها را غیرفعال می‌کند تا
+    تنظیمات اینباندها (و پاسخ list_inbounds) با کلاینت‌های مرده بزرگ نشوند.
+    خریدها به صورت دسته‌ای (CLIENT_GC_BATCH_SIZE) پردازش می‌شوند؛ درخواست‌های هر پنل به ترتیب و با
+    سقف CLIENT_GC_PANEL_RATE_PER_SECOND ارسال می‌شوند و پنل‌های مختلف به صورت موازی.
+    با start() در یک نخ پس‌زمینه به صورت دوره‌ای اجرا می‌شود.
+    """
+    thread_name = "client-gc"
+    display_name = "Expired-client sweeper"
+
+    def __init__(self, db_manager, xui_api_class, interval_seconds: float = 0):
+        self.db_manager = db_manager
+        self.xui_api = xui_api_class
+        super().__init__(interval_seconds)
+
+    def _delete_on_server(self, server_id, items):
+        """
+        items: لیست (purchase_id, inbound_id, client_uuid). مجموعه purchase_id هایی که حداقل
+        یک درخواست حذفشان بدون پاسخ ماند برمی‌گرداند (این خریدها در اجرای بعدی دوباره بررسی می‌شوند).
+        """
+        server = self.db_manager.get_server_by_id(server_id)
+        if not server:
+            return set()  # سرور حذف شده است؛ چیزی برای پاکسازی روی پنل نمانده
+        client = client_registry.get_client_for_server(server, self.xui_api)
+        min_interval = 1.0 / CLIENT_GC_PANEL_RATE_PER_SECOND if CLIENT_GC_PANEL_RATE_PER_SECOND > 0 else 0
+        unreachable, next_call_at = set(), time.monotonic()
+        for purchase_id, inbound_id, client_uuid in items:
+            if purchase_id in unreachable:
+                continue
+            delay = next_call_at - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            next_call_at = time.monotonic() + min_interval
+            if client.delete_client(inbound_id, client_uuid) is None:
+                unreachable.add(purchase_id)
+        return unreachable
+
+    def _sweep_batch(self, batch, targets):
+        """کلاینت‌های یک دسته را از پنل‌ها حذف کرده و id خریدهایی که کاملاً پاکسازی شدند را برمی‌گرداند."""
+        uuids = {p['id']: p['xui_client_uuid'] for p in batch}
+        items_by_server = {}
+        for target in targets:
+            if uuids.get(target['purchase_id']):
+                items_by_server.setdefault(target['server_id'], []).append(
+                    (target['purchase_id'], target['inbound_id'], uuids[target['purchase_id']]))
+
+        unreachable = set()
+        if items_by_server:
+            workers = min(CLIENT_GC_MAX_WORKERS, len(items_by_server))
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="client-gc") as executor:
+                for failed in executor.map(lambda entry: self._delete_on_server(*entry), items_by_server.items()):
+                    unreachable |= failed
+        return [purchase_id for purchase_id in uuids if purchase_id not in unreachable]
+
+    def run_once(self, dry_run: bool = False):
+        """
+        یک دور کامل پاکسازی. در حالت dry_run هیچ تغییری در پنل‌ها یا دیتابیس داده نمی‌شود.
+        خروجی یک گزارش: {'purchases', 'by_reason', 'clients_by_server', 'deactivated', 'skipped', 'dry_run', 'busy'}
+        """
+        report = {'purchases': 0, 'by_reason': Counter(), 'clients_by_server': Counter(),
+                  'deactivated': 0, 'skipped': 0, 'dry_run': dry_run, 'busy': False}
+        if not _sweep_lock.acquire(blocking=False):
+            logger.warning("Expired-client sweep already running; skipping this run.")
+            report['busy'] = True
+            return report
+        try:
+            after_id = 0
+            while not self._stop_event.is_set():
+                batch = self.db_manager.get_expired_purchases(CLIENT_GC_GRACE_HOURS, CLIENT_GC_BATCH_SIZE, after_id)
+                if not batch:
+                    break
+                after_id = batch[-1]['id']
+                targets = self.db_manager.get_purchase_client_targets([p['id'] for p in batch])
+
+                report['purchases'] += len(batch)
+                report['by_reason'].update(p['reason'] for p in batch)
+                report['clients_by_server'].update(t['server_id'] for t in targets)
+                if dry_run:
+                    continue
+
+                cleaned = self._sweep_batch(batch, targets)
+                report['deactivated'] += self.db_manager.deactivate_purchases(cleaned)
+                report['skipped'] += len(batch) - len(cleaned)
+        finally:
+            _sweep_lock.release()
+
+        if report['purchases']:
+            logger.info(f"Expired-client sweep{' (dry run)' if dry_run else ''}: {report['purchases']} purchase(s), "
+                        f"{sum(report['clients_by_server'].values())} panel client(s), {report['deactivated']} deactivated, "
+                        f"{report['skipped']} left for retry.")
+        return report
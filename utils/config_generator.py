@@ -4,38 +4,121 @@ import json
 import logging
 import uuid
 import datetime
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from urllib.parse import quote
 import base64
 
+from config import (PROVISION_MAX_WORKERS, PROVISION_PER_SERVER_CONCURRENCY, PROVISION_DEADLINE_SECONDS,
+                    INBOUND_SNAPSHOT_TTL_SECONDS)
+
 from utils.helpers import generate_random_string
+from api_client import client_registry
+from api_client.xui_api_client import INBOUND_SUMMARY_FIELDS
 
 logger = logging.getLogger(__name__)
 
+
+def new_client_identity(user_telegram_id: int) -> dict:
+    """شناسه‌های یک کلاینت جدید (uuid، ایمیل و subId پنل و شناسه لینک سابسکریپشن ربات)."""
+    return {
+        'uuid': str(uuid.uuid4()),
+        'email': f"u{user_telegram_id}.{generate_random_string(6)}",
+        'sub_id': generate_random_string(12),
+        'webhook_sub_id': generate_random_string(16),
+    }
+
+
 class ConfigGenerator:
     def __init__(self, xui_api_client, db_manager):
         self.xui_api = xui_api_client
         self.db_manager = db_manager
+        # Pool نخ‌ها برای ارسال همزمان درخواست‌ها به پنل‌ها (مقدار 1 یعنی اجرای ترتیبی)
+        self._executor = ThreadPoolExecutor(max_workers=max(1, PROVISION_MAX_WORKERS), thread_name_prefix="provision")
+        self._server_semaphores = {}
+        self._semaphores_lock = threading.Lock()
         logger.info("ConfigGenerator initialized.")
 
-    def create_subscription_for_server(self, user_telegram_id: int, server_id: int, total_gb: float, duration_days: int):
+    def create_subscription_for_server(self, user_telegram_id: int, server_id: int, total_gb: float, duration_days: int,
+                                       identity: dict = None, existing_ok: bool = False):
         inbounds_list = self.db_manager.get_server_inbounds(server_id, only_active=True)
-        return self._build_configs(user_telegram_id, inbounds_list, total_gb, duration_days)
+        return self._build_configs(user_telegram_id, inbounds_list, total_gb, duration_days, identity, existing_ok)
 
-    def create_subscription_for_profile(self, user_telegram_id: int, profile_id: int, total_gb: float, duration_days: int):
+    def create_subscription_for_profile(self, user_telegram_id: int, profile_id: int, total_gb: float, duration_days: int,
+                                        identity: dict = None, existing_ok: bool = False):
         inbounds_list = self.db_manager.get_inbounds_for_profile(profile_id)
-        return self._build_configs(user_telegram_id, inbounds_list, total_gb, duration_days)
-
-    def _build_configs(self, user_telegram_id: int, inbounds_list: list, total_gb: float, duration_days: int):
-        all_generated_configs = []
-        
-        webhook_subscription_id = generate_random_string(16)
-        master_client_uuid = str(uuid.uuid4())
-        master_client_email = f"u{user_telegram_id}.{generate_random_string(6)}"
-        master_xui_sub_id = generate_random_string(12)
-        
-        client_details_for_db = {
-            'uuid': master_client_uuid, 'email': master_client_email, 'sub_id': master_xui_sub_id
-        }
+        return self._build_configs(user_telegram_id, inbounds_list, total_gb, duration_days, identity, existing_ok)
+
+    def _get_server_semaphore(self, server_id):
+        with self._semaphores_lock:
+            if server_id not in self._server_semaphores:
+                self._server_semaphores[server_id] = threading.BoundedSemaphore(PROVISION_PER_SERVER_CONCURRENCY)
+            return self._server_semaphores[server_id]
+
+    def _call_with_server_limit(self, server_id, deadline, func, *args):
+        """func را با رعایت سقف درخواست‌های همزمان به یک سرور اجرا می‌کند."""
+        semaphore = self._get_server_semaphore(server_id)
+        if not semaphore.acquire(timeout=max(0, deadline - time.monotonic())):
+            raise TimeoutError(f"Provisioning deadline reached while waiting for server {server_id}")
+        try:
+            return func(*args)
+        finally:
+            semaphore.release()
+
+    def _fresh_snapshots(self, inbounds: list):
+        """
+        اگر snapshot همه اینباندهای داده شده موجود و تازه‌تر از INBOUND_SNAPSHOT_TTL_SECONDS باشد،
+        دیکشنری {inbound_id: snapshot} را برمی‌گرداند؛ در غیر این صورت None.
+        """
+        if INBOUND_SNAPSHOT_TTL_SECONDS <= 0:
+            return None
+        now = datetime.datetime.now(datetime.timezone.utc)
+        snapshots = {}
+        for s_inbound in inbounds:
+            snapshot_json, updated_at = s_inbound.get('snapshot_json'), s_inbound.get('snapshot_updated_at')
+            if not snapshot_json or not updated_at or (now - updated_at).total_seconds() > INBOUND_SNAPSHOT_TTL_SECONDS:
+                return None
+            snapshots[s_inbound['inbound_id']] = json.loads(snapshot_json)
+        return snapshots
+
+    def _build_configs(self, user_telegram_id: int, inbounds_list: list, total_gb: float, duration_days: int,
+                       identity: dict = None, existing_ok: bool = False):
+        results = self._provision(user_telegram_id, inbounds_list, total_gb, duration_days,
+                                  [identity] if identity else None, existing_ok)
+        return results[0] if results else (None, None, None)
+
+    def _provision(self, user_telegram_id: int, inbounds_list: list, total_gb: float, duration_days: int,
+                   identities: list = None, existing_ok: bool = False):
+        """
+        کلاینت‌های identities (پیش‌فرض یک کلاینت جدید) را روی تمام اینباندهای داده شده می‌سازد؛
+        برای هر اینباند تمام کلاینت‌ها در یک درخواست addClient ارسال می‌شوند. درخواست‌ها به سرورهای مختلف به صورت همزمان ارسال می‌شوند
+        (با سقف همزمانی برای هر سرور و یک مهلت کلی)، پس زمان کل تقریباً برابر با کندترین پنل است.
+        identities (خروجی new_client_identity) اجازه می‌دهد تلاش دوباره یک کار همان کلاینت‌ها را بسازد؛
+        با existing_ok کلاینتی که تلاش قبلی روی اینباند ساخته است موفق حساب می‌شود.
+        لیست (webhook_subscription_id, configs, client_details) را برای اشتراک‌هایی که حداقل یک کانفیگ دارند برمی‌گرداند.
+        """
+        expiry_time_ms = 0
+        if duration_days and duration_days > 0:
+            expire_date = datetime.datetime.now() + datetime.timedelta(days=duration_days)
+            expiry_time_ms = int(expire_date.timestamp() * 1000)
+        total_traffic_bytes = int(total_gb * (1024**3)) if total_gb and total_gb > 0 else 0
+
+        if identities is None:
+            identities = [new_client_identity(user_telegram_id)]
+        subscriptions = []
+        for identity in identities:
+            subscriptions.append({
+                'webhook_sub_id': identity['webhook_sub_id'],
+                'details': {'uuid': identity['uuid'], 'email': identity['email'], 'sub_id': identity['sub_id']},
+                # تنظیمات کلاینت (برای تمام اینباندها یکسان است)
+                'settings': {
+                    "id": identity['uuid'], "email": identity['email'], "flow": "",
+                    "totalGB": total_traffic_bytes, "expiryTime": expiry_time_ms,
+                    "enable": True, "tgId": str(user_telegram_id), "subId": identity['sub_id'],
+                },
+            })
+        client_settings_list = [subscription['settings'] for subscription in subscriptions]
 
         inbounds_by_server = {}
         for inbound_info in inbounds_list:
@@ -44,63 +127,113 @@ class ConfigGenerator:
                 inbounds_by_server[server_id] = []
             inbounds_by_server[server_id].append(inbound_info)
 
-        for server_id, inbounds in inbounds_by_server.items():
+        servers, api_clients = {}, {}
+        for server_id in inbounds_by_server:
             server_data = self.db_manager.get_server_by_id(server_id)
             if not server_data: continue
+            servers[server_id] = server_data
+            api_clients[server_id] = client_registry.get_client_for_server(server_data, self.xui_api)
 
-            api_client = self.xui_api(panel_url=server_data['panel_url'], username=server_data['username'], password=server_data['password'])
-            
-            panel_inbounds_details = {i['id']: i for i in api_client.list_inbounds()}
-            if not panel_inbounds_details:
-                logger.error(f"Could not retrieve any inbound details from server {server_id}.")
-                continue
-
-            expiry_time_ms = 0
-            if duration_days and duration_days > 0:
-                expire_date = datetime.datetime.now() + datetime.timedelta(days=duration_days)
-                expiry_time_ms = int(expire_date.timestamp() * 1000)
-            
-            total_traffic_bytes = int(total_gb * (1024**3)) if total_gb and total_gb > 0 else 0
+        deadline = time.monotonic() + PROVISION_DEADLINE_SECONDS
+        inbound_snapshots = {}        # server_id -> {inbound_id: snapshot}
+        added_inbounds = set()        # (server_id, inbound_id)
+        pending = {}                  # future -> (kind, server_id, inbound_id)
 
-            for s_inbound in inbounds:
-                # ساخت JSON برای تنظیمات کلاینت
-                client_settings = {
-                    "id": master_client_uuid, "email": master_client_email, "flow": "",
-                    "totalGB": total_traffic_bytes, "expiryTime": expiry_time_ms,
-                    "enable": True, "tgId": str(user_telegram_id), "subId": master_xui_sub_id,
-                }
-                
-                # تبدیل دیکشنری به یک رشته JSON
-                client_settings_string = json.dumps({"clients": [client_settings]})
-                
-                # --- FIX: فراخوانی صحیح تابع جدید ---
-                if not api_client.add_client(s_inbound['inbound_id'], client_settings_string):
-                    logger.error(f"Failed to add client to inbound {s_inbound['inbound_id']} on server {server_id}.")
+        def submit_add_client_tasks(server_id):
+            for s_inbound in inbounds_by_server[server_id]:
+                if s_inbound['inbound_id'] not in inbound_snapshots[server_id]:
+                    logger.warning(f"Details for inbound ID {s_inbound['inbound_id']} not found on server {server_id}; skipping it.")
+                    continue
+                add_future = self._executor.submit(
+                    self._call_with_server_limit, server_id, deadline,
+                    api_clients[server_id].add_clients, s_inbound['inbound_id'], client_settings_list, existing_ok
+                )
+                pending[add_future] = ('add', server_id, s_inbound['inbound_id'])
+
+        # مرحله اول: اگر snapshot تازه اینباندها در دیتابیس باشد، لیست کامل اینباندها از پنل گرفته نمی‌شود
+        for server_id, api_client in api_clients.items():
+            cached = self._fresh_snapshots(inbounds_by_server[server_id])
+            if cached is not None:
+                inbound_snapshots[server_id] = cached
+                submit_add_client_tasks(server_id)
+            else:
+                future = self._executor.submit(self._call_with_server_limit, server_id, deadline,
+                                               api_client.list_inbounds, INBOUND_SUMMARY_FIELDS)
+                pending[future] = ('list', server_id, None)
+
+        # مرحله دوم: به محض آماده شدن هر سرور، افزودن کلاینت به اینباندهای آن
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            done, _ = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                kind, server_id, inbound_id = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.error(f"Provisioning step '{kind}' failed on server {server_id}: {e}")
                     continue
 
-                inbound_details = panel_inbounds_details.get(s_inbound['inbound_id'])
-                if inbound_details:
-                    single_config = self._generate_single_config_url(master_client_uuid, server_data, inbound_details)
+                if kind == 'list':
+                    # فقط اینباندهای همین سفارش؛ اینباند خراب دیگری روی پنل نباید خرید را خراب کند
+                    needed_ids = {s_inbound['inbound_id'] for s_inbound in inbounds_by_server[server_id]}
+                    snapshots = {}
+                    for panel_inbound in (result or []):
+                        if panel_inbound.get('id') not in needed_ids:
+                            continue
+                        try:
+                            snapshots[panel_inbound['id']] = build_inbound_snapshot(panel_inbound)
+                        except Exception as e:
+                            logger.error(f"Skipping inbound {panel_inbound.get('id')} on server {server_id}: bad settings ({e}).")
+                    if not snapshots:
+                        logger.error(f"Could not retrieve any inbound details from server {server_id}.")
+                        continue
+                    inbound_snapshots[server_id] = snapshots
+                    try:
+                        self.db_manager.update_inbound_snapshots(server_id, snapshots)
+                    except Exception as e:
+                        logger.error(f"Could not save inbound snapshots for server {server_id}: {e}")
+                    submit_add_client_tasks(server_id)
+                elif result:
+                    added_inbounds.add((server_id, inbound_id))
+                else:
+                    logger.error(f"Failed to add client to inbound {inbound_id} on server {server_id}.")
+
+        if pending:
+            logger.error(f"Provisioning deadline of {PROVISION_DEADLINE_SECONDS}s reached; {len(pending)} panel call(s) did not finish.")
+            for future in pending:
+                future.cancel()
+
+        # ساخت لینک‌ها به ترتیب اصلی اینباندها
+        results = []
+        for subscription in subscriptions:
+            configs = []
+            for s_inbound in inbounds_list:
+                server_id, inbound_id = s_inbound['server_id'], s_inbound['inbound_id']
+                if (server_id, inbound_id) not in added_inbounds:
+                    continue
+                snapshot = inbound_snapshots.get(server_id, {}).get(inbound_id)
+                if snapshot:
+                    single_config = self._generate_single_config_url(subscription['details']['uuid'], servers[server_id], snapshot)
                     if single_config:
-                        all_generated_configs.append(single_config)
+                        configs.append(single_config)
                 else:
-                    logger.warning(f"Details for inbound ID {s_inbound['inbound_id']} not found.")
+                    logger.warning(f"Details for inbound ID {inbound_id} not found.")
+            if configs:
+                results.append((subscription['webhook_sub_id'], configs, subscription['details']))
+        return results
 
-        return (webhook_subscription_id, all_generated_configs, client_details_for_db) if all_generated_configs else (None, None, None)
-    
-    
-    def _generate_single_config_url(self, client_uuid: str, server_data: dict, inbound_details: dict) -> dict or None:
-        """This function now correctly handles various VLESS configurations."""
+    def _generate_single_config_url(self, client_uuid: str, server_data: dict, snapshot: dict) -> dict or None:
+        """لینک کانفیگ را از snapshot فشرده اینباند (خروجی build_inbound_snapshot) می‌سازد."""
         try:
-            protocol = inbound_details.get('protocol')
-            remark = inbound_details.get('remark', f"Alamor-{server_data['name']}")
+            protocol = snapshot.get('protocol')
+            remark = snapshot.get('remark') or f"Alamor-{server_data['name']}"
             # آدرس را از subscription_base_url استخراج می‌کنیم
             address = server_data['subscription_base_url'].split('//')[1].split(':')[0].split('/')[0]
-            port = inbound_details.get('port')
-            
-            stream_settings = json.loads(inbound_details.get('streamSettings', '{}'))
-            network = stream_settings.get('network', 'tcp')
-            security = stream_settings.get('security', 'none')
+            port = snapshot.get('port')
+            network = snapshot.get('network', 'tcp')
+            security = snapshot.get('security', 'none')
             config_url = ""
 
             if protocol == 'vless':
@@ -110,26 +243,25 @@ class ConfigGenerator:
                     params['security'] = security
                 
                 if security == 'reality':
-                    reality_settings = stream_settings.get('realitySettings', {})
-                    params['fp'] = reality_settings.get('fingerprint', '')
-                    params['pbk'] = reality_settings.get('publicKey', '')
-                    params['sid'] = reality_settings.get('shortId', '')
-                    params['sni'] = reality_settings.get('serverNames', [''])[0]
+                    reality = snapshot.get('reality') or {}
+                    params['fp'] = reality.get('fp', '')
+                    params['pbk'] = reality.get('pbk', '')
+                    params['sid'] = reality.get('sid', '')
+                    params['sni'] = reality.get('sni', '')
                 
                 if security == 'tls':
-                    tls_settings = stream_settings.get('tlsSettings', {})
-                    params['sni'] = tls_settings.get('serverName', address)
+                    tls_sni = snapshot.get('tls_sni')
+                    params['sni'] = tls_sni if tls_sni is not None else address
 
                 if network == 'ws':
-                    ws_settings = stream_settings.get('wsSettings', {})
-                    params['path'] = ws_settings.get('path', '/')
-                    params['host'] = ws_settings.get('headers', {}).get('Host', address)
+                    ws_path, ws_host = snapshot.get('ws_path'), snapshot.get('ws_host')
+                    params['path'] = ws_path if ws_path is not None else '/'
+                    params['host'] = ws_host if ws_host is not None else address
                     if security == 'tls':
                         params['sni'] = params['host']
 
                 if security == 'xtls':
-                    xtls_settings = stream_settings.get('xtlsSettings', {})
-                    params['flow'] = xtls_settings.get('flow', 'xtls-rprx-direct')
+                    params['flow'] = snapshot.get('xtls_flow') or 'xtls-rprx-direct'
 
                 query_string = '&'.join([f"{k}={quote(str(v))}" for k, v in params.items() if v])
                 config_url = f"vless://{client_uuid}@{address}:{port}?{query_string}#{quote(remark)}"
@@ -138,4 +270,42 @@ class ConfigGenerator:
                 return {"remark": remark, "url": config_url}
         except Exception as e:
             logger.error(f"Error in _generate_single_config_url: {e}")
-        return None
\ No newline at end of file
+        return None
+
+
+def build_inbound_snapshot(inbound_details: dict) -> dict:
+    """
+    از جزئیات کامل یک اینباند پنل، فقط فیلدهای لازم برای ساخت لینک کانفیگ را استخراج می‌کند
+    (بدون لیست کلاینت‌ها). مقادیر None یعنی از پیش‌فرض مبتنی بر آدرس سرور استفاده شود.
+    """
+    stream_settings = inbound_details.get('streamSettings') or '{}'
+    if isinstance(stream_settings, str):
+        stream_settings = json.loads(stream_settings)
+    network = stream_settings.get('network', 'tcp')
+    security = stream_settings.get('security', 'none')
+
+    snapshot = {
+        'id': inbound_details.get('id'),
+        'protocol': inbound_details.get('protocol'),
+        'port': inbound_details.get('port'),
+        'remark': inbound_details.get('remark'),
+        'network': network,
+        'security': security,
+    }
+    if security == 'reality':
+        reality_settings = stream_settings.get('realitySettings', {})
+        snapshot['reality'] = {
+            'fp': reality_settings.get('fingerprint', ''),
+            'pbk': reality_settings.get('publicKey', ''),
+            'sid': reality_settings.get('shortId', ''),
+            'sni': (reality_settings.get('serverNames') or [''])[0],
+        }
+    if security == 'tls':
+        snapshot['tls_sni'] = stream_settings.get('tlsSettings', {}).get('serverName')
+    if network == 'ws':
+        ws_settings = stream_settings.get('wsSettings', {})
+        snapshot['ws_path'] = ws_settings.get('path')
+        snapshot['ws_host'] = ws_settings.get('headers', {}).get('Host')
+    if security == 'xtls':
+        snapshot['xtls_flow'] = stream_settings.get('xtlsSettings', {}).get('flow')
+    return snapshot
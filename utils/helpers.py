@@ -7,9 +7,15 @@ import string
 
 # این خط برای دسترسی به لیست ادمین‌ها اضافه شده است
 from config import ADMIN_IDS
+from config import CHANNEL_MEMBER_CACHE_MAX_ENTRIES, CHANNEL_MEMBER_CACHE_TTL_SECONDS, CHANNEL_MEMBER_CACHE_NEGATIVE_TTL_SECONDS
+from utils.cache import TTLCache
 
 logger = logging.getLogger(__name__)
 
+_MEMBER_STATUSES = ('member', 'creator', 'administrator')
+# (channel_id, user_id) -> عضو است یا نه
+_channel_member_cache = TTLCache(ttl_seconds=CHANNEL_MEMBER_CACHE_TTL_SECONDS, max_size=CHANNEL_MEMBER_CACHE_MAX_ENTRIES)
+
 
 # تابع is_admin در اینجا تعریف شده است
 def is_admin(user_id: int) -> bool:
@@ -24,15 +30,29 @@ def is_user_member_of_channel(bot: telebot.TeleBot, channel_id: int, user_id: in
     if channel_id is None:
         return True
 
+    is_member = _channel_member_cache.get((channel_id, user_id))
+    if is_member is not None:
+        return is_member
     try:
         chat_member = bot.get_chat_member(channel_id, user_id)
-        return chat_member.status in ['member', 'creator', 'administrator']
+        return update_channel_membership(channel_id, user_id, chat_member.status)
     except Exception as e:
         logger.error(f"Error checking user {user_id} membership in channel {channel_id}: {e}")
         # در صورت بروز خطا (مثلا اگر ربات از کانال حذف شده باشد)، دسترسی را مجاز می‌دانیم تا ربات متوقف نشود
         return True
 
 
+def update_channel_membership(channel_id: int, user_id: int, status: str) -> bool:
+    """
+    وضعیت عضویت کاربر را در کش ثبت می‌کند (از get_chat_member یا update های chat_member کانال).
+    نتیجه منفی فقط CHANNEL_MEMBER_CACHE_NEGATIVE_TTL_SECONDS ثانیه نگه داشته می‌شود.
+    """
+    is_member = status in _MEMBER_STATUSES
+    _channel_member_cache.set((channel_id, user_id), is_member,
+                              ttl=None if is_member else CHANNEL_MEMBER_CACHE_NEGATIVE_TTL_SECONDS)
+    return is_member
+
+
 def is_float_or_int(value) -> bool:
     """
     بررسی می‌کند که آیا یک رشته می‌تواند به float یا int تبدیل شود یا خیر.
@@ -62,4 +82,9 @@ def generate_random_string(length=10) -> str:
     یک رشته تصادفی از حروف کوچک و اعداد به طول مشخص تولید می‌کند.
     """
     characters = string.ascii_lowercase + string.digits
-    return ''.join(random.choice(characters) for i in range(length))
\ No newline at end of file
+    return ''.join(random.choice(characters) for i in range(length))
+
+
+def bytes_to_gb(num_bytes) -> float:
+    """تعداد بایت را به گیگابایت (با دو رقم اعشار) تبدیل می‌کند."""
+    return round((num_bytes or 0) / (1024 ** 3), 2)
@@ -48,6 +48,56 @@ SERVER_DELETED_ERROR = "❌ حذف سرور ناموفق بود."
 SERVER_NOT_FOUND = "سروری با ID وارد شده یافت نشد."
 TESTING_ALL_SERVERS = "⏳ در حال تست اتصال به تمام سرورها..."
 TEST_RESULTS_HEADER = "📊 نتایج تست اتصال سرورها:\n\n"
+RECONCILE_RUNNING = "⏳ در حال مقایسه خریدها با کلاینت‌های پنل‌ها..."
+RECONCILE_REPORT_HEADER = "🔍 **گزارش همخوانی دیتابیس و پنل‌ها**\n\n"
+RECONCILE_FIX_REPORT_HEADER = "🛠 **نتیجه اصلاح ناهمخوانی‌ها**\n\n"
+RECONCILE_SERVER_LINE = (
+    "▫️ **{server_name}**: {purchases} خرید، {panel_clients} کلاینت پنل\n"
+    "   نبود در پنل: {missing} | اضافی در پنل: {orphaned} | ناهمخوان: {mismatched} | اصلاح شده: {fixed}\n"
+)
+RECONCILE_SERVER_UNREACHABLE = "▫️ **{server_name}**: ❌ پنل در دسترس نبود\n"
+RECONCILE_ORPHAN_NOTE = "\n_کلاینت‌های اضافی در پنل فقط گزارش می‌شوند و به صورت خودکار حذف نمی‌شوند._"
+ADMIN_DASHBOARD_TEXT = (
+    "📊 **داشبورد وضعیت ربات**\n\n"
+    "⚙️ **پردازش updateها**\n"
+    "▫️ تعداد worker: {workers} (ظرفیت صف هر worker: {queue_size})\n"
+    "▫️ در صف: {queued} (بیشترین عمق صف: {max_queue_depth})\n"
+    "▫️ پردازش شده: {processed} | خطا: {errors} | رد شده (صف پر): {rejected}\n"
+    "▫️ میانگین زمان پردازش: {avg_ms}ms\n\n"
+    "🗄 **اتصالات دیتابیس**\n"
+    "▫️ در حال استفاده: {db_in_use} | آزاد: {db_idle} (حداکثر {db_max_size})\n"
+    "▫️ انتظار برای اتصال: {db_waits} | timeout: {db_timeouts}\n\n"
+    "🛠 **صف ساخت سرویس**\n"
+    "▫️ در انتظار: {jobs_pending} | در حال اجرا: {jobs_running} | ناموفق (dead): {jobs_dead}"
+)
+CLIENT_GC_RUNNING = "⏳ در حال بررسی خریدهای منقضی..."
+CLIENT_GC_BUSY = "⚠️ یک پاکسازی دیگر در حال اجراست. لطفاً بعداً دوباره تلاش کنید."
+CLIENT_GC_NOTHING_TO_DO = "✅ هیچ خرید منقضی یا تمام شده‌ای برای پاکسازی وجود ندارد."
+CLIENT_GC_DRY_RUN_REPORT = (
+    "🧹 **گزارش پیش‌نمایش پاکسازی (بدون اعمال تغییر)**\n\n"
+    "تعداد خریدها: {purchases}\n"
+    "منقضی شده: {expired} | حجم تمام شده: {exhausted}\n\n"
+    "**کلاینت‌های قابل حذف در هر سرور:**\n{servers}"
+)
+CLIENT_GC_DONE_REPORT = (
+    "✅ **پاکسازی انجام شد.**\n\n"
+    "خریدهای غیرفعال شده: {deactivated}\n"
+    "خریدهای باقی‌مانده برای تلاش بعدی (پنل در دسترس نبود): {skipped}"
+)
+
+# --- ارسال همگانی ---
+BROADCAST_PROMPT = "📢 لطفاً متن پیامی که می‌خواهید برای همه کاربران ارسال شود را بفرستید:"
+BROADCAST_CONFIRM = "📢 پیش‌نمایش پیام همگانی:\n\n{text}\n\n➖➖➖\nاین پیام برای {count} کاربر ارسال می‌شود. آیا مطمئن هستید؟"
+BROADCAST_START_FAILED = "❌ خطایی در ثبت ارسال همگانی رخ داد."
+BROADCAST_NOT_RUNNING = "ℹ️ این ارسال همگانی قبلاً به پایان رسیده یا لغو شده است."
+BROADCAST_STATUS_LABELS = {'running': "⏳ در حال ارسال", 'done': "✅ پایان یافته", 'cancelled': "⛔️ لغو شده"}
+BROADCAST_PROGRESS = (
+    "📢 ارسال همگانی #{broadcast_id}\n\n"
+    "وضعیت: {status}\n"
+    "▫️ پیشرفت: {processed} از {total} ({percent}%)\n"
+    "▫️ ارسال شده: {sent} | بلاک/غیرفعال: {blocked} | ناموفق: {failed}\n"
+    "▫️ سرعت: {rate} پیام در ثانیه | زمان باقی‌مانده: {eta}"
+)
 
 # --- مدیریت Inbound ---
 SELECT_SERVER_FOR_INBOUNDS_PROMPT = "لطفاً سروری که می‌خواهید Inboundهای آن را مدیریت کنید، انتخاب نمایید:"
@@ -142,6 +192,21 @@ RECEIPT_RECEIVED_USER = "✅ رسید شما با موفقیت دریافت شد
 
 # --- تحویل سرویس و تست رایگان ---
 SERVICE_ACTIVATION_SUCCESS_USER = "🎉 سرویس شما با موفقیت فعال شد!"
+PROVISIONING_QUEUED_USER = "✅ پرداخت شما تایید شد.\n⏳ سرویس شما در حال ساخت است و به محض آماده شدن، اطلاعات آن برایتان ارسال می‌شود."
+PROVISIONING_FAILED_USER = "❌ متاسفانه ساخت سرویس شما پس از چند بار تلاش ناموفق بود. پرداخت شما ثبت شده است؛ لطفاً با پشتیبانی تماس بگیرید."
+PROVISIONING_FAILED_ADMIN = "🚨 ساخت سرویس برای پرداخت {payment_id} (کار {job_id}) پس از {attempts} تلاش ناموفق بود و به صف dead منتقل شد.\nخطا: {error}"
+ADMIN_PROVISIONING_QUEUED = "⏳ ساخت سرویس در صف قرار گرفت."
+ADMIN_PAYMENT_ALREADY_PROCESSED = "ℹ️ پرداخت {payment_id} قبلاً (توسط ادمین دیگری) پردازش شده است."
+ADMIN_PAYMENT_APPROVAL_FAILED = "❌ خطا در ثبت تایید پرداخت {payment_id}. تغییری ذخیره نشد؛ لطفاً دوباره تلاش کنید."
+
+# --- صفحه بازگشت از درگاه پرداخت ---
+PAYMENT_VERIFY_INCOMPLETE = "اطلاعات بازگشتی از درگاه ناقص است."
+PAYMENT_VERIFY_NOT_FOUND = "تراکنش یافت نشد."
+PAYMENT_VERIFY_IN_PROGRESS = "تراکنش شما در حال بررسی است. لطفاً چند لحظه دیگر صفحه را دوباره بارگذاری کنید."
+PAYMENT_VERIFY_GATEWAY_ERROR = "خطا در ارتباط با سرور درگاه پرداخت. لطفاً چند لحظه دیگر صفحه را دوباره بارگذاری کنید."
+PAYMENT_VERIFY_CANCELLED = "تراکنش توسط شما لغو شد."
+PAYMENT_VERIFY_REJECTED_USER = "❌ پرداخت شما توسط درگاه تایید نشد. (خطا: {error})"
+PAYMENT_VERIFY_CANCELLED_USER = "شما فرآیند پرداخت را لغو کردید. سفارش شما ناتمام باقی ماند."
 CONFIG_DELIVERY_HEADER = "در ادامه، اطلاعات سرویس شما آمده است:"
 CONFIG_DELIVERY_SUB_LINK = "\n🔗 **لینک اشتراک (Subscription Link):**\n`{sub_link}`\n\n_(این لینک را کپی کرده و در اپلیکیشن خود وارد کنید تا تمام کانفیگ‌ها اضافه شوند.)_"
 QR_CODE_CAPTION = "می‌توانید با اسکن کد بالا، لینک را مستقیماً به اپلیکیشن خود اضافه کنید."
@@ -164,6 +229,9 @@ MY_SERVICES_ITEM = (
     "--------------------\n"
 )
 NO_SERVICES_FOUND = "شما در حال حاضر هیچ سرویس فعالی ندارید."
+SERVICE_USAGE_INFO = "\n📊 **مصرف:** {used_gb} از {total_gb} گیگابایت\n_(آخرین به‌روزرسانی: {updated_at})_\n"
+SERVICE_USAGE_UNLIMITED = "نامحدود"
+SERVICE_USAGE_NOT_SYNCED = "\n📊 **مصرف:** هنوز اطلاعاتی ثبت نشده است.\n"
 
 
 # --- مدیریت درگاه پرداخت ---
@@ -0,0 +1,388 @@
+# utils/outbound.py
+
+import io
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+import telebot
+from telebot.apihelper import ApiTelegramException
+
+from config import (OUTBOUND_GLOBAL_RATE, OUTBOUND_GLOBAL_BURST, OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST,
+                    OUTBOUND_INTERACTIVE_RESERVE, OUTBOUND_MAX_RETRIES, OUTBOUND_MAX_RETRY_WAIT_SECONDS,
+                    OUTBOX_BATCH_SIZE, OUTBOX_POLL_INTERVAL_SECONDS, OUTBOX_MAX_ATTEMPTS, OUTBOX_LOCK_TIMEOUT_SECONDS)
+
+logger = logging.getLogger(__name__)
+
+# اولویت‌ها (عدد کمتر = مهم‌تر): ویرایش پیام‌ها در پاسخ به کلیک کاربر، پیام‌های عادی هندلرها، ارسال‌های انبوه و صف outbox
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2
+
+# کانالی که تریگر outbound_messages_notify (مهاجرت 13) پس از ثبت پیام جدید در آن اعلام می‌کند
+OUTBOUND_MESSAGE_CHANNEL = 'outbound_message'
+# حداکثر تعداد bucket چت‌ها در حافظه؛ bucketهای پر و بیکار پس از آن حذف می‌شوند
+_MAX_CHAT_BUCKETS = 10000
+
+
+def retry_after_of(error):
+    """مقدار retry_after یک خطای 429 تلگرام (ثانیه) یا None برای سایر خطاها."""
+    if not isinstance(error, ApiTelegramException) or error.error_code != 429:
+        return None
+    parameters = (error.result_json or {}).get('parameters') or {}
+    return float(parameters.get('retry_after') or 1)
+
+
+class _Bucket:
+    __slots__ = ('tokens', 'updated_at', 'blocked_until')
+
+    def __init__(self, tokens, now):
+        self.tokens = tokens
+        self.updated_at = now
+        self.blocked_until = 0.0
+
+    def refill(self, rate, capacity, now):
+        self.tokens = min(capacity, self.tokens + (now - self.updated_at) * rate)
+        self.updated_at = now
+
+
+class OutboundRateLimiter:
+    """
+    token bucket سراسری و token bucket جداگانه برای هر چت. اولویت با «ذخیره» ظرفیت سراسری اعمال می‌شود:
+    ارسال‌های انبوه فقط وقتی توکن برمی‌دارند که بیش از interactive_reserve توکن باقی باشد (عادی‌ها نیمی از آن)،
+    پس ویرایش‌های تعاملی حتی در میانه یک ارسال انبوه منتظر نمی‌مانند.
+    """
+    def __init__(self, global_rate: float = OUTBOUND_GLOBAL_RATE, global_burst: int = OUTBOUND_GLOBAL_BURST,
+                 chat_rate: float = OUTBOUND_CHAT_RATE, chat_burst: int = OUTBOUND_CHAT_BURST,
+                 interactive_reserve: int = OUTBOUND_INTERACTIVE_RESERVE):
+        self.global_rate = global_rate
+        self.global_burst = max(1, global_burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = max(1, chat_burst)
+        # ذخیره باید از ظرفیت کمتر باشد وگرنه ارسال انبوه هرگز انجام نمی‌شود
+        self.interactive_reserve = min(max(0, interactive_reserve), self.global_burst - 1)
+        self._global = _Bucket(self.global_burst, time.monotonic())
+        self._chats = {}
+        self._lock = threading.Lock()
+        self._stats = {'acquired': 0, 'waited_seconds': 0.0, 'rate_limited': 0}
+
+    def _chat_bucket(self, chat_id, now):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= _MAX_CHAT_BUCKETS:
+                self._prune(now)
+            bucket = self._chats[chat_id] = _Bucket(self.chat_burst, now)
+        else:
+            bucket.refill(self.chat_rate, self.chat_burst, now)
+        return bucket
+
+    def _prune(self, now):
+        for chat_id, bucket in list(self._chats.items()):
+            bucket.refill(self.chat_rate, self.chat_burst, now)
+            if bucket.tokens >= self.chat_burst and bucket.blocked_until <= now:
+                del self._chats[chat_id]
+
+    def _delay(self, chat_id, priority, now):
+        """زمان انتظار لازم (ثانیه) برای یک ارسال؛ 0 یعنی توکن‌ها در دسترس‌اند. باید زیر قفل صدا زده شود."""
+        self._global.refill(self.global_rate, self.global_burst, now)
+        needed = 1 + self.interactive_reserve * priority / PRIORITY_BULK
+        delay = max(self._global.blocked_until - now, (needed - self._global.tokens) / self.global_rate)
+        if chat_id is not None:
+            bucket = self._chat_bucket(chat_id, now)
+            delay = max(delay, bucket.blocked_until - now, (1 - bucket.tokens) / self.chat_rate)
+        return max(0.0, delay)
+
+    def chat_delay(self, chat_id) -> float:
+        """زمان باقی‌مانده تا مجاز شدن ارسال بعدی به این چت (بدون برداشتن توکن)."""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._chat_bucket(chat_id, now)
+            return max(0.0, bucket.blocked_until - now, (1 - bucket.tokens) / self.chat_rate)
+
+    def acquire(self, chat_id, priority: int = PRIORITY_NORMAL, timeout: float = None) -> bool:
+        """تا در دسترس بودن توکن سراسری و توکن چت منتظر می‌ماند و آن‌ها را برمی‌دارد؛ با پایان timeout False."""
+        started = time.monotonic()
+        deadline = started + timeout if timeout is not None else None
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                delay = self._delay(chat_id, priority, now)
+                if delay <= 0:
+                    self._global.tokens -= 1
+                    if chat_id is not None:
+                        self._chats[chat_id].tokens -= 1
+                    self._stats['acquired'] += 1
+                    self._stats['waited_seconds'] += now - started
+                    return True
+            if deadline is not None:
+                if now >= deadline:
+                    return False
+                delay = min(delay, deadline - now)
+            time.sleep(delay)
+
+    def penalize(self, chat_id, retry_after: float):
+        """
+        پاسخ 429 را اعمال می‌کند: چت تا retry_after ثانیه مسدود و bucket سراسری خالی می‌شود تا نرخ کل هم
+        موقتاً پایین بیاید (تلگرام مشخص نمی‌کند محدودیت چت بوده یا کل ربات).
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._stats['rate_limited'] += 1
+            self._global.refill(self.global_rate, self.global_burst, now)
+            self._global.tokens = min(self._global.tokens, 0)
+            if chat_id is None:
+                self._global.blocked_until = max(self._global.blocked_until, now + retry_after)
+            else:
+                bucket = self._chat_bucket(chat_id, now)
+                bucket.tokens = min(bucket.tokens, 0)
+                bucket.blocked_until = max(bucket.blocked_until, now + retry_after)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['chats_tracked'] = len(self._chats)
+        return stats
+
+
+def _rewind(args, kwargs):
+    # فایل‌های ارسالی (مثل QR کد در BytesIO) پس از تلاش ناموفق باید از ابتدا دوباره خوانده شوند
+    for value in (*args, *kwargs.values()):
+        if isinstance(value, io.IOBase) and value.seekable():
+            value.seek(0)
+
+
+class RateLimitedTeleBot(telebot.TeleBot):
+    """
+    TeleBot که ارسال و ویرایش پیام‌ها را از OutboundRateLimiter عبور می‌دهد و پس از خطای 429 به اندازه
+    retry_after صبر کرده و دوباره تلاش می‌کند. اولویت پیش‌فرض هر متد با outbound_context قابل تغییر است.
+    """
+    def __init__(self, token, limiter: OutboundRateLimiter = None, **kwargs):
+        super().__init__(token, **kwargs)
+        self.limiter = limiter or OutboundRateLimiter()
+        self._outbound_local = threading.local()
+
+    @contextmanager
+    def outbound_context(self, priority: int = None, retry: bool = True):
+        """اولویت ارسال‌های این نخ را تغییر می‌دهد؛ با retry=False خطای 429 به فراخواننده برگردانده می‌شود."""
+        previous = getattr(self._outbound_local, 'context', None)
+        self._outbound_local.context = (priority, retry)
+        try:
+            yield
+        finally:
+            self._outbound_local.context = previous
+
+    def _limited(self, chat_id, priority, method, *args, **kwargs):
+        context_priority, retry = getattr(self._outbound_local, 'context', None) or (None, True)
+        priority = priority if context_priority is None else context_priority
+        attempts = 0
+        while True:
+            self.limiter.acquire(chat_id, priority)
+            try:
+                return method(*args, **kwargs)
+            except ApiTelegramException as e:
+                retry_after = retry_after_of(e)
+                if retry_after is None:
+                    raise
+                self.limiter.penalize(chat_id, retry_after)
+                attempts += 1
+                if not retry or attempts > OUTBOUND_MAX_RETRIES or retry_after > OUTBOUND_MAX_RETRY_WAIT_SECONDS:
+                    raise
+                logger.warning(f"Telegram rate limit hit for chat {chat_id}; retrying in {retry_after:.0f}s (attempt {attempts}).")
+                _rewind(args, kwargs)
+
+    def send_message(self, chat_id, *args, **kwargs):
+        return self._limited(chat_id, PRIORITY_NORMAL, super().send_message, chat_id, *args, **kwargs)
+
+    def send_photo(self, chat_id, *args, **kwargs):
+        return self._limited(chat_id, PRIORITY_NORMAL, super().send_photo, chat_id, *args, **kwargs)
+
+    def send_document(self, chat_id, *args, **kwargs):
+        return self._limited(chat_id, PRIORITY_NORMAL, super().send_document, chat_id, *args, **kwargs)
+
+    def edit_message_text(self, text, chat_id=None, *args, **kwargs):
+        return self._limited(chat_id, PRIORITY_INTERACTIVE, super().edit_message_text, text, chat_id, *args, **kwargs)
+
+    def edit_message_caption(self, caption, chat_id=None, *args, **kwargs):
+        return self._limited(chat_id, PRIORITY_INTERACTIVE, super().edit_message_caption, caption, chat_id, *args, **kwargs)
+
+    def edit_message_reply_markup(self, chat_id=None, *args, **kwargs):
+        return self._limited(chat_id, PRIORITY_INTERACTIVE, super().edit_message_reply_markup, chat_id, *args, **kwargs)
+
+
+# --- صف پایدار (outbox) ---
+def _markup_json(reply_markup):
+    return reply_markup.to_json() if hasattr(reply_markup, 'to_json') else reply_markup
+
+
+def message_row(chat_id: int, text: str, parse_mode: str = None, reply_markup=None, priority: int = PRIORITY_BULK):
+    """ردیف outbox یک پیام متنی (قالب enqueue_outbound_messages)؛ برای ثبت همراه با تغییرات دیگر در یک تراکنش."""
+    payload = {'text': text, 'parse_mode': parse_mode, 'reply_markup': _markup_json(reply_markup)}
+    return (chat_id, 'send_message', payload, None, priority)
+
+
+def queue_message(db_manager, chat_id: int, text: str, parse_mode: str = None, reply_markup=None,
+                  priority: int = PRIORITY_BULK) -> bool:
+    """یک پیام متنی را برای ارسال توسط OutboxRelay ربات در صف دیتابیس قرار می‌دهد (قابل استفاده در هر پروسه)."""
+    row = message_row(chat_id, text, parse_mode, reply_markup, priority)
+    return db_manager.enqueue_outbound_messages([row]) == 1
+
+
+def queue_photo(db_manager, chat_id: int, photo, caption: str = None, parse_mode: str = None, reply_markup=None,
+                priority: int = PRIORITY_BULK, on_sent: tuple = None) -> bool:
+    """
+    یک عکس (file_id تلگرام یا bytes) را در صف قرار می‌دهد. on_sent = (نام هوک، آرگومان) پس از ارسال موفق
+    با پیام ارسال شده اجرا می‌شود (ر.ک. ON_SENT_HOOKS).
+    """
+    payload = {'caption': caption, 'parse_mode': parse_mode, 'reply_markup': _markup_json(reply_markup)}
+    attachment = None
+    if isinstance(photo, (bytes, bytearray)):
+        attachment = bytes(photo)
+    else:
+        payload['photo'] = photo
+    if on_sent:
+        payload['on_sent'] = list(on_sent)
+    return db_manager.enqueue_outbound_messages([(chat_id, 'send_photo', payload, attachment, priority)]) == 1
+
+
+def _record_payment_admin_notification(db_manager, payment_id, message):
+    db_manager.update_payment_admin_notification_id(payment_id, message.message_id)
+
+
+# کارهایی که پس از ارسال موفق یک پیام صف لازم است (مثلاً ذخیره message_id)
+ON_SENT_HOOKS = {
+    'payment_admin_notification': _record_payment_admin_notification,
+}
+
+
+class OutboxRelay:
+    """
+    پیام‌های جدول outbound_messages را (که وب‌سرور پرداخت و خود ربات ثبت می‌کنند) دسته‌ای برمی‌دارد و با اولویت
+    PRIORITY_BULK از همان OutboundRateLimiter ربات ارسال می‌کند. چت‌هایی که فعلاً توکن ندارند منتظر نمی‌مانند و
+    نوبت به چت‌های دیگر می‌رسد؛ ترتیب پیام‌های هر چت حفظ می‌شود. پاسخ 429 پیام‌های آن چت را به اندازه retry_after
+    به صف برمی‌گرداند، خطاهای موقت با backoff تکرار و خطاهای دائمی (مثلاً بلاک شدن ربات) failed می‌شوند.
+    """
+    def __init__(self, db_manager, bot: RateLimitedTeleBot, batch_size: int = OUTBOX_BATCH_SIZE,
+                 poll_interval: float = OUTBOX_POLL_INTERVAL_SECONDS):
+        self.db_manager = db_manager
+        self.bot = bot
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self._stop_event = threading.Event()
+        self._wakeup = threading.Event()
+        self._threads = []
+        self._stats = {'sent': 0, 'failed': 0, 'deferred': 0}
+
+    def _deliver(self, row):
+        payload = json.loads(row['payload_json'])
+        on_sent = payload.pop('on_sent', None)
+        method = getattr(self.bot, row['method'])
+        if row['method'] == 'send_photo':
+            photo = payload.pop('photo', None)
+            content = bytes(row['attachment']) if row['attachment'] is not None else photo
+        else:
+            content = payload.pop('text')
+        with self.bot.outbound_context(priority=row['priority'], retry=False):
+            sent = method(row['chat_id'], content, **payload)
+        if on_sent:
+            name, arg = on_sent
+            try:
+                ON_SENT_HOOKS[name](self.db_manager, arg, sent)
+            except Exception as e:
+                logger.error(f"on_sent hook '{name}' failed for outbound message {row['id']}: {e}")
+
+    def _drain(self, rows):
+        by_chat = OrderedDict()
+        for row in rows:
+            by_chat.setdefault(row['chat_id'], deque()).append(row)
+
+        while by_chat and not self._stop_event.is_set():
+            min_delay = None
+            for chat_id in list(by_chat):
+                delay = self.bot.limiter.chat_delay(chat_id)
+                if delay > 0:
+                    min_delay = delay if min_delay is None else min(min_delay, delay)
+                    continue
+                queue = by_chat[chat_id]
+                row = queue.popleft()
+                retry_after = self._send(row)
+                if retry_after is not None:
+                    # ترتیب پیام‌های چت حفظ می‌شود: بقیه هم همراه همین پیام به صف برمی‌گردند و پیام‌های بعدی این چت
+                    # که در این دسته نیستند تا زمان آزاد شدن همین پیام‌ها برداشته نمی‌شوند (claim_outbound_messages)
+                    self.db_manager.release_outbound_messages([row['id']] + [r['id'] for r in queue], retry_after)
+                    self._stats['deferred'] += len(queue) + 1
+                    queue.clear()
+                if not queue:
+                    del by_chat[chat_id]
+            if min_delay is not None and by_chat:
+                if min_delay > self.poll_interval:
+                    # به جای نگه داشتن قفل پیام‌ها، آن‌ها تا آزاد شدن چت به صف برگردانده می‌شوند
+                    ids = [r['id'] for queue in by_chat.values() for r in queue]
+                    self.db_manager.release_outbound_messages(ids, min_delay)
+                    self._stats['deferred'] += len(ids)
+                    return
+                self._stop_event.wait(min_delay)
+
+        # پیام‌های باقی‌مانده هنگام توقف بلافاصله به صف برمی‌گردند
+        leftover = [r['id'] for queue in by_chat.values() for r in queue]
+        self.db_manager.release_outbound_messages(leftover, 0)
+
+    def _send(self, row):
+        """پیام را ارسال می‌کند؛ اگر تلگرام 429 داده باشد retry_after را برمی‌گرداند."""
+        try:
+            self._deliver(row)
+        except ApiTelegramException as e:
+            retry_after = retry_after_of(e)
+            if retry_after is not None:
+                return retry_after
+            # خطاهای سمت سرور تلگرام موقتی‌اند؛ بقیه (مثلاً 403 بلاک شدن ربات، 400 چت نامعتبر) دائمی
+            retry_delay = min(300, 5 * (2 ** (row['attempts'] - 1))) if e.error_code >= 500 else None
+            self._fail(row, e, retry_delay)
+            return None
+        except Exception as e:
+            self._fail(row, e, min(300, 5 * (2 ** (row['attempts'] - 1))))
+            return None
+        self.db_manager.complete_outbound_message(row['id'])
+        self._stats['sent'] += 1
+        return None
+
+    def _fail(self, row, error, retry_delay):
+        status = self.db_manager.fail_outbound_message(row['id'], str(error)[:1000], OUTBOX_MAX_ATTEMPTS, retry_delay)
+        if status == 'failed':
+            self._stats['failed'] += 1
+            logger.warning(f"Outbound message {row['id']} to chat {row['chat_id']} failed permanently: {error}")
+        else:
+            logger.warning(f"Outbound message {row['id']} to chat {row['chat_id']} failed (attempt {row['attempts']}): {error}")
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            rows = self.db_manager.claim_outbound_messages(self.batch_size, OUTBOX_LOCK_TIMEOUT_SECONDS)
+            if rows:
+                self._drain(rows)
+                continue
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+    def stats(self):
+        return dict(self._stats)
+
+    def start(self):
+        if self._threads:
+            return
+        listener = threading.Thread(
+            target=self.db_manager.listen_for_notifications,
+            args=(OUTBOUND_MESSAGE_CHANNEL, lambda payload: self._wakeup.set(), self._stop_event),
+            name="outbox-listener", daemon=True)
+        sender = threading.Thread(target=self._run, name="outbox-relay", daemon=True)
+        for thread in (listener, sender):
+            thread.start()
+            self._threads.append(thread)
+        logger.info("Outbox relay started.")
+
+    def stop(self, timeout: float = 5):
+        self._stop_event.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout=timeout)
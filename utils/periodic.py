@@ -0,0 +1,48 @@
+# utils/periodic.py
+
+import logging
+import threading
+from abc import ABC, abstractmethod
+
+logger = logging.getLogger(__name__)
+
+
+class PeriodicWorker(ABC):
+    """
+    پایه کارهای دوره‌ای پس‌زمینه: start() یک نخ daemon می‌سازد که run_once() زیرکلاس را هر interval_seconds
+    اجرا می‌کند (مقدار 0 یعنی غیرفعال؛ run_once همچنان به صورت دستی قابل اجراست). خطای یک دور لاگ می‌شود و
+    حلقه را متوقف نمی‌کند. زیرکلاس‌ها thread_name و display_name را تعیین کرده و فقط run_once را پیاده می‌کنند؛
+    دورهای طولانی می‌توانند با بررسی self._stop_event زودتر تمام شوند.
+    """
+    thread_name = "periodic-worker"
+    display_name = "Periodic worker"
+
+    def __init__(self, interval_seconds: float = 0):
+        self.interval_seconds = interval_seconds
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @abstractmethod
+    def run_once(self):
+        """یک دور کامل کار."""
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f"Error in {self.display_name} loop: {e}")
+            self._stop_event.wait(self.interval_seconds)
+
+    def _started_message(self):
+        return f"{self.display_name} started (every {self.interval_seconds}s)."
+
+    def start(self):
+        if self.interval_seconds <= 0 or self._thread:
+            return
+        self._thread = threading.Thread(target=self._run, name=self.thread_name, daemon=True)
+        self._thread.start()
+        logger.info(self._started_message())
+
+    def stop(self):
+        self._stop_event.set()
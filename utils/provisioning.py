@@ -0,0 +1,189 @@
+# utils/provisioning.py
+
+import datetime
+import json
+import logging
+import random
+import threading
+
+from config import (ADMIN_IDS, WEBHOOK_DOMAIN, JOB_MAX_ATTEMPTS, JOB_RETRY_BASE_SECONDS, JOB_RETRY_MAX_SECONDS,
+                    JOB_LOCK_TIMEOUT_SECONDS, JOB_POLL_INTERVAL_SECONDS)
+from utils import messages
+from utils.bot_helpers import send_subscription_info
+from utils.config_generator import new_client_identity
+
+logger = logging.getLogger(__name__)
+
+
+def order_plan_limits(order_details: dict):
+    """(total_gb, duration_days, plan_id) را از جزئیات سفارش استخراج می‌کند."""
+    total_gb, duration_days, plan_id = 0, 0, None
+    plan_type = order_details.get('plan_type')
+    if plan_type == 'fixed_monthly':
+        plan = order_details.get('plan_details')
+        if plan:
+            total_gb, duration_days, plan_id = plan.get('volume_gb'), plan.get('duration_days'), plan.get('id')
+    elif plan_type == 'gigabyte_based':
+        gb_plan = order_details.get('gb_plan_details')
+        gb_plan = gb_plan[0] if isinstance(gb_plan, list) and gb_plan else gb_plan
+        if gb_plan and isinstance(gb_plan, dict):
+            total_gb = order_details.get('requested_gb')
+            duration_days = gb_plan.get('duration_days', 0)
+            plan_id = gb_plan.get('id')
+    return total_gb, duration_days, plan_id
+
+
+def _job_payload(payment_id: int, user_telegram_id: int, source: str, **extra):
+    # شناسه‌های کلاینت یک بار هنگام ثبت کار ساخته می‌شوند تا هر تلاش دوباره همان کلاینت‌ها و همان خرید را بسازد
+    return {'payment_id': payment_id, 'source': source, 'client': new_client_identity(user_telegram_id), **extra}
+
+
+def approve_payment_and_enqueue(db_manager, payment_id: int, admin_id: int, user_telegram_id: int):
+    """
+    تایید دستی پرداخت توسط ادمین و ثبت کار ساخت سرویس آن (در یک تراکنش).
+    خروجی: id کار، False اگر پرداخت قبلاً تایید شده و None در صورت خطای دیتابیس.
+    """
+    job_id = db_manager.confirm_payment_and_enqueue(
+        payment_id, admin_id, _job_payload(payment_id, user_telegram_id, 'admin', admin_id=admin_id), JOB_MAX_ATTEMPTS)
+    if job_id:
+        logger.info(f"Queued provisioning job {job_id} for payment {payment_id} (admin {admin_id}).")
+    return job_id
+
+
+def verify_payment_and_enqueue(db_manager, payment_id: int, user_telegram_id: int, ref_id: str, outbound_messages: list = None):
+    """
+    پرداخت آنلاین بررسی شده را تایید و کار ساخت سرویس و پیام‌های outbox را در یک تراکنش ثبت می‌کند.
+    خروجی مانند DatabaseManager.complete_payment_verification است.
+    """
+    done = db_manager.complete_payment_verification(
+        payment_id, ref_id, _job_payload(payment_id, user_telegram_id, 'zarinpal', ref_id=ref_id), JOB_MAX_ATTEMPTS,
+        outbound_messages)
+    if done:
+        logger.info(f"Queued provisioning job for payment {payment_id} (zarinpal).")
+    return done
+
+
+class ProvisioningWorkerPool:
+    """
+    چند نخ worker که کارهای جدول provisioning_jobs را برمی‌دارند، کلاینت‌ها را روی پنل‌ها می‌سازند،
+    خرید را ثبت می‌کنند و نتیجه را به کاربر اطلاع می‌دهند. شکست‌ها با backoff نمایی دوباره تلاش
+    می‌شوند و پس از JOB_MAX_ATTEMPTS به وضعیت dead می‌روند (و ادمین‌ها مطلع می‌شوند).
+    """
+    def __init__(self, db_manager, config_generator, bot, num_workers: int):
+        self.db_manager = db_manager
+        self.config_generator = config_generator
+        self.bot = bot
+        self.num_workers = num_workers
+        self._stop_event = threading.Event()
+        self._threads = []
+
+    def _provision(self, job):
+        """
+        کلاینت‌های کار را روی پنل‌ها می‌سازد و (user_telegram_id, sub_link, purchase) را برمی‌گرداند.
+        شناسه‌های کلاینت از payload کار می‌آیند، پس تلاش دوباره همان کلاینت‌ها را می‌سازد (کلاینتی که از تلاش قبلی
+        روی پنل مانده موفق حساب می‌شود). اگر خرید در تلاش قبلی ثبت شده باشد، پنل‌ها دست نمی‌خورند و purchase=None است.
+        """
+        payload = json.loads(job['payload_json'])
+        identity = payload['client']
+        payment = self.db_manager.get_payment_by_id(payload['payment_id'])
+        if not payment:
+            raise ValueError(f"payment {payload['payment_id']} not found")
+        user_db_info = self.db_manager.get_user_by_id(payment['user_id'])
+        sub_link = f"https://{WEBHOOK_DOMAIN}/sub/{identity['webhook_sub_id']}"
+        if self.db_manager.get_purchase_by_subscription_id(identity['webhook_sub_id']):
+            logger.info(f"Purchase of job {job['id']} was already saved by a previous attempt.")
+            return user_db_info['telegram_id'], sub_link, None
+
+        order_details = json.loads(payment['order_details_json'])
+        total_gb, duration_days, plan_id = order_plan_limits(order_details)
+        existing_ok = job['attempts'] > 1
+
+        purchase_type = order_details.get('purchase_type')
+        server_id, profile_id = None, None
+        if purchase_type == 'profile':
+            profile_id = order_details.get('profile_id')
+            result = self.config_generator.create_subscription_for_profile(
+                user_db_info['telegram_id'], profile_id, total_gb, duration_days, identity, existing_ok)
+        else:
+            server_id = order_details.get('server_id')
+            result = self.config_generator.create_subscription_for_server(
+                user_db_info['telegram_id'], server_id, total_gb, duration_days, identity, existing_ok)
+        webhook_sub_id, full_configs, client_details = result
+        if not webhook_sub_id or not full_configs or not client_details:
+            raise RuntimeError("could not create client on any panel")
+
+        expire_date = (datetime.datetime.now() + datetime.timedelta(days=duration_days)) if duration_days and duration_days > 0 else None
+        purchase = {
+            'user_id': user_db_info['id'], 'purchase_type': purchase_type or 'server',
+            'server_id': server_id, 'profile_id': profile_id, 'plan_id': plan_id,
+            'expire_date': expire_date.strftime("%Y-%m-%d %H:%M:%S") if expire_date else None,
+            'initial_volume_gb': total_gb, 'subscription_id': webhook_sub_id,
+            'full_configs_json': json.dumps(full_configs),
+            'xui_client_uuid': client_details.get('uuid'), 'xui_client_email': client_details.get('email'),
+            'single_configs_json': json.dumps(full_configs),
+        }
+        return user_db_info['telegram_id'], sub_link, purchase
+
+    def _notify_success(self, user_telegram_id, sub_link):
+        # خطای ارسال پیام نباید باعث تکرار کار (و ساخت دوباره کلاینت) شود
+        try:
+            self.bot.send_message(user_telegram_id, messages.SERVICE_ACTIVATION_SUCCESS_USER)
+            send_subscription_info(self.bot, user_telegram_id, sub_link)
+        except Exception as e:
+            logger.error(f"Provisioned service but failed to notify user {user_telegram_id}: {e}")
+
+    def _notify_dead(self, job, error):
+        payment_id = job['payment_id']
+        try:
+            payment = self.db_manager.get_payment_by_id(payment_id)
+            user_db_info = self.db_manager.get_user_by_id(payment['user_id']) if payment else None
+            if user_db_info:
+                self.bot.send_message(user_db_info['telegram_id'], messages.PROVISIONING_FAILED_USER)
+            for admin_id in ADMIN_IDS:
+                self.bot.send_message(admin_id, messages.PROVISIONING_FAILED_ADMIN.format(
+                    job_id=job['id'], payment_id=payment_id, attempts=job['attempts'], error=str(error)[:300]))
+        except Exception as e:
+            logger.error(f"Failed to send dead-letter notifications for job {job['id']}: {e}")
+
+    def _process(self, job):
+        try:
+            user_telegram_id, sub_link, purchase = self._provision(job)
+            # ثبت خرید و بستن کار در یک تراکنش؛ اگر ناموفق باشد هیچ‌کدام ثبت نشده و تلاش بعدی همان کلاینت‌ها را دارد
+            if not self.db_manager.complete_provisioning_job(job['id'], purchase):
+                raise RuntimeError("could not save purchase")
+        except Exception as e:
+            delay = random.uniform(0.5, 1.0) * min(JOB_RETRY_MAX_SECONDS, JOB_RETRY_BASE_SECONDS * (2 ** (job['attempts'] - 1)))
+            status = self.db_manager.fail_provisioning_job(job['id'], str(e)[:1000], delay)
+            if status == 'dead':
+                logger.error(f"Provisioning job {job['id']} moved to dead-letter after {job['attempts']} attempt(s): {e}")
+                self._notify_dead(job, e)
+            else:
+                logger.warning(f"Provisioning job {job['id']} failed (attempt {job['attempts']}): {e}; retrying in {delay:.0f}s.")
+            return
+        logger.info(f"Provisioning job {job['id']} done (payment {job['payment_id']}).")
+        self._notify_success(user_telegram_id, sub_link)
+
+    def _run(self, worker_name):
+        while not self._stop_event.is_set():
+            job = self.db_manager.claim_provisioning_job(worker_name, JOB_LOCK_TIMEOUT_SECONDS)
+            if not job:
+                self._stop_event.wait(JOB_POLL_INTERVAL_SECONDS)
+                continue
+            try:
+                self._process(job)
+            except Exception as e:
+                logger.error(f"Unexpected error in {worker_name} while processing job {job['id']}: {e}")
+
+    def start(self):
+        if self.num_workers <= 0 or self._threads:
+            return
+        for i in range(self.num_workers):
+            thread = threading.Thread(target=self._run, args=(f"provision-worker-{i}",), name=f"provision-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"Provisioning worker pool started with {self.num_workers} worker(s).")
+
+    def stop(self, timeout: float = 5):
+        self._stop_event.set()
+        for thread in self._threads:
+            thread.join(timeout=timeout)
@@ -0,0 +1,128 @@
+# utils/reconciler.py
+
+import logging
+from collections import Counter
+
+from api_client import client_registry
+from config import RECONCILE_EXPIRY_TOLERANCE_SECONDS, RECONCILE_REPORT_SAMPLE_SIZE
+from utils.helpers import generate_random_string
+from utils.periodic import PeriodicWorker
+
+logger = logging.getLogger(__name__)
+
+# حداکثر اختلاف مجاز حجم (برای خطای گرد کردن REAL در initial_volume_gb)
+_VOLUME_TOLERANCE_BYTES = 1024 * 1024
+# تعداد خریدهای خوانده شده از دیتابیس در هر صفحه
+_PURCHASE_PAGE_SIZE = 2000
+
+
+def _expected_client_limits(purchase):
+    """(حجم به بایت، زمان انقضا به میلی‌ثانیه) مورد انتظار پنل برای یک خرید؛ صفر یعنی نامحدود."""
+    total_bytes = int(purchase['initial_volume_gb'] * (1024 ** 3)) if purchase['initial_volume_gb'] and purchase['initial_volume_gb'] > 0 else 0
+    expiry_ms = int(purchase['expire_date'].timestamp() * 1000) if purchase['expire_date'] else 0
+    return total_bytes, expiry_ms
+
+
+class DriftReconciler(PeriodicWorker):
+    """
+    خریدهای فعال دیتابیس را با کلاینت‌های واقعی هر پنل مقایسه می‌کند:
+    missing: خرید فعال است ولی کلاینتش روی پنل نیست.
+    orphaned: کلاینت روی پنل هست ولی خرید فعالی برایش وجود ندارد (فقط گزارش می‌شود؛ ممکن است دستی ساخته شده باشد).
+    mismatched: حجم یا تاریخ انقضای پنل با خرید همخوانی ندارد.
+
+    آمار کلاینت‌های پنل به صورت جریانی به tupleهای فشرده تبدیل و خریدها به صورت صفحه‌ای (keyset) خوانده می‌شوند،
+    پس درخواست‌های اصلاح به پنل بین صفحه‌ها و بدون اتصال باز به دیتابیس ارسال می‌شوند؛
+    هر خرید هنگام خواندن از دیکشنری پنل pop می‌شود و آنچه باقی می‌ماند همان orphanها هستند (یک گذر).
+    """
+    thread_name = "drift-reconciler"
+    display_name = "Drift reconciler"
+
+    def __init__(self, db_manager, xui_api_class, interval_seconds: float = 0, auto_fix: bool = False):
+        self.db_manager = db_manager
+        self.xui_api = xui_api_class
+        self.auto_fix = auto_fix
+        super().__init__(interval_seconds)
+
+    def _client_settings(self, purchase, total_bytes, expiry_ms):
+        return {
+            "id": purchase['xui_client_uuid'], "email": purchase['xui_client_email'], "flow": "",
+            "totalGB": total_bytes, "expiryTime": expiry_ms, "enable": True,
+            "tgId": str(purchase['telegram_id']), "subId": generate_random_string(12),
+        }
+
+    def reconcile_server(self, server, fix: bool = False):
+        """
+        یک سرور را بررسی (و در صورت fix=True اصلاح) می‌کند. خروجی گزارشی با شمارنده‌ها و
+        نمونه‌ای محدود (RECONCILE_REPORT_SAMPLE_SIZE) از ایمیل‌های هر دسته است؛ در صورت عدم دسترسی به پنل None.
+        """
+        client = client_registry.get_client_for_server(server, self.xui_api)
+        panel_clients = client.list_client_traffics(transform=lambda stat: (
+            stat.get('email'), (stat.get('inboundId'), int(stat.get('total') or 0), int(stat.get('expiryTime') or 0))))
+        if panel_clients is None:
+            logger.warning(f"Reconcile: could not fetch clients from server {server['id']}.")
+            return None
+        panel_clients = dict(panel_clients)
+        panel_client_count = len(panel_clients)
+
+        counts = Counter()
+        samples = {'missing': [], 'orphaned': [], 'mismatched': []}
+
+        def note(kind, email):
+            counts[kind] += 1
+            if len(samples[kind]) < RECONCILE_REPORT_SAMPLE_SIZE:
+                samples[kind].append(email)
+
+        last_purchase_id = 0
+        while True:
+            page = self.db_manager.get_server_purchases_for_reconcile(server['id'], last_purchase_id, _PURCHASE_PAGE_SIZE)
+            if page is None:
+                raise RuntimeError(f"could not read purchases of server {server['id']}")
+            if not page:
+                break
+            last_purchase_id = page[-1]['id']
+            for purchase in page:
+                counts['purchases'] += 1
+                email = purchase['xui_client_email']
+                total_bytes, expiry_ms = _expected_client_limits(purchase)
+                panel_entry = panel_clients.pop(email, None)
+
+                if panel_entry is None:
+                    if not purchase['inbound_ids']:
+                        continue  # اینباند فعالی روی این سرور برای این خرید وجود ندارد
+                    note('missing', email)
+                    if fix and purchase['xui_client_uuid']:
+                        settings = self._client_settings(purchase, total_bytes, expiry_ms)
+                        if all(client.add_clients(inbound_id, [settings]) for inbound_id in purchase['inbound_ids']):
+                            counts['fixed'] += 1
+                    continue
+
+                inbound_id, panel_total, panel_expiry = panel_entry
+                # expiryTime منفی یعنی «شروع از اولین اتصال» و قابل مقایسه نیست
+                expiry_drift = panel_expiry >= 0 and abs(panel_expiry - expiry_ms) > RECONCILE_EXPIRY_TOLERANCE_SECONDS * 1000
+                if abs(panel_total - total_bytes) > _VOLUME_TOLERANCE_BYTES or expiry_drift:
+                    note('mismatched', email)
+                    if fix and purchase['xui_client_uuid'] and inbound_id:
+                        if client.update_client(inbound_id, purchase['xui_client_uuid'], self._client_settings(purchase, total_bytes, expiry_ms)):
+                            counts['fixed'] += 1
+
+        for email in panel_clients:
+            note('orphaned', email)
+
+        report = {'panel_clients': panel_client_count, 'counts': counts, 'samples': samples}
+        logger.info(f"Reconcile server {server['id']}{' (fix)' if fix else ''}: {counts['purchases']} purchases, "
+                    f"{counts['missing']} missing, {counts['orphaned']} orphaned, {counts['mismatched']} mismatched, {counts['fixed']} fixed.")
+        return report
+
+    def run_once(self, fix: bool = None):
+        """تمام سرورهای فعال و آنلاین را به ترتیب بررسی می‌کند. لیست (server, report یا None در صورت خطا) را برمی‌گرداند."""
+        fix = self.auto_fix if fix is None else fix
+        results = []
+        for server in self.db_manager.get_all_servers(only_active=True):
+            if self._stop_event.is_set():
+                break
+            try:
+                results.append((server, self.reconcile_server(server, fix=fix)))
+            except Exception as e:
+                logger.error(f"Error reconciling server {server['id']}: {e}")
+                results.append((server, None))
+        return results
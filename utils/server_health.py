@@ -0,0 +1,58 @@
+# utils/server_health.py
+
+import datetime
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from api_client import client_registry
+from config import SERVER_HEALTH_FAILURE_THRESHOLD, SERVER_HEALTH_MAX_WORKERS
+from utils.periodic import PeriodicWorker
+
+logger = logging.getLogger(__name__)
+
+
+class ServerHealthChecker(PeriodicWorker):
+    """
+    تمام پنل‌ها را به صورت موازی بررسی می‌کند (لاگین + زمان پاسخ) و نتیجه را
+    یکجا در جدول servers ثبت می‌کند. با start() در یک نخ پس‌زمینه به صورت دوره‌ای اجرا می‌شود.
+    """
+    thread_name = "server-health-checker"
+    display_name = "Server health checker"
+
+    def __init__(self, db_manager, xui_api_class, interval_seconds: float = 0):
+        self.db_manager = db_manager
+        self.xui_api = xui_api_class
+        super().__init__(interval_seconds)
+
+    def _probe(self, server):
+        client = client_registry.get_client_for_server(server, self.xui_api)
+        started = time.monotonic()
+        try:
+            is_ok = bool(client.login())
+        except Exception as e:
+            logger.warning(f"Health probe for server {server['id']} raised: {e}")
+            is_ok = False
+        latency_ms = int((time.monotonic() - started) * 1000)
+        return server, is_ok, latency_ms
+
+    def run_once(self):
+        """
+        یک دور بررسی کامل. لیست (server, is_ok, latency_ms) را برمی‌گرداند.
+        """
+        servers = self.db_manager.get_all_servers(only_active=False)
+        if not servers:
+            return []
+
+        with ThreadPoolExecutor(max_workers=min(SERVER_HEALTH_MAX_WORKERS, len(servers)), thread_name_prefix="health") as executor:
+            results = list(executor.map(self._probe, servers))
+
+        checked_at = datetime.datetime.now(datetime.timezone.utc)
+        self.db_manager.update_servers_health(
+            [(server['id'], is_ok, latency_ms, checked_at) for server, is_ok, latency_ms in results],
+            failure_threshold=SERVER_HEALTH_FAILURE_THRESHOLD
+        )
+        offline = [server['name'] for server, is_ok, _ in results if not is_ok]
+        if offline:
+            logger.warning(f"Health check: {len(offline)}/{len(results)} server(s) failed: {', '.join(offline)}")
+        return results
@@ -0,0 +1,149 @@
+# utils/state_store.py
+
+import logging
+import pickle
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+from config import STATE_STORE_BACKEND, STATE_TTL_SECONDS, STATE_MAX_ENTRIES, STATE_PURGE_INTERVAL_SECONDS
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class StateStore(ABC):
+    """
+    رابط مشترک نگهداری وضعیت گفتگو (کلید: شناسه کاربر). هر مقدار TTL دارد و تعداد کل ورودی‌ها محدود است.
+    مقدار برگشتی get یک کپی است (در بک‌اند دیتابیس)؛ پس از هر تغییر باید دوباره با set (یا store[key] = value) ذخیره شود.
+    """
+    @abstractmethod
+    def get(self, key, default=None):
+        """مقدار key یا default اگر وجود نداشته یا منقضی شده باشد."""
+
+    @abstractmethod
+    def set(self, key, value, ttl: float = None):
+        """مقدار را با TTL (پیش‌فرض TTL بک‌اند) ذخیره می‌کند."""
+
+    @abstractmethod
+    def pop(self, key, default=None):
+        """مقدار key را حذف کرده و برمی‌گرداند (یا default)."""
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        self.pop(key)
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+
+class _Entry:
+    __slots__ = ('value', 'expires_at')
+
+    def __init__(self, value, expires_at):
+        self.value = value
+        self.expires_at = expires_at
+
+
+class MemoryStateStore(StateStore):
+    """بک‌اند درون حافظه (فقط یک پروسه): LRU با سقف max_entries؛ ورودی منقضی شده در اولین دسترسی حذف می‌شود."""
+    def __init__(self, ttl_seconds: float = STATE_TTL_SECONDS, max_entries: int = STATE_MAX_ENTRIES):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            if entry.expires_at is not None and entry.expires_at <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return entry.value
+
+    def set(self, key, value, ttl: float = None):
+        ttl = self.ttl_seconds if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl and ttl > 0 else None
+        with self._lock:
+            self._data[key] = _Entry(value, expires_at)
+            self._data.move_to_end(key)
+            if self.max_entries and len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        if entry is None or (entry.expires_at is not None and entry.expires_at <= time.monotonic()):
+            return default
+        return entry.value
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+
+class PostgresStateStore(StateStore):
+    """
+    بک‌اند مشترک در جدول conversation_states: چند پروسه ربات پشت یک توکن وضعیت یکسانی می‌بینند و وضعیت
+    با restart از بین نمی‌رود. مقادیر با pickle سریال می‌شوند تا set، DictRow و کلیدهای عددی دست نخورده بمانند
+    (فقط خود ربات در این جدول می‌نویسد). حذف ورودی‌های منقضی و مازاد حداکثر هر purge_interval ثانیه یک بار انجام می‌شود.
+    """
+    def __init__(self, db_manager, namespace: str, ttl_seconds: float = STATE_TTL_SECONDS,
+                 max_entries: int = STATE_MAX_ENTRIES, purge_interval: float = STATE_PURGE_INTERVAL_SECONDS):
+        self.db_manager = db_manager
+        self.namespace = namespace
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.purge_interval = purge_interval
+        self._next_purge = time.monotonic() + purge_interval
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        value = self.db_manager.get_conversation_state(self.namespace, str(key))
+        return pickle.loads(value) if value is not None else default
+
+    def set(self, key, value, ttl: float = None):
+        ttl = self.ttl_seconds if ttl is None else ttl
+        # TTL صفر در این بک‌اند معنای «بدون انقضا» ندارد؛ از سقف یک سال استفاده می‌شود
+        ttl = ttl if ttl and ttl > 0 else 365 * 24 * 3600
+        self.db_manager.set_conversation_state(self.namespace, str(key),
+                                               pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), ttl)
+        self._maybe_purge()
+
+    def pop(self, key, default=None):
+        value = self.db_manager.delete_conversation_state(self.namespace, str(key))
+        return pickle.loads(value) if value is not None else default
+
+    def _maybe_purge(self):
+        with self._lock:
+            now = time.monotonic()
+            if now < self._next_purge:
+                return
+            self._next_purge = now + self.purge_interval
+        deleted = self.db_manager.purge_conversation_states(self.namespace, self.max_entries)
+        if deleted:
+            logger.info(f"Purged {deleted} expired or excess conversation state(s) from '{self.namespace}'.")
+
+
+def create_state_store(namespace: str, db_manager=None) -> StateStore:
+    """state store یک namespace (مثلاً user یا admin) را بر اساس STATE_STORE_BACKEND می‌سازد."""
+    if STATE_STORE_BACKEND == 'postgres':
+        if db_manager is None:
+            raise ValueError("PostgresStateStore requires a db_manager.")
+        return PostgresStateStore(db_manager, namespace)
+    if STATE_STORE_BACKEND != 'memory':
+        logger.warning(f"Unknown STATE_STORE_BACKEND '{STATE_STORE_BACKEND}'; falling back to memory.")
+    return MemoryStateStore()
@@ -0,0 +1,123 @@
+# utils/subscription_cache.py
+
+import datetime
+import hashlib
+import json
+import logging
+import threading
+from collections import namedtuple
+
+from config import (SUBSCRIPTION_CACHE_MAX_ENTRIES, SUBSCRIPTION_CACHE_TTL_SECONDS, SUBSCRIPTION_CACHE_NEGATIVE_TTL_SECONDS,
+                    SUBSCRIPTION_USAGE_CACHE_TTL_SECONDS)
+from utils.cache import TTLCache
+from utils.subscription_formats import SUBSCRIPTION_FORMATS
+
+logger = logging.getLogger(__name__)
+
+# کانالی که تریگر purchases_notify_change (مهاجرت 11) subscription_id خریدهای تغییر یافته را در آن اعلام می‌کند
+PURCHASE_CHANGE_CHANNEL = 'purchase_changed'
+
+_MISSING = object()
+
+# بدنه آماده ارسال (bytes، خالی یعنی 204)، ETag و Content-Type یک فرمت
+RenderedBody = namedtuple('RenderedBody', ['body', 'etag', 'mimetype'])
+
+
+class SubscriptionEntry:
+    """
+    داده‌های لازم برای پاسخ یک سابسکریپشن. بدنه هر فرمت در اولین درخواست همان فرمت ساخته و
+    تا باطل شدن ورودی نگه داشته می‌شود.
+    """
+    __slots__ = ('config_urls', 'xui_client_email', 'total_bytes', 'expire', 'last_modified', '_bodies')
+
+    def __init__(self, purchase):
+        config_list = json.loads(purchase['full_configs_json']) if purchase['full_configs_json'] else []
+        self.config_urls = [item['url'] for item in config_list if 'url' in item]
+        self.xui_client_email = purchase['xui_client_email']
+        volume_gb = purchase['initial_volume_gb']
+        self.total_bytes = int(volume_gb * (1024 ** 3)) if volume_gb and volume_gb > 0 else 0
+        self.expire = int(purchase['expire_date'].timestamp()) if purchase['expire_date'] else 0
+        self.last_modified = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+        self._bodies = {}
+
+    def render(self, fmt: str) -> RenderedBody:
+        rendered = self._bodies.get(fmt)
+        if rendered is None:
+            render, mimetype = SUBSCRIPTION_FORMATS[fmt]
+            body = render(self.config_urls) if self.config_urls else b''
+            rendered = RenderedBody(body, hashlib.sha1(body).hexdigest(), mimetype)
+            self._bodies[fmt] = rendered
+        return rendered
+
+
+class SubscriptionCache:
+    """
+    کش LRU ورودی‌های سابسکریپشن (کلید: subscription_id) تا درخواست‌های دوره‌ای کلاینت‌ها
+    بدون کوئری دیتابیس و بدون ساخت دوباره پاسخ داده شوند. سابسکریپشن‌های نامعتبر یا غیرفعال هم (با TTL کوتاه‌تر) کش می‌شوند.
+    هدر subscription-userinfo از جدول client_usage (که UsageSyncEngine پر می‌کند) خوانده و جداگانه با
+    SUBSCRIPTION_USAGE_CACHE_TTL_SECONDS کش می‌شود تا تغییر مصرف، بدنه‌های ساخته شده را باطل نکند.
+    با start() یک نخ روی NOTIFY دیتابیس گوش می‌دهد و ورودی خریدهای تغییر یافته را باطل می‌کند.
+    """
+    def __init__(self, db_manager, max_entries: int = SUBSCRIPTION_CACHE_MAX_ENTRIES,
+                 ttl_seconds: float = SUBSCRIPTION_CACHE_TTL_SECONDS):
+        self.db_manager = db_manager
+        self._cache = TTLCache(ttl_seconds=ttl_seconds, max_size=max_entries)
+        self._usage_cache = TTLCache(ttl_seconds=SUBSCRIPTION_USAGE_CACHE_TTL_SECONDS, max_size=max_entries)
+        # هر باطل‌سازی شمارنده را زیاد می‌کند تا نتیجه کوئری‌ای که همزمان با تغییر خرید اجرا شده کش نشود
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def get(self, subscription_id: str):
+        """SubscriptionEntry را برمی‌گرداند؛ None یعنی سابسکریپشن پیدا نشد یا غیرفعال است."""
+        entry = self._cache.get(subscription_id, _MISSING)
+        if entry is not _MISSING:
+            return entry
+
+        generation = self._generation
+        purchase = self.db_manager.get_purchase_by_subscription_id(subscription_id)
+        entry = SubscriptionEntry(purchase) if purchase and purchase['is_active'] else None
+        with self._lock:
+            if generation == self._generation:
+                self._cache.set(subscription_id, entry, ttl=None if entry else SUBSCRIPTION_CACHE_NEGATIVE_TTL_SECONDS)
+        return entry
+
+    def userinfo(self, subscription_id: str, entry: SubscriptionEntry) -> str:
+        """مقدار هدر subscription-userinfo (upload/download/total/expire) یک سابسکریپشن."""
+        usage = self._usage_cache.get(subscription_id)
+        if usage is None:
+            usage = self.db_manager.get_client_usage(entry.xui_client_email) or {}
+            usage = (int(usage.get('up_bytes') or 0), int(usage.get('down_bytes') or 0))
+            self._usage_cache.set(subscription_id, usage)
+        upload, download = usage
+        return f"upload={upload}; download={download}; total={entry.total_bytes}; expire={entry.expire}"
+
+    def invalidate(self, subscription_id: str):
+        with self._lock:
+            self._generation += 1
+            self._cache.invalidate(subscription_id)
+            self._usage_cache.invalidate(subscription_id)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._cache.clear()
+            self._usage_cache.clear()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def start(self):
+        if self._thread:
+            return
+        # پس از هر اتصال (دوباره) کل کش پاک می‌شود چون اعلان‌های زمان قطعی از دست رفته‌اند
+        self._thread = threading.Thread(
+            target=self.db_manager.listen_for_notifications,
+            args=(PURCHASE_CHANGE_CHANNEL, self.invalidate, self._stop_event),
+            kwargs={'on_connect': self.clear}, name="subscription-cache-listener", daemon=True)
+        self._thread.start()
+        logger.info("Subscription cache invalidation listener started.")
+
+    def stop(self):
+        self._stop_event.set()
@@ -0,0 +1,161 @@
+# utils/subscription_formats.py
+
+import base64
+import json
+from urllib.parse import urlsplit, parse_qs, unquote
+
+DEFAULT_FORMAT = 'base64'
+
+# کلاینت‌هایی که اگر فرمت صریحاً خواسته نشده باشد، از روی User-Agent فرمت بومی خود را دریافت می‌کنند
+_USER_AGENT_FORMATS = (
+    ('clash', 'clash'), ('mihomo', 'clash'), ('stash', 'clash'),
+    ('sing-box', 'singbox'), ('sfa', 'singbox'), ('sfi', 'singbox'),
+)
+_FORMAT_ALIASES = {'base64': 'base64', 'v2ray': 'base64', 'clash': 'clash', 'yaml': 'clash',
+                   'singbox': 'singbox', 'sing-box': 'singbox', 'json': 'singbox'}
+
+
+def negotiate_format(requested: str = None, user_agent: str = None) -> str:
+    """فرمت خروجی را از پارامتر format (اولویت) یا User-Agent کلاینت تعیین می‌کند."""
+    if requested:
+        return _FORMAT_ALIASES.get(requested.lower())
+    user_agent = (user_agent or '').lower()
+    for marker, fmt in _USER_AGENT_FORMATS:
+        if marker in user_agent:
+            return fmt
+    return DEFAULT_FORMAT
+
+
+def parse_vless_url(url: str):
+    """لینک vless ساخته شده توسط ConfigGenerator را به دیکشنری پارامترها تبدیل می‌کند؛ برای لینک نامعتبر None."""
+    parts = urlsplit(url)
+    if parts.scheme != 'vless' or not parts.hostname or not parts.port:
+        return None
+    params = {key: values[0] for key, values in parse_qs(parts.query).items()}
+    return {
+        'name': unquote(parts.fragment) or parts.hostname, 'uuid': unquote(parts.username or ''),
+        'server': parts.hostname, 'port': parts.port, 'network': params.get('type', 'tcp'),
+        'security': params.get('security', 'none'), 'sni': params.get('sni'), 'fp': params.get('fp'),
+        'pbk': params.get('pbk'), 'sid': params.get('sid'), 'path': params.get('path'),
+        'host': params.get('host'), 'flow': params.get('flow'),
+    }
+
+
+def _parse_proxies(config_urls):
+    """لینک‌ها را پارس کرده و نام‌های تکراری را یکتا می‌کند (کلاینت‌ها نام تکراری را نمی‌پذیرند)."""
+    proxies, seen = [], {}
+    for url in config_urls:
+        proxy = parse_vless_url(url)
+        if not proxy:
+            continue
+        name = proxy['name']
+        seen[name] = seen.get(name, 0) + 1
+        if seen[name] > 1:
+            proxy['name'] = f"{name} {seen[name]}"
+        proxies.append(proxy)
+    return proxies
+
+
+def render_base64(config_urls) -> bytes:
+    return base64.b64encode("\n".join(config_urls).encode('utf-8'))
+
+
+def _yaml_lines(value, indent=0):
+    # زیرمجموعه کوچکی از YAML کافی است؛ رشته‌ها به صورت JSON (که YAML معتبر است) نوشته می‌شوند
+    pad = '  ' * indent
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if isinstance(item, (dict, list)) and item:
+                yield f"{pad}{key}:"
+                yield from _yaml_lines(item, indent + 1)
+            else:
+                yield f"{pad}{key}: {_yaml_scalar(item)}"
+    elif isinstance(value, list):
+        for item in value:
+            if isinstance(item, dict) and item:
+                first, *rest = list(_yaml_lines(item, indent + 1))
+                yield f"{pad}- {first.lstrip()}"
+                yield from rest
+            else:
+                yield f"{pad}- {_yaml_scalar(item)}"
+
+
+def _yaml_scalar(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (int, float)):
+        return str(value)
+    if isinstance(value, (dict, list)):
+        return '{}' if isinstance(value, dict) else '[]'
+    return json.dumps('' if value is None else str(value), ensure_ascii=False)
+
+
+def render_clash(config_urls) -> bytes:
+    """پروفایل Clash (هسته Meta/mihomo که vless را پشتیبانی می‌کند) با یک گروه انتخاب دستی."""
+    proxies = []
+    for p in _parse_proxies(config_urls):
+        proxy = {'name': p['name'], 'type': 'vless', 'server': p['server'], 'port': p['port'],
+                 'uuid': p['uuid'], 'network': p['network'], 'udp': True}
+        if p['security'] in ('tls', 'xtls', 'reality'):
+            proxy['tls'] = True
+            if p['sni']:
+                proxy['servername'] = p['sni']
+            if p['fp']:
+                proxy['client-fingerprint'] = p['fp']
+        if p['security'] == 'reality':
+            proxy['reality-opts'] = {'public-key': p['pbk'] or '', 'short-id': p['sid'] or ''}
+        if p['flow']:
+            proxy['flow'] = p['flow']
+        if p['network'] == 'ws':
+            proxy['ws-opts'] = {'path': p['path'] or '/', 'headers': {'Host': p['host'] or p['server']}}
+        proxies.append(proxy)
+
+    names = [proxy['name'] for proxy in proxies]
+    profile = {
+        'mixed-port': 7890, 'allow-lan': False, 'mode': 'rule', 'log-level': 'info',
+        'proxies': proxies,
+        'proxy-groups': [{'name': 'PROXY', 'type': 'select', 'proxies': names}],
+        'rules': ['MATCH,PROXY'],
+    }
+    return ("\n".join(_yaml_lines(profile)) + "\n").encode('utf-8')
+
+
+def render_singbox(config_urls) -> bytes:
+    """پیکربندی کامل sing-box (ورودی tun و mixed، یک selector روی تمام کانفیگ‌ها)."""
+    outbounds = []
+    for p in _parse_proxies(config_urls):
+        outbound = {'type': 'vless', 'tag': p['name'], 'server': p['server'], 'server_port': p['port'], 'uuid': p['uuid']}
+        if p['flow']:
+            outbound['flow'] = p['flow']
+        if p['security'] in ('tls', 'xtls', 'reality'):
+            tls = {'enabled': True, 'server_name': p['sni'] or p['server']}
+            if p['fp']:
+                tls['utls'] = {'enabled': True, 'fingerprint': p['fp']}
+            if p['security'] == 'reality':
+                tls['reality'] = {'enabled': True, 'public_key': p['pbk'] or '', 'short_id': p['sid'] or ''}
+            outbound['tls'] = tls
+        if p['network'] == 'ws':
+            outbound['transport'] = {'type': 'ws', 'path': p['path'] or '/', 'headers': {'Host': p['host'] or p['server']}}
+        elif p['network'] == 'grpc':
+            outbound['transport'] = {'type': 'grpc'}
+        outbounds.append(outbound)
+
+    config = {
+        'log': {'level': 'warn'},
+        'inbounds': [
+            {'type': 'tun', 'tag': 'tun-in', 'address': ['172.19.0.1/30'], 'auto_route': True, 'strict_route': True},
+            {'type': 'mixed', 'tag': 'mixed-in', 'listen': '127.0.0.1', 'listen_port': 2080},
+        ],
+        'outbounds': [{'type': 'selector', 'tag': 'proxy', 'outbounds': [o['tag'] for o in outbounds]},
+                      *outbounds, {'type': 'direct', 'tag': 'direct'}],
+        'route': {'auto_detect_interface': True, 'final': 'proxy'},
+    }
+    return json.dumps(config, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+# فرمت -> (تابع ساخت بدنه از لیست لینک‌ها، Content-Type)
+SUBSCRIPTION_FORMATS = {
+    'base64': (render_base64, 'text/plain; charset=utf-8'),
+    'clash': (render_clash, 'text/yaml; charset=utf-8'),
+    'singbox': (render_singbox, 'application/json'),
+}
@@ -0,0 +1,90 @@
+# utils/telegram_webhook.py
+
+import hmac
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telebot import types
+
+logger = logging.getLogger(__name__)
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+# سقف اندازه بدنه یک update (تلگرام به مراتب کمتر می‌فرستد)
+_MAX_BODY_BYTES = 1024 * 1024
+
+
+class TelegramWebhookServer:
+    """
+    updateهای تلگرام را از طریق وب‌هوک HTTPS (پشت nginx) دریافت می‌کند: پس از بررسی secret token،
+    update به submit_update (صف ChatOrderedDispatcher) سپرده و بلافاصله 200 برگردانده می‌شود.
+    اگر صف پر باشد 503 برگردانده می‌شود تا تلگرام بعداً دوباره ارسال کند.
+    """
+    def __init__(self, submit_update, listen: str, port: int, path: str, secret_token: str):
+        self.submit_update = submit_update
+        self.listen = listen
+        self.port = port
+        self.path = path
+        self.secret_token = secret_token
+        self._stop_event = threading.Event()
+        self._httpd = None
+
+    def _make_handler(self):
+        server = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path != server.path:
+                    return self._reply(404)
+                token = self.headers.get(SECRET_TOKEN_HEADER, '')
+                if not hmac.compare_digest(token.encode('utf-8'), server.secret_token.encode('utf-8')):
+                    logger.warning(f"Rejected Telegram webhook request with invalid secret token from {self.client_address[0]}.")
+                    return self._reply(403)
+                length = int(self.headers.get('Content-Length') or 0)
+                if length <= 0 or length > _MAX_BODY_BYTES:
+                    return self._reply(400)
+                try:
+                    update = types.Update.de_json(json.loads(self.rfile.read(length)))
+                except Exception as e:
+                    # JSON سالم با ساختار نادرست (KeyError/TypeError) هم نباید نخ درخواست را بدون پاسخ بکشد
+                    logger.warning(f"Rejected malformed Telegram update ({type(e).__name__}): {e}")
+                    return self._reply(400)
+                if update is None:
+                    return self._reply(400)
+                if not server.submit_update(update):
+                    logger.warning("Telegram update queue is full; asking Telegram to retry later.")
+                    return self._reply(503)
+                self._reply(200)
+
+            def _reply(self, status):
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass  # لاگ هر درخواست در حجم بالا فقط هزینه است
+
+        return _Handler
+
+    def start(self):
+        if self._httpd:
+            return
+        self._httpd = ThreadingHTTPServer((self.listen, self.port), self._make_handler())
+        self._httpd.daemon_threads = True
+        threading.Thread(target=self._httpd.serve_forever, name="tg-webhook-http", daemon=True).start()
+        logger.info(f"Telegram webhook listening on {self.listen}:{self.port}{self.path}.")
+
+    def wait(self):
+        """تا زمان فراخوانی stop() (مثلاً از signal handler) منتظر می‌ماند."""
+        while not self._stop_event.wait(1):
+            pass
+
+    def stop(self):
+        """دریافت update جدید را متوقف می‌کند؛ updateهای در صف توسط dispatcher پردازش می‌شوند."""
+        if self._stop_event.is_set():
+            return
+        if self._httpd:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+        self._stop_event.set()
@@ -0,0 +1,131 @@
+# utils/update_dispatcher.py
+
+import logging
+import queue
+import threading
+import time
+
+from utils.outbound import RateLimitedTeleBot
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+def update_chat_id(update):
+    """شناسه چت (یا کاربر) یک update برای انتخاب shard؛ updateهای بدون چت بر اساس update_id پخش می‌شوند."""
+    for attr in ('message', 'edited_message', 'channel_post', 'edited_channel_post', 'my_chat_member', 'chat_member',
+                 'chat_join_request'):
+        event = getattr(update, attr, None)
+        if event is not None and getattr(event, 'chat', None) is not None:
+            return event.chat.id
+    callback_query = getattr(update, 'callback_query', None)
+    if callback_query is not None:
+        return callback_query.message.chat.id if callback_query.message else callback_query.from_user.id
+    for attr in ('inline_query', 'chosen_inline_result', 'shipping_query', 'pre_checkout_query', 'poll_answer'):
+        event = getattr(update, attr, None)
+        user = getattr(event, 'from_user', None) or getattr(event, 'user', None)
+        if user is not None:
+            return user.id
+    return update.update_id
+
+
+class ChatOrderedDispatcher:
+    """
+    updateها را بر اساس شناسه چت بین num_workers نخ تقسیم (shard) می‌کند: updateهای یک چت به ترتیب و
+    یکی پس از دیگری اجرا می‌شوند (دو کلیک سریع یک کاربر روی وضعیت خرید او تداخل ندارند) و چت‌های
+    مختلف به صورت موازی. هر shard صف محدود خود را دارد (queue_size) تا فشار ورودی به منبع برگردد.
+    """
+    def __init__(self, handle_update, num_workers: int = 8, queue_size: int = 1000):
+        self._handle_update = handle_update
+        self.num_workers = max(1, num_workers)
+        self.queue_size = queue_size
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(self.num_workers)]
+        self._threads = []
+        self._lock = threading.Lock()
+        self._stats = {'submitted': 0, 'rejected': 0, 'processed': 0, 'errors': 0, 'busy_seconds': 0.0}
+        self._max_depth = 0
+
+    def submit(self, update, block: bool = True, timeout: float = None) -> bool:
+        """update را در صف shard چت آن قرار می‌دهد. اگر صف پر باشد (و block=False یا timeout تمام شود) False."""
+        shard = self._queues[hash(update_chat_id(update)) % self.num_workers]
+        try:
+            shard.put(update, block=block, timeout=timeout)
+        except queue.Full:
+            with self._lock:
+                self._stats['rejected'] += 1
+            return False
+        with self._lock:
+            self._stats['submitted'] += 1
+            self._max_depth = max(self._max_depth, shard.qsize())
+        return True
+
+    def _worker(self, shard):
+        while True:
+            update = shard.get()
+            if update is _STOP:
+                return
+            started = time.monotonic()
+            failed = False
+            try:
+                self._handle_update(update)
+            except Exception as e:
+                failed = True
+                logger.error(f"Error handling update {getattr(update, 'update_id', '?')}: {e}")
+            elapsed = time.monotonic() - started
+            with self._lock:
+                self._stats['processed'] += 1
+                self._stats['errors'] += failed
+                self._stats['busy_seconds'] += elapsed
+
+    def stats(self):
+        """اندازه pool، عمق فعلی صف هر shard و شمارنده‌های تجمعی."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['max_queue_depth'] = self._max_depth
+        depths = [shard.qsize() for shard in self._queues]
+        stats.update({'workers': self.num_workers, 'queue_size': self.queue_size,
+                      'queue_depths': depths, 'queued': sum(depths)})
+        return stats
+
+    def start(self):
+        if self._threads:
+            return
+        for i, shard in enumerate(self._queues):
+            thread = threading.Thread(target=self._worker, args=(shard,), name=f"update-dispatcher-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"Update dispatcher started with {self.num_workers} worker(s).")
+
+    def stop(self, timeout: float = 5):
+        """updateهای در صف را پردازش کرده (حداکثر timeout ثانیه) و workerها را متوقف می‌کند."""
+        deadline = time.monotonic() + timeout
+        for shard in self._queues:
+            try:
+                shard.put(_STOP, timeout=max(0, deadline - time.monotonic()))
+            except queue.Full:
+                pass
+        for thread in self._threads:
+            thread.join(timeout=max(0, deadline - time.monotonic()))
+
+
+class DispatchingTeleBot(RateLimitedTeleBot):
+    """
+    TeleBot که اجرای هندلرها را به ChatOrderedDispatcher می‌سپارد (هم در polling و هم در webhook).
+    thread pool خود کتابخانه استفاده نمی‌شود؛ هندلرها در workerهای dispatcher اجرا می‌شوند.
+    ارسال پیام‌ها از OutboundRateLimiter (bot.limiter) عبور می‌کند.
+    """
+    def __init__(self, token, num_workers: int = 8, queue_size: int = 1000, **kwargs):
+        super().__init__(token, threaded=False, **kwargs)
+        self.dispatcher = ChatOrderedDispatcher(self._handle_update, num_workers, queue_size)
+
+    def _handle_update(self, update):
+        super().process_new_updates([update])
+
+    def process_new_updates(self, updates):
+        # polling آفست بعدی را از last_update_id می‌خواند؛ چون اجرا به تعویق می‌افتد همین‌جا جلو برده می‌شود
+        for update in updates:
+            if update.update_id > self.last_update_id:
+                self.last_update_id = update.update_id
+            # در polling صبر روی صف پر، دریافت updateهای بعدی را کند می‌کند
+            self.dispatcher.submit(update)
@@ -0,0 +1,61 @@
+# utils/usage_sync.py
+
+import datetime
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from api_client import client_registry
+from config import USAGE_SYNC_MAX_WORKERS
+from utils.periodic import PeriodicWorker
+
+logger = logging.getLogger(__name__)
+
+
+class UsageSyncEngine(PeriodicWorker):
+    """
+    آمار ترافیک تمام کلاینت‌ها را با یک درخواست برای هر پنل دریافت کرده و در جدول client_usage
+    ذخیره می‌کند تا نمایش مصرف کاربران فقط با خواندن از دیتابیس انجام شود.
+    با start() در یک نخ پس‌زمینه به صورت دوره‌ای اجرا می‌شود.
+    """
+    thread_name = "usage-sync"
+    display_name = "Usage sync engine"
+
+    def __init__(self, db_manager, xui_api_class, interval_seconds: float = 0):
+        self.db_manager = db_manager
+        self.xui_api = xui_api_class
+        super().__init__(interval_seconds)
+
+    def _sync_server(self, server):
+        client = client_registry.get_client_for_server(server, self.xui_api)
+        # هر آیتم هنگام پارس جریانی به یک tuple فشرده تبدیل می‌شود
+        client_stats = client.list_client_traffics(transform=lambda stat: (
+            stat.get('email'), int(stat.get('up') or 0), int(stat.get('down') or 0), int(stat.get('total') or 0),
+            int(stat.get('expiryTime') or 0), stat.get('enable')))
+        if client_stats is None:
+            logger.warning(f"Usage sync: could not fetch client traffics from server {server['id']}.")
+            return server, None
+
+        # یک ایمیل ممکن است در چند اینباند یک پنل تکرار شده باشد؛ آمار پنل برای هر ایمیل یکتاست
+        rows = {row[0]: row for row in client_stats if row[0]}
+        synced_at = datetime.datetime.now(datetime.timezone.utc)
+        if not self.db_manager.sync_client_usage(server['id'], list(rows.values()), synced_at):
+            return server, None
+        return server, len(rows)
+
+    def run_once(self):
+        """
+        یک دور همگام‌سازی روی سرورهای فعال و آنلاین. لیست (server, تعداد کلاینت‌ها یا None در صورت خطا) را برمی‌گرداند.
+        """
+        servers = self.db_manager.get_all_servers(only_active=True)
+        if not servers:
+            return []
+
+        with ThreadPoolExecutor(max_workers=min(USAGE_SYNC_MAX_WORKERS, len(servers)), thread_name_prefix="usage-sync") as executor:
+            results = list(executor.map(self._sync_server, servers))
+
+        synced = sum(count for _, count in results if count)
+        failed = [server['name'] for server, count in results if count is None]
+        logger.info(f"Usage sync: {synced} client(s) from {len(results) - len(failed)}/{len(results)} server(s).")
+        if failed:
+            logger.warning(f"Usage sync failed for: {', '.join(failed)}")
+        return results
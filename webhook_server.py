@@ -1,42 +1,129 @@
 # webhook_server.py
 
-from flask import Flask, request, render_template
+from flask import Flask, Response, request, render_template
 import requests
 import json
 import logging
 import os
 import sys
-import datetime
+import atexit
 
 # افزودن مسیر پروژه به sys.path
 project_path = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, project_path)
 
 # وارد کردن ماژول‌های پروژه
-from config import BOT_TOKEN, BOT_USERNAME_ALAMOR # <-- اصلاح شد
+from config import (BOT_USERNAME_ALAMOR, ZARINPAL_VERIFY_URL, ZARINPAL_VERIFY_TIMEOUT_SECONDS,
+                    ZARINPAL_VERIFY_CLAIM_TIMEOUT_SECONDS, DB_POOL_MAX_SIZE, WEBHOOK_THREADS)
 from database.db_manager import DatabaseManager
-from utils.bot_helpers import send_subscription_info
-from utils.config_generator import ConfigGenerator
-from api_client.xui_api_client import XuiAPIClient
-import telebot
+from utils import messages
+from utils.outbound import queue_message, message_row, PRIORITY_NORMAL
+from utils.provisioning import verify_payment_and_enqueue
+from utils.subscription_cache import SubscriptionCache
+from utils.subscription_formats import negotiate_format
 
 # تنظیمات اولیه
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
-db_manager = DatabaseManager()
-bot = telebot.TeleBot(BOT_TOKEN)
-config_gen = ConfigGenerator(XuiAPIClient, db_manager)
 
-# آدرس API واقعی زرین‌پال
-ZARINPAL_VERIFY_URL = "https://api.zarinpal.com/pg/v4/payment/verify.json"
+# اتصالات دیتابیس و نخ‌های پس‌زمینه متعلق به هر پروسه worker هستند و با init_worker ساخته می‌شوند؛
+# اگر در پروسه master گانیکورن (preload_app) ساخته شوند، سوکت‌ها بین workerهای fork شده مشترک می‌شوند
+db_manager = None
+subscription_cache = None
+
+
+def prepare_database():
+    """جداول و مهاجرت‌ها را یک بار (در پروسه master یا اجرای مستقیم) اعمال کرده و اتصالاتش را می‌بندد."""
+    setup_db = DatabaseManager()
+    try:
+        setup_db.create_tables()
+        setup_db.run_migrations()
+    finally:
+        setup_db.close()
+
+
+def init_worker():
+    """Pool دیتابیس و کش سابسکریپشن اختصاصی همین پروسه را می‌سازد (در gunicorn از هوک post_fork)."""
+    global db_manager, subscription_cache
+    # هر نخ gunicorn حداکثر یک اتصال همزمان لازم دارد (+1 برای نخ پس‌زمینه کش)
+    db_manager = DatabaseManager(pool_max_size=min(DB_POOL_MAX_SIZE, WEBHOOK_THREADS + 1))
+    subscription_cache = SubscriptionCache(db_manager)
+    subscription_cache.start()
+
+
+def shutdown_worker():
+    if subscription_cache:
+        subscription_cache.stop()
+    if db_manager:
+        db_manager.close() # بستن اتصالات Pool هنگام خروج
+
+
+prepare_database()
+
 BOT_USERNAME = BOT_USERNAME_ALAMOR # <-- اصلاح شد
 
 @app.route('/', methods=['GET'])
 def index():
     return "AlamorVPN Bot Webhook Server is running."
 
+
+def _render_payment_outcome(payment):
+    """نتیجه ذخیره شده یک پرداخت را برای درخواست‌هایی که claim بررسی را به دست نیاوردند نمایش می‌دهد."""
+    if payment['is_confirmed']:
+        return render_template('payment_status.html', status='success', ref_id=payment.get('ref_id'), bot_username=BOT_USERNAME)
+    state = payment.get('verification_state')
+    if state == 'verifying':
+        return render_template('payment_status.html', status='pending', message=messages.PAYMENT_VERIFY_IN_PROGRESS, bot_username=BOT_USERNAME)
+    if state == 'cancelled':
+        return render_template('payment_status.html', status='error', message=messages.PAYMENT_VERIFY_CANCELLED, bot_username=BOT_USERNAME)
+    message = payment.get('verification_message') if state == 'failed' else messages.PAYMENT_VERIFY_GATEWAY_ERROR
+    return render_template('payment_status.html', status='error', message=message, bot_username=BOT_USERNAME)
+
+
+def _verify_claimed_payment(payment, authority):
+    """
+    پرداختی که claim آن در اختیار این درخواست است را با درگاه بررسی و نتیجه را ثبت می‌کند.
+    فقط همین درخواست سرویس را در صف ساخت قرار داده و به کاربر پیام می‌دهد.
+    """
+    user_telegram_id = db_manager.get_user_by_id(payment['user_id'])['telegram_id']
+    order_details = json.loads(payment['order_details_json'])
+    gateway = db_manager.get_payment_gateway_by_id(order_details['gateway_details']['id'])
+    payload = {"merchant_id": gateway['merchant_id'], "amount": int(payment['amount']) * 10, "authority": authority}
+
+    try:
+        response = requests.post(ZARINPAL_VERIFY_URL, json=payload, timeout=ZARINPAL_VERIFY_TIMEOUT_SECONDS)
+        response.raise_for_status()
+        result = response.json()
+    except (requests.exceptions.RequestException, ValueError) as e:
+        logger.error(f"Error verifying with Zarinpal: {e}")
+        # claim آزاد می‌شود تا بارگذاری دوباره صفحه، بررسی را تکرار کند
+        db_manager.finish_payment_verification(payment['id'], None)
+        return render_template('payment_status.html', status='error', message=messages.PAYMENT_VERIFY_GATEWAY_ERROR, bot_username=BOT_USERNAME)
+
+    data = result.get("data") or {}
+    # کد 101 یعنی این تراکنش قبلاً verify شده است (مثلاً claim قبلی پیش از ثبت نتیجه از کار افتاده)
+    if data.get("code") in [100, 101]:
+        ref_id = str(data.get("ref_id", "N/A"))
+        logger.info(f"Payment {payment['id']} verified successfully. Ref ID: {ref_id}")
+        # تایید پرداخت، کار ساخت سرویس و پیام کاربر (outbox) در یک تراکنش ثبت می‌شوند تا پاسخ به درگاه منتظر
+        # پنل‌ها نماند و پرداخت برداشت شده بدون کار ساخت باقی نماند؛ worker ربات پس از ساخت، اطلاعات سرویس را می‌فرستد
+        notification = message_row(user_telegram_id, messages.PROVISIONING_QUEUED_USER, priority=PRIORITY_NORMAL)
+        if verify_payment_and_enqueue(db_manager, payment['id'], user_telegram_id, ref_id, [notification]) is None:
+            # چیزی ثبت نشده است؛ claim آزاد می‌شود تا بارگذاری دوباره صفحه (با کد 101 درگاه) ثبت را تکرار کند
+            db_manager.finish_payment_verification(payment['id'], None)
+            return render_template('payment_status.html', status='error', message=messages.PAYMENT_VERIFY_GATEWAY_ERROR, bot_username=BOT_USERNAME)
+        return render_template('payment_status.html', status='success', ref_id=ref_id, bot_username=BOT_USERNAME)
+
+    errors = result.get("errors")
+    error_message = (errors.get("message") if isinstance(errors, dict) else None) or "خطای نامشخص"
+    if db_manager.finish_payment_verification(payment['id'], 'failed', message=error_message):
+        queue_message(db_manager, user_telegram_id, messages.PAYMENT_VERIFY_REJECTED_USER.format(error=error_message),
+                      priority=PRIORITY_NORMAL)
+    return render_template('payment_status.html', status='error', message=error_message, bot_username=BOT_USERNAME)
+
+
 @app.route('/zarinpal/verify', methods=['GET'])
 def handle_zarinpal_callback():
     authority = request.args.get('Authority')
@@ -45,101 +132,65 @@ def handle_zarinpal_callback():
     logger.info(f"Callback received from Zarinpal >> Status: {status}, Authority: {authority}")
 
     if not authority or not status:
-        return render_template('payment_status.html', status='error', message="اطلاعات بازگشتی از درگاه ناقص است.", bot_username=BOT_USERNAME)
+        return render_template('payment_status.html', status='error', message=messages.PAYMENT_VERIFY_INCOMPLETE, bot_username=BOT_USERNAME)
 
-    payment = db_manager.get_payment_by_authority(authority)
+    # رفرش مرورگر یا تکرار callback توسط درگاه نباید پرداخت را دو بار بررسی و سرویس را دو بار بسازد:
+    # فقط درخواستی که UPDATE شرطی را برنده شود ادامه می‌دهد و بقیه نتیجه ذخیره شده را می‌بینند
+    claim_state = 'verifying' if status == 'OK' else 'cancelled'
+    payment = db_manager.claim_payment_verification(authority, claim_state, ZARINPAL_VERIFY_CLAIM_TIMEOUT_SECONDS)
     if not payment:
-        logger.warning(f"Payment not found for Authority: {authority}")
-        return render_template('payment_status.html', status='error', message="تراکنش یافت نشد.", bot_username=BOT_USERNAME)
-    
-    user_db_info = db_manager.get_user_by_id(payment['user_id'])
-    user_telegram_id = user_db_info['telegram_id']
+        payment = db_manager.get_payment_by_authority(authority)
+        if not payment:
+            logger.warning(f"Payment not found for Authority: {authority}")
+            return render_template('payment_status.html', status='error', message=messages.PAYMENT_VERIFY_NOT_FOUND, bot_username=BOT_USERNAME)
+        logger.info(f"Payment ID {payment['id']} is already handled (state: {payment.get('verification_state')}, confirmed: {payment['is_confirmed']}).")
+        return _render_payment_outcome(payment)
+
+    if claim_state == 'cancelled':
+        user_db_info = db_manager.get_user_by_id(payment['user_id'])
+        queue_message(db_manager, user_db_info['telegram_id'], messages.PAYMENT_VERIFY_CANCELLED_USER, priority=PRIORITY_NORMAL)
+        return render_template('payment_status.html', status='error', message=messages.PAYMENT_VERIFY_CANCELLED, bot_username=BOT_USERNAME)
 
-    if payment['is_confirmed']:
-        logger.warning(f"Payment ID {payment['id']} has already been confirmed.")
-        return render_template('payment_status.html', status='success', ref_id=payment.get('ref_id'), bot_username=BOT_USERNAME)
+    try:
+        return _verify_claimed_payment(payment, authority)
+    except Exception:
+        # claim در وضعیت verifying نمی‌ماند تا پایان مهلت، درخواست‌های بعدی مسدود نشوند
+        db_manager.finish_payment_verification(payment['id'], None)
+        raise
 
-    if status == 'OK':
-        order_details = json.loads(payment['order_details_json'])
-        gateway = db_manager.get_payment_gateway_by_id(order_details['gateway_details']['id'])
-        
-        payload = {"merchant_id": gateway['merchant_id'], "amount": int(payment['amount']) * 10, "authority": authority}
-        
-        try:
-            response = requests.post(ZARINPAL_VERIFY_URL, json=payload, timeout=20)
-            response.raise_for_status()
-            result = response.json()
-
-            if result.get("data") and result.get("data", {}).get("code") in [100, 101]:
-                ref_id = result.get("data", {}).get("ref_id", "N/A")
-                logger.info(f"Payment {payment['id']} verified successfully. Ref ID: {ref_id}")
-                
-                if order_details['plan_type'] == 'fixed_monthly':
-                    plan = order_details['plan_details']
-                    total_gb, duration_days = plan['volume_gb'], plan['duration_days']
-                else:
-                    gb_plan = order_details['gb_plan_details']
-                    total_gb, duration_days = order_details['requested_gb'], gb_plan.get('duration_days', 0)
-                
-                client_details, sub_link, single_configs = config_gen.create_client_and_configs(user_telegram_id, order_details['server_id'], total_gb, duration_days)
-                
-                if sub_link:
-                    expire_date = (datetime.datetime.now() + datetime.timedelta(days=duration_days)) if duration_days and duration_days > 0 else None
-                    plan_id = order_details.get('plan_details', {}).get('id') or order_details.get('gb_plan_details', {}).get('id')
-                    
-                    db_manager.add_purchase(
-                        user_id=payment['user_id'], server_id=order_details['server_id'], plan_id=plan_id,
-                        expire_date=expire_date.strftime("%Y-%m-%d %H:%M:%S") if expire_date else None,
-                        initial_volume_gb=total_gb, client_uuid=client_details['uuid'],
-                        client_email=client_details['email'], sub_id=client_details['subscription_id'],
-                        single_configs=single_configs
-                    )
-                    
-                    db_manager.confirm_online_payment(payment['id'], str(ref_id))
-                    bot.send_message(user_telegram_id, "✅ پرداخت شما با موفقیت تایید و سرویس شما فعال گردید.")
-                    send_subscription_info(bot, user_telegram_id, sub_link)
-                else:
-                    bot.send_message(user_telegram_id, "❌ در فعال‌سازی سرویس شما خطایی رخ داد. لطفاً با پشتیبانی تماس بگیرید.")
-                
-                return render_template('payment_status.html', status='success', ref_id=ref_id, bot_username=BOT_USERNAME)
-            else:
-                error_message = result.get("errors", {}).get("message", "خطای نامشخص")
-                bot.send_message(user_telegram_id, f"❌ پرداخت شما توسط درگاه تایید نشد. (خطا: {error_message})")
-                return render_template('payment_status.html', status='error', message=error_message, bot_username=BOT_USERNAME)
-
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Error verifying with Zarinpal: {e}")
-            return render_template('payment_status.html', status='error', message="خطا در ارتباط با سرور درگاه پرداخت.", bot_username=BOT_USERNAME)
-    else:
-        bot.send_message(user_telegram_id, "شما فرآیند پرداخت را لغو کردید. سفارش شما ناتمام باقی ماند.")
-        return render_template('payment_status.html', status='error', message="تراکنش توسط شما لغو شد.", bot_username=BOT_USERNAME)
-import base64
 
 @app.route('/sub/<subscription_id>', methods=['GET'])
 def handle_subscription_request(subscription_id):
-    """محتوای لینک سابسکریپشن ترکیبی را به کاربر تحویل می‌دهد."""
-    logger.info(f"Subscription request received for ID: {subscription_id}")
-    purchase = db_manager.get_purchase_by_subscription_id(subscription_id)
-    
-    if not purchase or not purchase['is_active']:
-        return "Subscription not found or is inactive.", 404
-        
-    configs_json = purchase.get('full_configs_json')
-    if not configs_json:
-        return "", 204 # No Content
+    """
+    محتوای لینک سابسکریپشن ترکیبی را از کش تحویل می‌دهد (با ETag/304 و هدر subscription-userinfo).
+    فرمت با پارامتر format (base64، clash یا singbox) یا User-Agent کلاینت انتخاب می‌شود.
+    """
+    fmt = negotiate_format(request.args.get('format'), request.user_agent.string)
+    if not fmt:
+        return "Unsupported subscription format.", 400
 
     try:
-        config_list = json.loads(configs_json)
-        config_urls = [item['url'] for item in config_list if 'url' in item]
-        
-        if not config_urls:
-            return "", 204
-
-        combined_configs = "\n".join(config_urls)
-        return base64.b64encode(combined_configs.encode('utf-8')).decode('utf-8')
-        
+        entry = subscription_cache.get(subscription_id)
+        if entry is None:
+            return "Subscription not found or is inactive.", 404
+        rendered = entry.render(fmt)
+        userinfo = subscription_cache.userinfo(subscription_id, entry)
     except Exception as e:
         logger.error(f"Error processing subscription ID {subscription_id}: {e}")
         return "Internal Server Error", 500
+
+    if not rendered.body:
+        return "", 204 # No Content
+
+    response = Response(rendered.body, content_type=rendered.mimetype)
+    response.headers['subscription-userinfo'] = userinfo
+    response.vary.add('User-Agent')
+    response.set_etag(rendered.etag)
+    response.last_modified = entry.last_modified
+    return response.make_conditional(request)
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8080)
\ No newline at end of file
+    # سرور توسعه Flask (تک پروسه)؛ در محیط production با gunicorn -c gunicorn.conf.py webhook_server:app اجرا شود
+    init_worker()
+    atexit.register(shutdown_worker)
+    app.run(host='0.0.0.0', port=8080)